@@ -0,0 +1,217 @@
+import math
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+DAY = 86400.0
+HALF_LIFE_DAYS = 180.0  # le sessioni di sei mesi fa pesano la metà nel trend
+MIN_SESSIONS = 10       # sotto questa soglia il trend non è affidabile
+MIN_SPAN_DAYS = 90      # su periodi più brevi la pendenza è solo rumore
+OUTLIER_Z = 4.0
+# Stime di salute fuori da questo intervallo vengono da sessioni troppo brevi o interrotte
+HEALTH_MIN = 30.0
+HEALTH_MAX = 150.0
+
+
+def _float(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if math.isfinite(value) else None
+
+
+def health_percent(value):
+    # battery_health_estimate a volte è in scala 0-1: la porto in percentuale
+    value = _float(value)
+    if value is None or value <= 0:
+        return None
+    value = value * 100 if value <= 1.5 else value
+    return value if HEALTH_MIN <= value <= HEALTH_MAX else None
+
+
+class RunningStats:
+    # Media e varianza online (Welford)
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    @property
+    def variance(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else 0.0
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+    def zscore(self, x):
+        std = self.std
+        return abs(x - self.mean) / std if std > 0 else 0.0
+
+
+class ExponentialTrend:
+    # Retta di regressione pesata con pesi che decadono esponenzialmente nel tempo:
+    # le somme pesate si aggiornano in O(1) a ogni punto, senza rileggere lo storico
+    def __init__(self, half_life_days=HALF_LIFE_DAYS):
+        self.decay_per_day = math.log(2) / half_life_days
+        self.t0 = None
+        self.last_t = None
+        self.s0 = self.st = self.sx = self.stt = self.stx = 0.0
+        self.n = 0
+
+    def add(self, t, x):
+        # t in giorni (qualsiasi origine), x valore osservato
+        if self.t0 is None:
+            self.t0 = self.last_t = t
+        if t > self.last_t:
+            w = math.exp(-(t - self.last_t) * self.decay_per_day)
+            self.s0 *= w
+            self.st *= w
+            self.sx *= w
+            self.stt *= w
+            self.stx *= w
+            self.last_t = t
+        u = t - self.t0
+        self.s0 += 1.0
+        self.st += u
+        self.sx += x
+        self.stt += u * u
+        self.stx += u * x
+        self.n += 1
+
+    def has_slope(self):
+        return self.n >= MIN_SESSIONS and self.last_t - self.t0 >= MIN_SPAN_DAYS
+
+    @property
+    def slope(self):
+        # Variazione per giorno (0 se il periodo coperto è troppo breve)
+        if not self.has_slope():
+            return 0.0
+        den = self.s0 * self.stt - self.st * self.st
+        if den <= 1e-9 * max(self.s0 * self.stt, 1.0):
+            return 0.0
+        return (self.s0 * self.stx - self.st * self.sx) / den
+
+    def level(self, t=None):
+        if not self.n:
+            return None
+        t = self.last_t if t is None else t
+        mean_u = self.st / self.s0
+        return self.sx / self.s0 + self.slope * (t - self.t0 - mean_u)
+
+
+class BatteryHealthTracker:
+    # Stato della batteria di un veicolo, aggiornato sessione per sessione:
+    # salute stimata, autonomia a batteria carica ed energia per punto di SoC
+    def __init__(self, half_life_days=HALF_LIFE_DAYS):
+        self.health = ExponentialTrend(half_life_days)
+        self.autonomy = ExponentialTrend(half_life_days)
+        self.health_stats = RunningStats()
+        self.autonomy_stats = RunningStats()
+        self.energy_per_soc = RunningStats()
+        self.n_sessions = 0
+        self.rejected = 0
+        self.last_time = None
+
+    def _time(self, record):
+        try:
+            when = datetime.fromisoformat(record.get("end_time") or record["start_time"])
+        except (KeyError, TypeError, ValueError):
+            return self.last_time
+        return when.timestamp() / DAY
+
+    def _add(self, trend, stats, t, x):
+        # Le stime di una singola sessione sono rumorose: scarto solo i valori assurdi
+        if stats.n >= MIN_SESSIONS and stats.zscore(x) > OUTLIER_Z:
+            self.rejected += 1
+            return
+        stats.add(x)
+        trend.add(t, x)
+
+    def add_session(self, record):
+        t = self._time(record)
+        if t is None:
+            return False
+        self.last_time = t if self.last_time is None else max(self.last_time, t)
+        health = health_percent(record.get("battery_health_estimate"))
+        if health is not None:
+            self._add(self.health, self.health_stats, t, health)
+        end_level = _float(record.get("end_battery_level"))
+        autonomy = _float(record.get("battery_autonomy"))
+        if autonomy and end_level and end_level >= 20:
+            # Autonomia riportata al 100% per confrontare sessioni con SoC finali diversi
+            self._add(self.autonomy, self.autonomy_stats, t, autonomy * 100 / end_level)
+        start_level = _float(record.get("start_battery_level"))
+        energy = _float(record.get("energy_measured"))
+        if energy and start_level is not None and end_level and end_level > start_level:
+            self.energy_per_soc.add(energy / (end_level - start_level))
+        self.n_sessions += 1
+        return True
+
+    @classmethod
+    def from_sessions(cls, sessions, vin=None, **kwargs):
+        tracker = cls(**kwargs)
+        for record in sessions:
+            if record.get("vin") in (None, vin):
+                tracker.add_session(record)
+        return tracker
+
+    def current_health(self):
+        return self.health.level()
+
+    def degradation_per_year(self):
+        # Punti percentuali di salute persi in un anno (positivo = degrado)
+        if not self.health.has_slope():
+            return None
+        return -self.health.slope * 365
+
+    def summary(self):
+        level = self.health.level()
+        autonomy = self.autonomy.level()
+        degradation = self.degradation_per_year()
+        return {
+            "sessions": self.n_sessions,
+            "health": round(level, 2) if level is not None else None,
+            "health_std": round(self.health_stats.std, 2),
+            "degradation_per_year": round(degradation, 2) if degradation is not None else None,
+            "autonomy_full_km": round(autonomy, 1) if autonomy is not None else None,
+            "autonomy_km_per_year": round(self.autonomy.slope * 365, 1) if self.autonomy.has_slope() else None,
+            "kwh_per_soc_point": round(self.energy_per_soc.mean, 4) if self.energy_per_soc.n else None,
+            "rejected": self.rejected,
+        }
+
+    def describe(self):
+        # Riga per il messaggio Telegram di fine ricarica
+        level = self.health.level()
+        if level is None:
+            return None
+        text = f"🔋 Salute batteria stimata: {level:.1f}%"
+        degradation = self.degradation_per_year()
+        if degradation is not None:
+            text += f" ({-degradation:+.1f} punti/anno)"
+        autonomy = self.autonomy.level()
+        if autonomy is not None:
+            text += f" | Autonomia al 100%: {autonomy:.0f} km"
+        return text
+
+
+def fit_health_trackers(sessions, vins, **kwargs):
+    # Un solo passaggio sull'archivio per tutta la flotta; le sessioni senza VIN
+    # (storico precedente alla gestione multi-veicolo) valgono per tutti
+    trackers = {vin: BatteryHealthTracker(**kwargs) for vin in vins}
+    for record in sessions:
+        vin = record.get("vin")
+        if vin is None:
+            for tracker in trackers.values():
+                tracker.add_session(record)
+        elif vin in trackers:
+            trackers[vin].add_session(record)
+    return trackers
@@ -0,0 +1,178 @@
+import logging
+from collections import deque
+
+from analitica_batteria import OUTLIER_Z, MIN_SESSIONS, health_percent
+from curva_ricarica import DEFAULT_RATE
+
+logger = logging.getLogger(__name__)
+
+# Azioni suggerite dal rilevatore
+ACTION_ALERT = "allarme"      # solo messaggio
+ACTION_BACKOFF = "diradamento"  # messaggio e controlli del cavo meno frequenti (meno chiamate API)
+ACTION_STOP = "stop"          # presa spenta fino allo scollegamento del cavo
+
+CHARGING = 1.0
+# chargingStatus di Kamereon (renault_api ChargeState)
+STATUS_TEXT = {
+    0.0: "non in carica",
+    0.1: "in attesa di una ricarica programmata",
+    0.2: "ricarica terminata dall'auto",
+    0.3: "in attesa di corrente",
+    0.4: "sportello di ricarica aperto",
+    -1.0: "errore di ricarica",
+    -1.1: "stato non disponibile",
+}
+
+STATUS_GRACE = 900      # s: l'auto può impiegare qualche minuto a iniziare la ricarica
+STALL_FACTOR = 4.0      # SoC fermo per 4 volte il tempo previsto per un punto: allarme; 8 volte: stop
+MIN_STALL = 2700        # s: mai meno di 45 minuti (le letture Renault possono arrivare in ritardo)
+SLOW_RATIO = 0.4        # meno del 40% dei punti previsti dalla curva: ricarica lenta
+SLOW_WINDOW = 7200      # s: velocità misurata sulle ultime due ore (il SoC arriva a punti interi)
+AUTONOMY_JUMP_KM = 30.0  # km di autonomia non spiegati dalla variazione di SoC
+MAX_BACKOFF = 8
+
+
+class Anomaly:
+    __slots__ = ("kind", "action", "message")
+
+    def __init__(self, kind, action, message):
+        self.kind = kind
+        self.action = action
+        self.message = message
+
+    def __repr__(self):
+        return f"Anomaly({self.kind!r}, {self.action!r}, {self.message!r})"
+
+
+class ChargeAnomalyDetector:
+    # Rilevatore online per una sessione di ricarica, alimentato dalle letture dello stato
+    # della batteria che il ciclo di ricarica fa comunque (nessuna chiamata in più).
+    # Confronta l'avanzamento del SoC con la curva appresa, segue chargingStatus e
+    # l'autonomia; ogni anomalia viene segnalata una sola volta per tipo e azione
+    def __init__(self, curve=None, health_tracker=None, status_grace=STATUS_GRACE,
+                 stall_factor=STALL_FACTOR, min_stall=MIN_STALL, slow_ratio=SLOW_RATIO,
+                 slow_window=SLOW_WINDOW, autonomy_jump_km=AUTONOMY_JUMP_KM):
+        self.curve = curve
+        self.health_tracker = health_tracker
+        self.status_grace = status_grace
+        self.stall_factor = stall_factor
+        self.min_stall = min_stall
+        self.slow_ratio = slow_ratio
+        self.slow_window = slow_window
+        self.autonomy_jump_km = autonomy_jump_km
+        self.started_at = None
+        self.last_soc = None
+        self.last_autonomy = None
+        self.progress_at = None
+        self.not_charging_since = None
+        self.km_per_pct = None
+        self.backoff = 1
+        self.samples = 0
+        self.window = deque()  # (istante, SoC) delle ultime slow_window
+        self.reported = set()
+
+    def _seconds_per_point(self, soc):
+        if self.curve is None:
+            return 3600 / DEFAULT_RATE
+        return max(60.0, self.curve.seconds_between(soc, min(100, soc + 1)))
+
+    def _expected_points(self, soc_from, elapsed):
+        if self.curve is None:
+            return elapsed / 3600 * DEFAULT_RATE
+        return self.curve.soc_after(soc_from + 0.5, elapsed) - (soc_from + 0.5)
+
+    def observe(self, now, status):
+        # now: secondi (tempo del loop); status: risposta di get_battery_status
+        soc = getattr(status, "batteryLevel", None)
+        if soc is None:
+            return []
+        charging_status = getattr(status, "chargingStatus", None)
+        autonomy = getattr(status, "batteryAutonomy", None)
+        self.samples += 1
+        if self.started_at is None:
+            self.started_at = self.progress_at = now
+            self.last_soc = soc
+            self.last_autonomy = autonomy
+            if autonomy and soc > 0:
+                self.km_per_pct = autonomy / soc
+            self.window.append((now, soc))
+            return []
+
+        found = []
+        progressed = soc > self.last_soc
+        if progressed:
+            # Il SoC che sale vale più di qualsiasi stato riportato: la ricarica procede
+            self.progress_at = now
+            self.not_charging_since = None
+            self.backoff = 1
+            # Uno stallo successivo va segnalato di nuovo (e può ancora fermare la ricarica)
+            self.reported -= {("stallo", ACTION_BACKOFF), ("stallo", ACTION_STOP)}
+        elif charging_status is not None and charging_status != CHARGING:
+            if self.not_charging_since is None:
+                self.not_charging_since = now
+            elif now - self.not_charging_since >= self.status_grace:
+                text = STATUS_TEXT.get(charging_status, f"stato {charging_status}")
+                found.append(Anomaly("rifiuto", ACTION_STOP,
+                                     f"l'auto non sta caricando ({text}) da {(now - self.not_charging_since) / 60:.0f} min "
+                                     f"con batteria al {soc}%"))
+        else:
+            self.not_charging_since = None
+
+        stall_limit = max(self.min_stall, self.stall_factor * self._seconds_per_point(soc))
+        stalled_for = now - self.progress_at
+        if stalled_for >= 2 * stall_limit:
+            found.append(Anomaly("stallo", ACTION_STOP,
+                                 f"batteria ferma al {soc}% da {stalled_for / 60:.0f} min"))
+        elif stalled_for >= stall_limit:
+            if ("stallo", ACTION_BACKOFF) not in self.reported:
+                self.backoff = min(MAX_BACKOFF, self.backoff * 4)
+            found.append(Anomaly("stallo", ACTION_BACKOFF,
+                                 f"batteria ferma al {soc}% da {stalled_for / 60:.0f} min, "
+                                 f"previsto un punto ogni {self._seconds_per_point(soc) / 60:.0f} min"))
+
+        window = self.window
+        window.append((now, soc))
+        while len(window) > 2 and window[1][0] <= now - self.slow_window:
+            window.popleft()
+        since, soc_then = window[0]
+        elapsed = now - since
+        if elapsed >= self.slow_window:
+            expected = self._expected_points(soc_then, elapsed)
+            observed = soc - soc_then
+            if expected >= 3 and observed < self.slow_ratio * expected:
+                hours = elapsed / 3600
+                found.append(Anomaly("lenta", ACTION_ALERT,
+                                     f"ricarica lenta: {observed / hours:.1f}%/h invece di {expected / hours:.1f}%/h"))
+
+        if autonomy is not None and self.last_autonomy is not None and self.km_per_pct:
+            unexplained = (autonomy - self.last_autonomy) - (soc - self.last_soc) * self.km_per_pct
+            if abs(unexplained) > self.autonomy_jump_km:
+                found.append(Anomaly("autonomia", ACTION_ALERT,
+                                     f"autonomia passata da {self.last_autonomy} a {autonomy} km "
+                                     f"con il SoC da {self.last_soc}% a {soc}%"))
+
+        self.last_soc = soc
+        self.last_autonomy = autonomy
+        return self._new(found)
+
+    def check_health(self, health_estimate):
+        # Stima di salute di fine sessione lontana dal trend (verrebbe scartata dal tracker)
+        health = health_percent(health_estimate)
+        tracker = self.health_tracker
+        if health is None or tracker is None or tracker.health_stats.n < MIN_SESSIONS:
+            return []
+        if tracker.health_stats.zscore(health) <= OUTLIER_Z:
+            return []
+        trend = tracker.current_health()
+        reference = f"trend {trend:.1f}%" if trend is not None else f"media {tracker.health_stats.mean:.1f}%"
+        return self._new([Anomaly("salute", ACTION_ALERT,
+                                  f"stima di salute della batteria anomala: {health:.1f}% ({reference})")])
+
+    def _new(self, found):
+        fresh = []
+        for anomaly in found:
+            key = (anomaly.kind, anomaly.action)
+            if key not in self.reported:
+                self.reported.add(key)
+                fresh.append(anomaly)
+        return fresh
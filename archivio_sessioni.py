@@ -0,0 +1,158 @@
+import os
+import json
+import sqlite3
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STORE_PATH = "charging_data.jsonl"
+LEGACY_JSON_PATH = "charging_data.json"
+
+
+# === INTERFACCIA COMUNE ===
+class SessionStore:
+    def append(self, record):
+        self.extend([record])
+
+    def extend(self, records):
+        raise NotImplementedError
+
+    def iter_records(self):
+        raise NotImplementedError
+
+    def read_all(self):
+        return list(self.iter_records())
+
+    def is_empty(self):
+        return next(iter(self.iter_records()), None) is None
+
+    def close(self):
+        pass
+
+
+# === BACKEND JSON LINES (append-only) ===
+class JsonLinesSessionStore(SessionStore):
+    def __init__(self, path=DEFAULT_STORE_PATH):
+        self.path = path
+        self._repair_tail()
+
+    def _repair_tail(self):
+        # Un crash durante la scrittura può lasciare una riga troncata in coda:
+        # la tronco all'ultimo "\n" così le append successive restano valide
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb+') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b"\n":
+                return
+            block = min(size, 64 * 1024)
+            pos = size
+            while pos > 0:
+                start = max(0, pos - block)
+                f.seek(start)
+                chunk = f.read(pos - start)
+                idx = chunk.rfind(b"\n")
+                if idx != -1:
+                    pos = start + idx + 1
+                    break
+                pos = start
+            logger.warning(f"Archivio sessioni {self.path}: rimossa riga incompleta ({size - pos} byte)")
+            f.truncate(pos)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def extend(self, records):
+        payload = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records)
+        if not payload:
+            return
+        # Una sola write in O_APPEND + fsync: costo O(1) rispetto allo storico
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def iter_records(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for n, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"Archivio sessioni {self.path}: riga {n} non valida, ignorata")
+
+
+# === BACKEND SQLITE ===
+class SqliteSessionStore(SessionStore):
+    def __init__(self, path="charging_data.db"):
+        self.path = path
+        # Le scritture arrivano dal thread di scrittura (scrittura.writer), le letture dal loop
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "start_time TEXT, "
+            "data TEXT NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_start ON sessions(start_time)")
+        self.conn.commit()
+
+    def extend(self, records):
+        rows = [(r.get("start_time"), json.dumps(r, ensure_ascii=False)) for r in records]
+        if not rows:
+            return
+        with self.conn:
+            self.conn.executemany("INSERT INTO sessions (start_time, data) VALUES (?, ?)", rows)
+
+    def iter_records(self):
+        for (data,) in self.conn.execute("SELECT data FROM sessions ORDER BY id"):
+            yield json.loads(data)
+
+    def close(self):
+        self.conn.close()
+
+
+# === MIGRAZIONE DAL VECCHIO charging_data.json ===
+def migrate_json_array(json_path, store):
+    with open(json_path, 'r', encoding='utf-8') as f:
+        records = json.load(f)
+    store.extend(records)
+    migrated_path = json_path + ".migrated"
+    os.replace(json_path, migrated_path)
+    logger.info(f"Migrate {len(records)} sessioni da {json_path} (originale in {migrated_path})")
+    return len(records)
+
+
+def open_store(path=DEFAULT_STORE_PATH, legacy_path=LEGACY_JSON_PATH):
+    if path.endswith((".db", ".sqlite", ".sqlite3")):
+        store = SqliteSessionStore(path)
+    else:
+        store = JsonLinesSessionStore(path)
+
+    if legacy_path and os.path.exists(legacy_path) and store.is_empty():
+        try:
+            migrate_json_array(legacy_path, store)
+        except Exception as e:
+            logger.error(f"Migrazione di {legacy_path} fallita: {e}")
+    return store
+
+
+# === LETTURA IN BLOCCO (notebook, generazione_dati.py) ===
+def load_sessions(path):
+    if path.endswith(".json"):
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    store = open_store(path, legacy_path=None)
+    try:
+        return store.read_all()
+    finally:
+        store.close()
@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import asyncio
+import logging
+
+import jwt
+from renault_api.renault_client import RenaultClient
+from renault_api.renault_vehicle import RenaultVehicle
+from renault_api.credential import Credential, JWTCredential
+from renault_api.credential_store import CredentialStore
+from renault_api.gigya import GIGYA_JWT, GIGYA_KEYS, GIGYA_LOGIN_TOKEN
+from renault_api.exceptions import NotAuthenticatedException
+from renault_api.kamereon import schemas
+from renault_api.kamereon.exceptions import UnauthorizedException
+
+from metriche import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = "renault_auth.json"
+DISCOVERY_TTL = 7 * 86400   # account e veicoli cambiano raramente; un VIN sconosciuto forza comunque la discovery
+REFRESH_MARGIN = 300        # il JWT (validità ~15 min) viene rinnovato 5 minuti prima della scadenza
+RELOGIN_INTERVAL = 30       # un solo nuovo login anche se più veicoli falliscono insieme
+
+# Errori che indicano token scaduti o revocati: si risolvono con un nuovo login
+AUTH_ERRORS = (NotAuthenticatedException, UnauthorizedException)
+
+
+class AuthCache:
+    # File unico per tutti gli account: {email: {"credentials": {...}, "account_id", "vins",
+    # "vehicle_details": {vin: raw}, "discovered_at"}}. Contiene i token: permessi 0600
+    def __init__(self, path=DEFAULT_CACHE_PATH, discovery_ttl=DISCOVERY_TTL):
+        self.path = path
+        self.discovery_ttl = discovery_ttl
+        self.data = self._load()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Cache di autenticazione {self.path} illeggibile ({e}): login completo")
+            return {}
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp = self.path + ".tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(self.data, f)
+        os.replace(tmp, self.path)
+
+    def entry(self, email):
+        return self.data.setdefault(email, {})
+
+    def save_credentials(self, email, credentials):
+        self.entry(email)["credentials"] = credentials
+        self._save()
+
+    def discovery(self, email):
+        # (account_id, vins, dettagli dei veicoli) se non scaduti, altrimenti None
+        entry = self.data.get(email, {})
+        if not entry.get("account_id") or time.time() - entry.get("discovered_at", 0) > self.discovery_ttl:
+            return None
+        return entry["account_id"], entry["vins"], entry.get("vehicle_details", {})
+
+    def save_discovery(self, email, account_id, vins, vehicle_details):
+        self.entry(email).update(account_id=account_id, vins=vins, vehicle_details=vehicle_details,
+                                 discovered_at=time.time())
+        self._save()
+
+
+class _CachedCredentialStore(CredentialStore):
+    # Credential store di renault_api salvato nella cache comune, per un account
+    def __init__(self, cache, email):
+        super().__init__()
+        self.cache = cache
+        self.email = email
+        for key, value in cache.entry(email).get("credentials", {}).items():
+            if key == GIGYA_JWT:
+                try:
+                    self._store[key] = JWTCredential(value)
+                except jwt.PyJWTError:
+                    continue  # JWT illeggibile: ne verrà chiesto uno nuovo
+            else:
+                self._store[key] = Credential(value)
+
+    def _write(self):
+        self.cache.save_credentials(self.email, {k: c.value for k, c in self._store.items()})
+
+
+class RenaultAuth:
+    # Sessione Renault di un account con token e discovery in cache: all'avvio a caldo
+    # non serve nessuna chiamata prima della prima lettura della batteria. I token vengono
+    # validati alla prima chiamata (recover() se rifiutati) e il JWT è rinnovato in background
+    def __init__(self, websession, email, password, cache=None, locale="it_IT"):
+        self.email = email
+        self.password = password
+        self.cache = cache if cache is not None else get_auth_cache()
+        self.store = _CachedCredentialStore(self.cache, email)
+        self.client = RenaultClient(websession=websession, locale=locale, credential_store=self.store)
+        self._lock = asyncio.Lock()
+        self._last_login = None
+        self._task = None
+        self.logins = 0
+        self.refreshes = 0
+
+    async def login(self):
+        with metrics.timer("renault_call_seconds", "Durata delle chiamate all'API Renault", call="login"):
+            await self.client.session.login(self.email, self.password)
+        self._last_login = time.monotonic()
+        self.logins += 1
+        metrics.counter("renault_logins_total", "Login completi a Renault (Gigya)").inc()
+
+    async def discover(self, force=False):
+        cached = None if force else self.cache.discovery(self.email)
+        if cached is not None:
+            return cached
+        if GIGYA_LOGIN_TOKEN not in self.store:
+            await self.login()
+        person = await self.client.get_person()
+        account_id = person.accounts[0].accountId
+        vehicles = await self.client.session.get_account_vehicles(account_id)
+        vins = [link.vin for link in vehicles.vehicleLinks]
+        details = {link.vin: link.vehicleDetails.raw_data for link in vehicles.vehicleLinks if link.vehicleDetails}
+        self.cache.save_discovery(self.email, account_id, vins, details)
+        logger.info(f"Discovery Renault per {self.email}: {len(vins)} veicoli")
+        return account_id, vins, details
+
+    async def get_vehicle(self, vin=None):
+        # Proxy del veicolo con i dettagli in cache: la prima lettura è una sola chiamata
+        account_id, vins, details = await self.discover()
+        if vin is not None and vin not in vins:
+            # Veicolo aggiunto all'account dopo l'ultima discovery
+            account_id, vins, details = await self.discover(force=True)
+            if vin not in vins:
+                raise ValueError(f"Veicolo {vin} non trovato nell'account")
+        vin = vin or vins[0]
+        raw = details.get(vin)
+        return account_id, RenaultVehicle(
+            account_id, vin, session=self.client.session,
+            vehicle_details=schemas.KamereonVehicleDetailsResponseSchema.load(raw) if raw else None)
+
+    async def recover(self):
+        # Token rifiutati (scaduti o revocati): nuovo login, uno solo anche con più veicoli in errore
+        async with self._lock:
+            if self._last_login is not None and time.monotonic() - self._last_login < RELOGIN_INTERVAL:
+                return
+            logger.warning(f"Token Renault non più validi per {self.email}: nuovo login")
+            self.store.clear_keys(GIGYA_KEYS)
+            await self.login()
+
+    def jwt_expires_in(self):
+        credential = self.store.get(GIGYA_JWT)
+        return credential.expiry - time.time() if isinstance(credential, JWTCredential) else None
+
+    async def _request_jwt(self):
+        # _get_jwt è interno a renault_api (provato con la 0.6.x, vedi requirements.txt) ma è
+        # l'unico modo di chiedere solo il JWT; se sparisce, get_person lo ottiene comunque
+        get_jwt = getattr(self.client.session, "_get_jwt", None)
+        if get_jwt is not None:
+            await get_jwt()
+        else:
+            await self.client.get_person()
+
+    async def _refresh_loop(self):
+        while True:
+            expires_in = self.jwt_expires_in()
+            if expires_in is not None and expires_in > REFRESH_MARGIN:
+                await asyncio.sleep(expires_in - REFRESH_MARGIN)
+                continue
+            try:
+                self.store.clear_keys([GIGYA_JWT])
+                with metrics.timer("renault_call_seconds", "Durata delle chiamate all'API Renault", call="get_jwt"):
+                    await self._request_jwt()
+                self.refreshes += 1
+                metrics.counter("renault_token_refresh_total", "Rinnovi del JWT in background").inc()
+                await asyncio.sleep(RELOGIN_INTERVAL)  # mai rinnovi a raffica, anche con JWT brevi
+            except AUTH_ERRORS:
+                try:
+                    await self.recover()
+                except Exception as e:
+                    logger.error(f"Nuovo login Renault fallito: {e}")
+                    await asyncio.sleep(60)
+            except Exception as e:
+                logger.warning(f"Rinnovo del token Renault fallito ({e}), riprovo tra 60 s")
+                await asyncio.sleep(60)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._refresh_loop(), name=f"renault-auth-{self.email}")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+# Una cache per file, condivisa da tutti gli account del processo
+_caches = {}
+
+
+def get_auth_cache(path=None):
+    # RENAULT_AUTH_CACHE vuoto: token e discovery solo in memoria (login completo a ogni avvio)
+    path = os.getenv('RENAULT_AUTH_CACHE', DEFAULT_CACHE_PATH) if path is None else path
+    if path not in _caches:
+        _caches[path] = AuthCache(path)
+    return _caches[path]
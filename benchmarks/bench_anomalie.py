@@ -0,0 +1,173 @@
+# Rilevamento di anomalie durante la ricarica, su sessioni ripetute da uno storico sintetico
+# (generazione_dati.generate_bulk): SoC iniziale e velocità di ogni sessione vengono dallo
+# storico, che è anche la base da cui il caricatore impara la curva di ricarica.
+# In ogni sessione simulata (orologio virtuale) viene iniettato un guasto tra il 20% e il 60%
+# della durata prevista:
+#   - rifiuto:   l'auto smette di caricare (chargingStatus 0, SoC fermo)
+#   - bloccata:  l'auto dice di caricare e assorbe potenza, ma il SoC non sale
+#   - lenta:     velocità ridotta a un quarto
+#   - autonomia: l'autonomia stimata cala di 45 km in un colpo
+#   - nessuno:   sessione sana (falsi positivi)
+# Le stime di salute dello storico vengono tolte: il generatore usa un altro modello di energia
+# e il controllo di fine sessione segnalerebbe ogni sessione simulata.
+# Confronta il rilevatore con il ciclo di ricarica senza rilevatore (ANOMALY_DETECTION=0):
+# ritardo di rilevamento, ore di presa accesa dopo il guasto (fino alla partenza, 12 h dopo
+# il collegamento) e chiamate Renault dopo il guasto.
+# Esecuzione dalla radice del repository:
+#     python -m benchmarks.bench_anomalie [--trials 10] [--seed 0]
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import tempfile
+from datetime import datetime, timedelta
+
+from archivio_sessioni import JsonLinesSessionStore, load_sessions
+from generazione_dati import generate_bulk
+from simulazione import (
+    FakePlug, FakeTapoCloud, FakeTelegramBot, SimulatedCharger, SimulatedVehicle, run_simulated,
+)
+
+FAULTS = ["rifiuto", "bloccata", "lenta", "autonomia", "nessuno"]
+HORIZON = 12 * 3600
+TARGET = 80
+HISTORY_START = datetime(2025, 1, 1)
+HISTORY_DAYS = 120
+
+
+class FaultyVehicle(SimulatedVehicle):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fault = None
+        self.autonomy_offset = 0
+
+    def fail(self, fault):
+        self.advance()
+        self.fault = fault
+        if fault == "rifiuto":
+            self.stalled = True
+        elif fault == "lenta":
+            self.rate /= 4
+        elif fault == "autonomia":
+            self.autonomy_offset = -45
+
+    def advance(self):
+        if self.fault == "bloccata":
+            # Potenza assorbita ma SoC fermo
+            self._last = asyncio.get_running_loop().time()
+            return
+        super().advance()
+
+    async def get_battery_status(self):
+        status = await super().get_battery_status()
+        status.batteryAutonomy += self.autonomy_offset
+        return status
+
+
+class RecordingCharger(SimulatedCharger):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.detected = []  # (istante, tipo, azione)
+
+    async def handle_anomaly(self, anomaly):
+        self.detected.append((asyncio.get_running_loop().time(), anomaly.kind, anomaly.action))
+        await super().handle_anomaly(anomaly)
+
+
+async def run_trial(session, fault, fault_fraction, store_path, detect):
+    loop = asyncio.get_running_loop()
+    hours = max(session["charging_duration_hours"], 0.5)
+    rate = min(10.0, max(2.0, (session["end_battery_level"] - session["start_battery_level"]) / hours))
+    start_soc = session["start_battery_level"] + 0.5
+    km_per_pct = session["battery_autonomy"] / session["end_battery_level"]
+    vehicle = FaultyVehicle(soc=start_soc, rate=rate, km_per_pct=km_per_pct, rng=random.Random(0))
+    cloud = FakeTapoCloud()
+    plug = cloud.add_plug("10.0.0.1", FakePlug(vehicle))
+    charger = RecordingCharger(vehicle, cloud, FakeTelegramBot(), JsonLinesSessionStore(store_path),
+                               vin=session["vin"], charge_state=None)
+    charger.detect_anomalies = detect
+
+    fault_at = fault_fraction * (TARGET - start_soc) / rate * 3600
+    vehicle.plug_in()
+    monitor = asyncio.create_task(charger.monitor_plug_status())
+    await asyncio.sleep(fault_at)
+    calls_at_fault = vehicle.calls["get_battery_status"]
+    if fault != "nessuno":
+        vehicle.fail(fault)
+    # Fino allo spegnimento della presa o alla partenza
+    while loop.time() < HORIZON and not plug.off_events:
+        await asyncio.sleep(30)
+    off_at = plug.off_events[0][0] if plug.off_events else HORIZON
+    calls_after = vehicle.calls["get_battery_status"] - calls_at_fault
+    vehicle.unplug()
+    monitor.cancel()
+    await asyncio.gather(monitor, return_exceptions=True)
+    relevant = [t for t, kind, _ in charger.detected if t >= fault_at and kind in _kinds(fault)]
+    delay = relevant[0] - fault_at if relevant else None
+    return {
+        "delay": delay,
+        "false_positive": fault == "nessuno" and bool(charger.detected),
+        "plug_on_h": max(0.0, off_at - fault_at) / 3600,
+        "calls_after": calls_after,
+    }
+
+
+def _kinds(fault):
+    return {"rifiuto": {"rifiuto", "stallo"}, "bloccata": {"stallo", "rifiuto"}, "lenta": {"lenta", "stallo"},
+            "autonomia": {"autonomia"}, "nessuno": set()}[fault]
+
+
+def summarize(results):
+    delays = sorted(r["delay"] / 60 for r in results if r["delay"] is not None)
+    return {
+        "detected": len(delays) / len(results),
+        "delay_median": statistics.median(delays) if delays else None,
+        "delay_max": delays[-1] if delays else None,
+        "plug_on_h": statistics.mean(r["plug_on_h"] for r in results),
+        "calls_after": statistics.mean(r["calls_after"] for r in results),
+        "false_positives": sum(r["false_positive"] for r in results),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trials", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.ERROR)
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        history = os.path.join(tmp, "storico.jsonl")
+        generate_bulk(history, HISTORY_START, HISTORY_START + timedelta(days=HISTORY_DAYS), 5, seed=args.seed)
+        records = load_sessions(history)
+        # Generatore e simulatore stimano l'energia in modo diverso (salute ~88% contro ~130%):
+        # senza le stime dello storico il controllo di fine sessione non confronta mondi diversi
+        with open(history, "w", encoding="utf-8") as f:
+            for record in records:
+                record["battery_health_estimate"] = None
+                f.write(json.dumps(record) + "\n")
+        sessions = [s for s in records if s["start_battery_level"] < TARGET - 15 and s["end_battery_level"] > 0]
+        print(f"{'guasto':<11}{'rilevatore':<12}{'rilevati':>9}{'ritardo min':>13}{'max':>7}"
+              f"{'presa accesa h':>16}{'chiamate dopo':>15}{'falsi pos.':>12}")
+        for fault in FAULTS:
+            picked = [(rng.choice(sessions), rng.uniform(0.2, 0.6)) for _ in range(args.trials)]
+            for label, detect in (("no", False), ("sì", True)):
+                results = []
+                for i, (session, fraction) in enumerate(picked):
+                    store_path = os.path.join(tmp, f"prova-{fault}-{detect}-{i}.jsonl")
+                    shutil.copy(history, store_path)
+                    results.append(run_simulated(run_trial(session, fault, fraction, store_path, detect)))
+                s = summarize(results)
+                delay = f"{s['delay_median']:.0f}" if s["delay_median"] is not None else "-"
+                delay_max = f"{s['delay_max']:.0f}" if s["delay_max"] is not None else "-"
+                print(f"{fault:<11}{label:<12}{s['detected']:>9.0%}{delay:>13}{delay_max:>7}"
+                      f"{s['plug_on_h']:>16.2f}{s['calls_after']:>15.1f}{s['false_positives']:>12}")
+
+
+if __name__ == "__main__":
+    main()
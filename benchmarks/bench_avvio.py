@@ -0,0 +1,136 @@
+# Chiamate di rete e tempo dall'avvio alla prima lettura della batteria, con Gigya e
+# Kamereon simulati (latenza fissa per chiamata, orologio virtuale). Confronta:
+#   - avvio a freddo (nessuna cache): login, discovery, JWT, lettura
+#   - avvio a caldo con JWT ancora valido
+#   - avvio a caldo con JWT scaduto (rinnovo del JWT + lettura)
+#   - token revocati lato server: la prima chiamata fallisce, nuovo login e nuovo tentativo
+# Esecuzione dalla radice del repository:
+#     python -m benchmarks.bench_avvio [--latency 0.4]
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+import aiohttp
+import jwt
+import renault_api.renault_session as renault_session
+from renault_api.exceptions import NotAuthenticatedException
+from renault_api.gigya.exceptions import GigyaResponseException
+from renault_api.kamereon import schemas
+
+from autenticazione import AuthCache, RenaultAuth
+from simulazione import run_simulated
+
+EMAIL = "sim@example.com"
+VIN = "VF1SIM00000000001"
+JWT_KEY = "chiave-di-simulazione-non-segreta-32b"
+DETAILS = {"vin": VIN, "model": {"code": "XBG1VE", "label": "SPRING"}, "energy": {"code": "ELEC"}}
+
+
+class FakeRenaultBackend:
+    # Sostituisce le funzioni di rete di renault_api (moduli gigya e kamereon)
+    def __init__(self, latency, jwt_lifetime=900):
+        self.latency = latency
+        self.jwt_lifetime = jwt_lifetime
+        self.calls = Counter()
+        self.revoked = False
+
+    async def _call(self, name):
+        self.calls[name] += 1
+        await asyncio.sleep(self.latency)
+
+    def _jwt(self):
+        return jwt.encode({"exp": int(time.time()) + self.jwt_lifetime}, JWT_KEY, algorithm="HS256")
+
+    async def login(self, *args, **kwargs):
+        await self._call("gigya.login")
+        self.revoked = False
+        return SimpleNamespace(get_session_cookie=lambda: "login-token")
+
+    async def get_account_info(self, *args, **kwargs):
+        await self._call("gigya.get_account_info")
+        return SimpleNamespace(get_person_id=lambda: "person-1")
+
+    async def get_jwt(self, *args, **kwargs):
+        await self._call("gigya.get_jwt")
+        if self.revoked:
+            raise GigyaResponseException(403005, "Unauthorized user")
+        return SimpleNamespace(get_jwt=self._jwt)
+
+    async def get_person(self, *args, **kwargs):
+        await self._call("kamereon.get_person")
+        return SimpleNamespace(accounts=[SimpleNamespace(accountId="account-1")])
+
+    async def get_account_vehicles(self, *args, **kwargs):
+        await self._call("kamereon.get_account_vehicles")
+        link = SimpleNamespace(vin=VIN, vehicleDetails=SimpleNamespace(raw_data=DETAILS))
+        return SimpleNamespace(vehicleLinks=[link])
+
+    async def get_vehicle_details(self, *args, **kwargs):
+        await self._call("kamereon.get_vehicle_details")
+        return schemas.KamereonVehicleDetailsResponseSchema.load(DETAILS)
+
+    async def request(self, *args, gigya_jwt=None, **kwargs):
+        await self._call("kamereon.battery-status")
+        if self.revoked:
+            raise NotAuthenticatedException("token revocato")
+        return SimpleNamespace(raw_data={"data": {"type": "Car", "id": VIN, "attributes": {
+            "batteryLevel": 60, "plugStatus": 1, "chargingStatus": 1.0}}})
+
+    def install(self):
+        renault_session.gigya.login = self.login
+        renault_session.gigya.get_account_info = self.get_account_info
+        renault_session.gigya.get_jwt = self.get_jwt
+        renault_session.kamereon.get_person = self.get_person
+        renault_session.kamereon.get_account_vehicles = self.get_account_vehicles
+        renault_session.kamereon.get_vehicle_details = self.get_vehicle_details
+        renault_session.kamereon.request = self.request
+
+
+async def first_reading(backend, cache_path):
+    # Come EVCharger.setup() seguito dalla prima lettura di monitor_plug_status
+    loop = asyncio.get_running_loop()
+    backend.calls.clear()
+    started = loop.time()
+    async with aiohttp.ClientSession() as websession:
+        auth = RenaultAuth(websession, EMAIL, "sim", cache=AuthCache(cache_path))
+        _, vehicle = await auth.get_vehicle(VIN)
+        for attempt in range(2):
+            try:
+                status = await vehicle.get_battery_status()
+                break
+            except NotAuthenticatedException:
+                await auth.recover()
+    return loop.time() - started, sum(backend.calls.values()), status.batteryLevel
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency", type=float, default=0.4)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.ERROR)
+    backend = FakeRenaultBackend(args.latency)
+    backend.install()
+
+    print(f"{'avvio':<28}{'chiamate':>10}{'secondi':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "renault_auth.json")
+        cases = [("a freddo", None), ("a caldo, JWT valido", None), ("a caldo, JWT scaduto", "scaduto"),
+                 ("a caldo, token revocati", "revocato")]
+        for label, change in cases:
+            if change == "scaduto":
+                cache = AuthCache(path)
+                cache.entry(EMAIL)["credentials"].pop("gigya_jwt")
+                cache._save()
+            elif change == "revocato":
+                backend.revoked = True
+            elapsed, calls, _ = run_simulated(first_reading(backend, path))
+            print(f"{label:<28}{calls:>10}{elapsed:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+# Domande Telegram contemporanee da più veicoli, su orologio virtuale con un'API Bot
+# simulata (getUpdates in long polling, sendMessage con message_id). Gli utenti rispondono
+# dopo qualche decina di secondi, in parte con "Rispondi" sul messaggio, in parte con testo
+# semplice (col nome del veicolo se le domande aperte sono più di una).
+# Confronta il dispatcher unico (comandi.TelegramDispatcher) con il vecchio schema
+# (ogni domanda interroga getUpdates per conto suo e prende il primo messaggio che trova).
+# Riporta risposte arrivate alla domanda giusta, sbagliata o perse, chiamate getUpdates
+# e tempo di CPU per messaggio instradato.
+# Esecuzione dalla radice del repository:
+#     python -m benchmarks.bench_comandi [--rounds 20] [--seed 0]
+import argparse
+import asyncio
+import logging
+import random
+import time
+from collections import Counter
+
+from comandi import TelegramDispatcher
+from simulazione import run_simulated
+
+FLEET_SIZES = [1, 5, 20]
+CHATS = ["1001", "1002"]
+ANSWERS = ["sì", "no", "85", "90"]
+
+
+class _Response:
+    def __init__(self, data):
+        self.data = data
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def json(self):
+        return self.data
+
+
+class FakeBotApi:
+    # Notifier e sessione HTTP insieme: il dispatcher usa url(), get_session(), send() e notify()
+    def __init__(self):
+        self.chat_ids = list(CHATS)
+        self.updates = []
+        self.next_update = 1
+        self.next_message = 1
+        self.arrived = asyncio.Event()
+        self.calls = Counter()
+        self.sent = []      # (chat_id, message_id, text)
+        self.hints = []     # (chat_id, text) messaggi del bot non legati alle domande
+
+    def url(self, method):
+        return method
+
+    def get_session(self):
+        return self
+
+    def get(self, method, params=None, timeout=None):
+        return _Response(None) if method != "getUpdates" else _GetUpdates(self, params or {})
+
+    async def get_updates(self, params):
+        self.calls["getUpdates"] += 1
+        offset = int(params.get("offset", 0))
+        if offset == -1:
+            return {"ok": True, "result": self.updates[-1:]}
+        pending = [u for u in self.updates if u["update_id"] >= offset]
+        if not pending and params.get("timeout"):
+            self.arrived.clear()
+            try:
+                await asyncio.wait_for(self.arrived.wait(), float(params["timeout"]))
+            except asyncio.TimeoutError:
+                pass
+            pending = [u for u in self.updates if u["update_id"] >= offset]
+        return {"ok": True, "result": pending}
+
+    async def send(self, text, chat_ids=None, reply_markup=None):
+        self.calls["sendMessage"] += len(chat_ids or self.chat_ids)
+        sent = []
+        for chat_id in chat_ids or self.chat_ids:
+            sent.append((chat_id, self.next_message))
+            self.sent.append((chat_id, self.next_message, text))
+            self.next_message += 1
+        return sent
+
+    def notify(self, text, chat_ids=None, coalesce_key=None, critical=False):
+        for chat_id in chat_ids or self.chat_ids:
+            self.hints.append((chat_id, text))
+
+    def user_message(self, chat_id, text, reply_to=None):
+        message = {"chat": {"id": int(chat_id)}, "text": text}
+        if reply_to is not None:
+            message["reply_to_message"] = {"message_id": reply_to}
+        self.updates.append({"update_id": self.next_update, "message": message})
+        self.next_update += 1
+        self.arrived.set()
+
+
+class _GetUpdates(_Response):
+    def __init__(self, api, params):
+        self.api = api
+        self.params = params
+
+    async def __aenter__(self):
+        return _Response(await self.api.get_updates(self.params))
+
+
+class FakeCharger:
+    def __init__(self, i):
+        self.vin = f"VF1SIM{i:011d}"
+        self.name = f"auto{i}"
+
+    def label(self):
+        return self.name
+
+
+async def legacy_ask(api, charger, text, timeout=300):
+    # Vecchio EVCharger.wait_for_user_response: ultimo update_id, poi polling ogni 2 s
+    await api.send(text)
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    last = await api.get_updates({})
+    last_update_id = last["result"][-1]["update_id"] if last["result"] else 0
+    while loop.time() - started < timeout:
+        data = await api.get_updates({"offset": last_update_id + 1, "timeout": 10})
+        for update in data["result"]:
+            if "text" in update["message"]:
+                return update["message"]["text"].strip().lower()
+        await asyncio.sleep(2)
+    return None
+
+
+async def user(api, rng, chat_id, message_id, label, answer, crowded):
+    # Risposta dopo 10-120 s: "Rispondi" sul messaggio, oppure testo semplice (col nome
+    # del veicolo se le domande aperte sono più di una)
+    await asyncio.sleep(rng.uniform(10, 120))
+    if rng.random() < 0.6:
+        api.user_message(chat_id, answer, reply_to=message_id)
+    elif crowded:
+        api.user_message(chat_id, f"{answer} {label}")
+    else:
+        api.user_message(chat_id, answer)
+
+
+async def run_round(api, rng, chargers, ask):
+    # Tutti i veicoli chiedono nello stesso quarto d'ora (es. rientro serale di una flotta)
+    expected = {c.vin: rng.choice(ANSWERS) for c in chargers}
+    results = {}
+    first_sent = len(api.sent)
+
+    async def one(charger):
+        await asyncio.sleep(rng.uniform(0, 900))
+        results[charger.vin] = await ask(charger, f"Continuare la ricarica di {charger.label()}?")
+
+    tasks = [asyncio.create_task(one(c)) for c in chargers]
+    answered = set()
+    users = []
+    while not all(t.done() for t in tasks):
+        await asyncio.sleep(1)
+        for chat_id, message_id, text in api.sent[first_sent:]:
+            charger = next(c for c in chargers if text.endswith(f"{c.label()}?"))
+            if charger.vin in answered:
+                continue
+            answered.add(charger.vin)
+            users.append(asyncio.create_task(user(api, rng, chat_id, message_id, charger.label(),
+                                                  expected[charger.vin], len(chargers) > 1)))
+        first_sent = len(api.sent)
+    await asyncio.gather(*users)
+    outcome = Counter()
+    for charger in chargers:
+        got = results[charger.vin]
+        outcome["giusta" if got == expected[charger.vin] else "persa" if got is None else "sbagliata"] += 1
+    return outcome
+
+
+async def run_case(n_vehicles, rounds, seed, dispatched):
+    rng = random.Random(seed)
+    api = FakeBotApi()
+    chargers = [FakeCharger(i) for i in range(n_vehicles)]
+    dispatcher = TelegramDispatcher(api)
+    routing = [0.0, 0]
+    if dispatched:
+        handle = dispatcher.handle_update
+
+        def timed(update):
+            started = time.perf_counter()
+            handle(update)
+            routing[0] += time.perf_counter() - started
+            routing[1] += 1
+        dispatcher.handle_update = timed
+        for charger in chargers:
+            dispatcher.register(charger)
+        ask = dispatcher.ask
+    else:
+        ask = lambda charger, text: legacy_ask(api, charger, text)
+    outcome = Counter()
+    for _ in range(rounds):
+        outcome += await run_round(api, rng, chargers, ask)
+        await asyncio.sleep(3600)
+    await dispatcher.close()
+    hours = asyncio.get_running_loop().time() / 3600
+    per_update = f"{routing[0] / routing[1] * 1e6:.1f}" if routing[1] else "-"
+    return outcome, api.calls["getUpdates"] / hours, per_update
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.ERROR)
+
+    print(f"{'schema':<14}{'veicoli':>8}{'giuste':>8}{'sbagliate':>11}{'perse':>7}"
+          f"{'getUpdates/h':>14}{'µs/messaggio':>14}")
+    for n in FLEET_SIZES:
+        for label, dispatched in (("per domanda", False), ("dispatcher", True)):
+            outcome, polls, per_update = run_simulated(run_case(n, args.rounds, args.seed, dispatched))
+            total = sum(outcome.values())
+            print(f"{label:<14}{n:>8}{outcome['giusta'] / total:>8.1%}{outcome['sbagliata'] / total:>11.1%}"
+                  f"{outcome['persa'] / total:>7.1%}{polls:>14.1f}{per_update:>14}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+# Replay delle sessioni registrate: confronto tra la vecchia stima dei tempi di sleep
+# di charge_loop (chargingRemainingTime scalato linearmente, esponente 1.5 nella fase
+# finale) e la curva di ricarica appresa con correzione online.
+# Riporta il superamento del target (punti di SoC) e le letture di stato per sessione.
+# Esecuzione dalla radice del repository:
+#     python -m benchmarks.bench_curva [percorso archivio]
+import sys
+import math
+import random
+
+from archivio_sessioni import load_sessions
+from curva_ricarica import ChargeCurveModel, session_hours
+
+DEFAULT_TARGET = 80
+
+
+class TrueCharge:
+    # Andamento "vero" della sessione: velocità costante fino all'80%, poi in calo,
+    # calibrata per riprodurre la durata registrata
+    def __init__(self, soc_from, soc_to, hours):
+        self.soc = soc_from + 0.5
+        self.rate = 1.0
+        self.rate = self._hours(soc_from, soc_to) / hours
+
+    def _rate_at(self, soc):
+        return self.rate * (1 - max(0.0, soc - 80) / 40)
+
+    def _hours(self, soc_from, soc_to):
+        steps = 100
+        h = (soc_to - soc_from) / steps
+        return sum(h / self._rate_at(soc_from + (i + 0.5) * h) for i in range(steps))
+
+    def advance(self, seconds):
+        remaining = seconds / 3600
+        while remaining > 0:
+            dt = min(remaining, 0.01)
+            self.soc = min(100.0, self.soc + self._rate_at(self.soc) * dt)
+            remaining -= dt
+
+    def reading(self):
+        return int(self.soc)
+
+    def remaining_minutes(self, bias):
+        # chargingRemainingTime dell'auto: stima lineare fino al 100%, con errore sistematico
+        return (100 - self.soc) / self.rate * 60 * bias
+
+
+def replay_legacy(truth, target, bias):
+    battery = truth.reading()
+    first = battery
+    charging_time_real = truth.remaining_minutes(bias) * (target - battery) / (100 - battery) * 60
+    checkpoints = list(range(((first // 10) + 1) * 10, target, 10))
+    initial_remaining = target - battery
+    polls = 0
+    while battery < target:
+        if checkpoints and battery >= checkpoints[0]:
+            checkpoints.pop(0)
+        elif not checkpoints:
+            ratio = (target - battery) / initial_remaining
+            truth.advance(max(300, min(charging_time_real * ratio ** 1.5, 1800)))
+        else:
+            truth.advance(charging_time_real * (checkpoints[0] - battery) / (target - battery))
+        polls += 1
+        battery = truth.reading()
+        if battery >= 100:
+            break
+        charging_time_real = truth.remaining_minutes(bias) * (target - battery) / (100 - battery) * 60
+    return truth.soc - target, polls
+
+
+def replay_curve(truth, target, model):
+    battery = truth.reading()
+    checkpoints = list(range(((battery // 10) + 1) * 10, target, 10))
+    curve = model.session()
+    polls = 0
+    while battery < target:
+        if checkpoints and battery >= checkpoints[0]:
+            checkpoints.pop(0)
+            elapsed = 0
+        elif not checkpoints:
+            elapsed = curve.next_sleep(battery, target, final=True)
+        else:
+            elapsed = curve.next_sleep(battery, checkpoints[0])
+        truth.advance(elapsed)
+        polls += 1
+        new_battery = truth.reading()
+        curve.observe(elapsed, battery, new_battery)
+        battery = new_battery
+    return truth.soc - target, polls
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else "Progetto SmartEVCharger/charging_data.json"
+    history = [r for r in load_sessions(path) if session_hours(r)]
+    rng = random.Random(7)
+    results = {"legacy": [], "curva appresa": []}
+    for i, record in enumerate(history):
+        soc_from, soc_to = record["start_battery_level"], record["end_battery_level"]
+        target = min(DEFAULT_TARGET, soc_to)
+        if soc_to - soc_from < 3 or soc_from >= target:
+            continue
+        hours = session_hours(record)
+        # Modello addestrato sulle altre sessioni (leave-one-out)
+        model = ChargeCurveModel.from_sessions(history[:i] + history[i + 1:])
+        bias = math.exp(rng.gauss(0, 0.3))
+        results["legacy"].append(replay_legacy(TrueCharge(soc_from, soc_to, hours), target, bias))
+        results["curva appresa"].append(replay_curve(TrueCharge(soc_from, soc_to, hours), target, model))
+
+    n = len(results["legacy"])
+    print(f"{n} sessioni riprodotte da {path}")
+    print(f"{'politica':>14} {'superamento medio':>18} {'max':>6} {'letture/sessione':>17}")
+    for name, rows in results.items():
+        overshoot = [o for o, _ in rows]
+        polls = [p for _, p in rows]
+        print(f"{name:>14} {sum(overshoot) / n:>14.2f} pt {max(overshoot):>6.2f} {sum(polls) / n:>17.1f}")
+
+
+if __name__ == "__main__":
+    main()
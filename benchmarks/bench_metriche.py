@@ -0,0 +1,70 @@
+# Costo delle metriche sul percorso caldo: incremento di un contatore, osservazione di
+# un istogramma e timer attorno a una coroutine, con le stesse etichette usate dal demone,
+# più il tempo per produrre /metrics con molte serie (flotta grande).
+# Esecuzione dalla radice del repository:
+#     python -m benchmarks.bench_metriche [--ops 200000] [--vehicles 1000]
+import argparse
+import asyncio
+import time
+
+from metriche import LAG_BUCKETS, MetricsRegistry
+
+
+def per_op_ns(fn, ops):
+    started = time.perf_counter()
+    fn(ops)
+    return (time.perf_counter() - started) / ops * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ops", type=int, default=200_000)
+    parser.add_argument("--vehicles", type=int, default=1000)
+    args = parser.parse_args()
+    registry = MetricsRegistry()
+    vin = "VF1AAAAA555777999"
+
+    def baseline(n):
+        for _ in range(n):
+            pass
+
+    def counter(n):
+        for _ in range(n):
+            registry.counter("plug_status_checks_total", "Controlli dello stato del cavo", vin=vin).inc()
+
+    def histogram(n):
+        for i in range(n):
+            registry.histogram("sleep_oversleep_seconds", "", LAG_BUCKETS, vin=vin).observe(i % 7 * 0.001)
+
+    async def noop():
+        return 1
+
+    async def timed(n):
+        for _ in range(n):
+            with registry.timer("renault_call_seconds", "", call="get_battery_status"):
+                await noop()
+
+    async def untimed(n):
+        for _ in range(n):
+            await noop()
+
+    base = per_op_ns(baseline, args.ops)
+    print(f"{'operazione':<28}{'ns/op':>10}")
+    print(f"{'contatore':<28}{per_op_ns(counter, args.ops) - base:>10.0f}")
+    print(f"{'istogramma':<28}{per_op_ns(histogram, args.ops) - base:>10.0f}")
+    plain = per_op_ns(lambda n: asyncio.run(untimed(n)), args.ops)
+    print(f"{'timer attorno a un await':<28}{per_op_ns(lambda n: asyncio.run(timed(n)), args.ops) - plain:>10.0f}")
+
+    for i in range(args.vehicles):
+        v = f"VF1SYN{i:011d}"
+        registry.counter("plug_status_checks_total", vin=v).inc()
+        registry.histogram("sleep_oversleep_seconds", "", LAG_BUCKETS, vin=v).observe(0.002)
+    series = len(registry._metrics)
+    started = time.perf_counter()
+    text = registry.render()
+    elapsed = time.perf_counter() - started
+    print(f"\n/metrics con {series} serie: {elapsed * 1000:.1f} ms, {len(text) / 1024:.0f} KiB")
+
+
+if __name__ == "__main__":
+    main()
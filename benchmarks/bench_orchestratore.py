@@ -0,0 +1,72 @@
+# Benchmark di scalabilità dell'orchestratore: costo (memoria e CPU) per veicolo
+# aggiunto, da 1 a 500 veicoli simulati che eseguono monitor_plug_status in parallelo.
+# Archivio sessioni in una directory temporanea, copia colonnare e stato della ricarica
+# disattivati: il benchmark non scrive nulla nella directory corrente.
+# CPU e memoria vengono misurate in due passate separate (tracemalloc rallenta ogni
+# allocazione e gonfierebbe la CPU per poll). Le poll attese sono quelle di un veicolo ogni
+# POLL_INTERVAL per RUN_SECONDS: quando il loop non regge, le poll misurate restano sotto.
+# Esecuzione dalla radice del repository:
+#     python -m benchmarks.bench_orchestratore
+import asyncio
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
+
+from orchestratore import FleetOrchestrator
+from rilevamento import AdaptivePlugScheduler
+from simulazione import SimulatedVehicle
+
+FLEET_SIZES = [1, 10, 100, 500]
+RUN_SECONDS = 2.0
+POLL_INTERVAL = 0.05
+
+
+async def run_fleet(n_vehicles, store_path):
+    orchestrator = FleetOrchestrator({"accounts": [], "session_store": store_path,
+                                      "columnar_store": "", "state_dir": ""})
+    for i in range(n_vehicles):
+        charger = orchestrator.charger_factory(
+            vin=f"VF1SIM{i:011d}", smart_plug_ip=f"10.0.{i // 256}.{i % 256}",
+            renault_email="sim@example.com", renault_password="sim",
+            tapo_email="sim@example.com", tapo_password="sim",
+            session_store=orchestrator.session_store, columnar_store=orchestrator.columnar_store,
+            mongo_sync=None, charge_state=orchestrator.charge_state,
+        )
+        charger.vehicle = SimulatedVehicle(soc=60, latency=0)
+        charger.plug_scheduler = AdaptivePlugScheduler(base_interval=POLL_INTERVAL)
+        charger.status_cache.ttl = 0
+        orchestrator.chargers.append(charger)
+
+    runner = asyncio.create_task(orchestrator.run())
+    await asyncio.sleep(RUN_SECONDS)
+    runner.cancel()
+    await asyncio.gather(runner, return_exceptions=True)
+    await orchestrator.close()
+    return sum(c.vehicle.calls["get_battery_status"] for c in orchestrator.chargers)
+
+
+def main():
+    logging.getLogger().setLevel(logging.WARNING)
+    print(f"{'veicoli':>8} {'mem tot KB':>11} {'KB/veicolo':>11} {'CPU s':>7} {'poll attese':>12} "
+          f"{'poll':>8} {'µs CPU/poll':>12}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in FLEET_SIZES:
+            cpu_start = time.process_time()
+            polls = asyncio.run(run_fleet(n, os.path.join(tmp, f"sessions_{n}_cpu.jsonl")))
+            cpu = time.process_time() - cpu_start
+
+            tracemalloc.start()
+            base = tracemalloc.get_traced_memory()[0]
+            asyncio.run(run_fleet(n, os.path.join(tmp, f"sessions_{n}_mem.jsonl")))
+            peak = tracemalloc.get_traced_memory()[1] - base
+            tracemalloc.stop()
+
+            expected = int(n * RUN_SECONDS / POLL_INTERVAL)
+            print(f"{n:>8} {peak / 1024:>11.1f} {peak / 1024 / n:>11.2f} {cpu:>7.2f} {expected:>12} "
+                  f"{polls:>8} {cpu / max(polls, 1) * 1e6:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+# Tempo di calcolo dei piani di ricarica su una settimana di prezzi quartorari
+# (672 slot) per flotte di centinaia di veicoli, con risparmio rispetto alla
+# ricarica immediata. Ogni veicolo ha SoC, target, collegamento e partenza casuali.
+# Esecuzione dalla radice del repository:
+#     python -m benchmarks.bench_pianificazione [--vehicles 100,500,1000] [--seed 0]
+import argparse
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from curva_ricarica import ChargeCurveModel
+from pianificazione import TimeSeriesPrices, plan_charging
+
+START = datetime(2025, 6, 2)
+SLOTS = 7 * 96
+
+
+def weekly_prices(rng):
+    # Profilo tipo PUN: valle notturna, picco serale, rumore per slot
+    hours = np.arange(SLOTS) / 4 % 24
+    profile = 0.22 + 0.06 * np.exp(-((hours - 19) / 2.5) ** 2) + 0.03 * np.exp(-((hours - 9) / 2) ** 2)
+    prices = profile + rng.normal(0, 0.01, SLOTS)
+    times = np.datetime64(START, "us").astype(np.int64) + np.arange(SLOTS, dtype=np.int64) * 15 * 60 * 1_000_000
+    return TimeSeriesPrices(times, prices)
+
+
+def random_vehicles(rng, n):
+    vehicles = []
+    for _ in range(n):
+        plug_in = START + timedelta(days=int(rng.integers(0, 6)), hours=float(rng.uniform(16, 22)))
+        departure = plug_in + timedelta(hours=float(rng.uniform(8, 60)))
+        soc = int(rng.integers(10, 60))
+        vehicles.append((soc, int(rng.integers(max(soc + 10, 70), 101)), plug_in, departure))
+    return vehicles
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vehicles", default="100,500,1000")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+    schedule = weekly_prices(rng)
+    curve = ChargeCurveModel()
+
+    print(f"{'veicoli':>8}{'totale ms':>11}{'ms/piano':>10}{'risparmio':>11}{'non fattibili':>15}")
+    for n in (int(v) for v in args.vehicles.split(",")):
+        vehicles = random_vehicles(rng, n)
+        started = time.perf_counter()
+        plans = [plan_charging(schedule, curve, soc, target, plug_in, departure)
+                 for soc, target, plug_in, departure in vehicles]
+        elapsed = time.perf_counter() - started
+        cost = sum(p.cost for p in plans)
+        immediate = sum(p.immediate_cost for p in plans)
+        infeasible = sum(not p.feasible for p in plans)
+        print(f"{n:>8}{elapsed * 1000:>11.1f}{elapsed / n * 1000:>10.3f}"
+              f"{(1 - cost / immediate) * 100:>10.1f}%{infeasible:>15}")
+
+
+if __name__ == "__main__":
+    main()
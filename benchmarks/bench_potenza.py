@@ -0,0 +1,67 @@
+# Costo delle decisioni del limite di potenza del sito con centinaia di prese.
+# Flusso sintetico di eventi: richieste di ricarica, rilasci, aggiornamenti di urgenza e
+# di potenza misurata (P110), con un limite pari al 40% della potenza totale installata.
+# Riporta per decisione tempo medio, 99° e 99,9° percentile e massimo (tempo reale, che con
+# una sola CPU include le preemption del sistema operativo) e il massimo in tempo CPU del
+# thread (include le pause del garbage collector), poi il carico massimo impegnato, che
+# non deve superare il limite nemmeno quando la potenza misurata di una presa risale.
+# Esecuzione dalla radice del repository:
+#     python -m benchmarks.bench_potenza [--plugs 100,500,1000] [--events 200000] [--seed 0]
+import argparse
+import asyncio
+import random
+import time
+
+from potenza import DEFAULT_PLUG_KW, PowerBudget
+
+
+async def run(n_plugs, n_events, seed):
+    rng = random.Random(seed)
+    budget = PowerBudget(cap_kw=0.4 * n_plugs * DEFAULT_PLUG_KW, min_run_s=0)
+    keys = [f"VF1SYN{i:011d}" for i in range(n_plugs)]
+    latencies = []
+    cpu = []
+    max_load = 0.0
+    for _ in range(n_events):
+        key = rng.choice(keys)
+        started = time.perf_counter()
+        cpu_started = time.thread_time()
+        if key in budget.active:
+            if budget.active[key].revoked or rng.random() < 0.2:
+                budget.release(key)
+            else:
+                # Letture P110 tra 0 e 1,2 volte la potenza prevista
+                budget.update(key, urgency=rng.uniform(0, 1.5),
+                              measured_kw=DEFAULT_PLUG_KW * rng.uniform(0.0, 1.2))
+        elif key in budget.waiting:
+            budget.update(key, urgency=rng.uniform(0, 1.5))
+        else:
+            budget.request(key, rng.uniform(0, 1.5), DEFAULT_PLUG_KW)
+        latencies.append(time.perf_counter() - started)
+        cpu.append(time.thread_time() - cpu_started)
+        max_load = max(max_load, budget.load_kw - budget.revoked_kw)
+    latencies.sort()
+    return budget, latencies, max(cpu), max_load
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--plugs", default="100,500,1000")
+    parser.add_argument("--events", type=int, default=200_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'prese':>6}{'limite kW':>11}{'medio µs':>10}{'p99 µs':>9}{'p99.9 µs':>10}{'max µs':>9}"
+          f"{'max CPU µs':>12}{'carico max kW':>15}{'attive':>8}{'in coda':>9}{'rotazioni':>11}{'riduzioni':>11}")
+    for n in (int(p) for p in args.plugs.split(",")):
+        budget, latencies, max_cpu, max_load = asyncio.run(run(n, args.events, args.seed))
+        mean = sum(latencies) / len(latencies)
+        p99 = latencies[int(len(latencies) * 0.99)]
+        p999 = latencies[int(len(latencies) * 0.999)]
+        print(f"{n:>6}{budget.cap_kw:>11.1f}{mean * 1e6:>10.1f}{p99 * 1e6:>9.1f}{p999 * 1e6:>10.1f}"
+              f"{latencies[-1] * 1e6:>9.1f}{max_cpu * 1e6:>12.1f}{max_load:>15.1f}{len(budget.active):>8}"
+              f"{len(budget.waiting):>9}{budget.preemptions:>11}{budget.sheds:>11}")
+
+
+if __name__ == "__main__":
+    main()
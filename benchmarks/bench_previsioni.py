@@ -0,0 +1,72 @@
+# Pipeline notturna delle previsioni ARIMA su flotte sintetiche di varie dimensioni.
+# Per ogni dimensione misura tre notti consecutive:
+#   1. prima esecuzione, nessuna cache (tutte le serie stimate da zero)
+#   2. nessuna sessione nuova (tutte le previsioni riusate)
+#   3. nuove sessioni per il 10% dei veicoli (solo quelle serie, partendo dai parametri in cache)
+# Esecuzione dalla radice del repository (10.000 veicoli sono 30.000 modelli: su una
+# sola CPU servono più di un'ora):
+#     python -m benchmarks.bench_previsioni [--sizes 10,1000,10000] [--days 180] [--workers N]
+import os
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from colonnare import ColumnarSessionStore
+from generazione_dati import batch_to_columns, generate_bulk_columnar, generate_vehicle_batches
+from previsioni import run_forecasts
+
+START = datetime(2024, 1, 1)
+
+
+def add_new_sessions(store_path, n_vehicles, end, share=0.1, seed=1):
+    # Tre giorni di ricariche in più per una parte della flotta
+    rng = np.random.default_rng(seed)
+    store = ColumnarSessionStore(store_path)
+    chosen = rng.choice(n_vehicles, max(1, int(n_vehicles * share)), replace=False)
+    for v in chosen:
+        for batch in generate_vehicle_batches(rng, f"VF1SYN{v:011d}", end, end + timedelta(days=3),
+                                              20_000.0, 90.0):
+            store.append_columns(batch_to_columns(batch), vin=batch["vin"])
+    return len(chosen)
+
+
+def run_size(n_vehicles, days, workers, budget, tmp):
+    store_path = os.path.join(tmp, f"flotta-{n_vehicles}.col")
+    cache_path = os.path.join(tmp, f"cache-{n_vehicles}.json")
+    out_path = os.path.join(tmp, f"previsioni-{n_vehicles}.npz")
+    end = START + timedelta(days=days)
+    sessions = generate_bulk_columnar(store_path, START, end, n_vehicles, seed=0)
+
+    nights = []
+    nights.append(("prima notte", run_forecasts(ColumnarSessionStore(store_path), cache_path, out_path,
+                                                budget_s=budget, workers=workers)))
+    nights.append(("senza novità", run_forecasts(ColumnarSessionStore(store_path), cache_path, out_path,
+                                                 budget_s=budget, workers=workers)))
+    changed = add_new_sessions(store_path, n_vehicles, end)
+    nights.append((f"{changed} veicoli nuovi", run_forecasts(ColumnarSessionStore(store_path), cache_path,
+                                                            out_path, budget_s=budget, workers=workers)))
+
+    print(f"\n{n_vehicles} veicoli, {sessions} sessioni, {len(ColumnarSessionStore(store_path))} dopo l'aggiunta, "
+          f"output {os.path.getsize(out_path) / 1024:.0f} KiB")
+    print(f"{'notte':<22}{'stimate':>9}{'riusate':>9}{'a caldo':>9}{'budget':>8}{'max s':>8}{'totale s':>10}")
+    for name, s in nights:
+        print(f"{name:<22}{s['fitted']:>9}{s['reused']:>9}{s['warm']:>9}{s['budget']:>8}"
+              f"{s['max_fit_s']:>8}{s['elapsed_s']:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10,1000,10000")
+    parser.add_argument("--days", type=int, default=180)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--budget", type=float, default=2.0)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in (int(s) for s in args.sizes.split(",")):
+            run_size(size, args.days, args.workers, args.budget, tmp)
+
+
+if __name__ == "__main__":
+    main()
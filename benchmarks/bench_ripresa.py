@@ -0,0 +1,104 @@
+# Riavvio del processo a metà ricarica, su orologio virtuale: il primo processo viene
+# interrotto (task cancellato, come un riavvio del dyno) e un secondo processo riparte
+# dopo qualche secondo sullo stesso archivio. Confronta la ripresa dallo stato salvato
+# su disco con la partenza a freddo (domanda Telegram, nuova sessione da zero).
+# Riporta la latenza dall'avvio del nuovo processo al controllo della ricarica,
+# i record scritti per ricarica e il SoC finale.
+# Esecuzione dalla radice del repository:
+#     python -m benchmarks.bench_ripresa [--trials 20] [--downtime 30] [--seed 0]
+import argparse
+import asyncio
+import logging
+import random
+import statistics
+import tempfile
+import time
+
+from archivio_sessioni import JsonLinesSessionStore
+from simulazione import (
+    FakePlug, FakeTapoCloud, FakeTelegramBot, SimulatedCharger, SimulatedVehicle, run_simulated,
+)
+from scrittura import writer
+from stato_ricarica import ChargeStateStore
+
+TARGET = 80
+
+
+class TimedCharger(SimulatedCharger):
+    # Istante in cui il processo riprende il controllo: primo ingresso in charge_loop
+    control_at = None
+
+    async def charge_loop(self, *args, **kwargs):
+        if self.control_at is None:
+            self.control_at = asyncio.get_running_loop().time()
+        return await super().charge_loop(*args, **kwargs)
+
+
+async def restart_trial(rng, store, state, downtime):
+    loop = asyncio.get_running_loop()
+    vehicle = SimulatedVehicle(soc=rng.uniform(50, 65), rate=rng.uniform(4, 6), rng=rng)
+    cloud = FakeTapoCloud()
+    cloud.add_plug("10.0.0.1", FakePlug(vehicle))
+    vin = f"VF1SIM{rng.randrange(10**11):011d}"
+    vehicle.plug_in()
+
+    first = TimedCharger(vehicle, cloud, FakeTelegramBot(), store, vin=vin, charge_state=state)
+    task = asyncio.create_task(first.monitor_plug_status())
+    await asyncio.sleep(rng.uniform(1, 2) * 3600)  # interruzione a metà ricarica
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    await asyncio.sleep(downtime)
+
+    second = TimedCharger(vehicle, cloud, FakeTelegramBot(), store, vin=vin, charge_state=state)
+    restarted = loop.time()
+    wall = time.perf_counter()
+    task = asyncio.create_task(second.monitor_plug_status())
+    while second.control_at is None:
+        await asyncio.sleep(1)
+    wall = time.perf_counter() - wall
+    latency = second.control_at - restarted
+    # Fine ricarica, poi scollego e chiudo il monitoraggio
+    while vehicle.plug.device_on:
+        await asyncio.sleep(600)
+    vehicle.unplug()
+    await asyncio.sleep(60)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    writer.flush()
+    records = [r for r in store.read_all() if r["vin"] == vin]
+    return latency, wall, len(records), vehicle.soc
+
+
+def run_case(trials, downtime, seed, resumable):
+    latencies, walls, records, socs = [], [], [], []
+    with tempfile.TemporaryDirectory() as tmp:
+        store = JsonLinesSessionStore(f"{tmp}/sessions.jsonl")
+        state = ChargeStateStore(f"{tmp}/stato") if resumable else None
+        rng = random.Random(seed)
+        for _ in range(trials):
+            latency, wall, n, soc = run_simulated(restart_trial(rng, store, state, downtime))
+            latencies.append(latency)
+            walls.append(wall)
+            records.append(n)
+            socs.append(soc)
+    return latencies, walls, records, socs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trials", type=int, default=20)
+    parser.add_argument("--downtime", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.ERROR)
+
+    print(f"{'avvio':<16}{'controllo s (medio)':>21}{'max s':>8}{'tempo reale ms':>16}"
+          f"{'record/ricarica':>17}{'SoC finale':>12}")
+    for label, resumable in (("a freddo", False), ("stato salvato", True)):
+        latencies, walls, records, socs = run_case(args.trials, args.downtime, args.seed, resumable)
+        print(f"{label:<16}{statistics.mean(latencies):>21.1f}{max(latencies):>8.1f}"
+              f"{statistics.mean(walls) * 1000:>16.2f}{statistics.mean(records):>17.1f}{statistics.mean(socs):>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+# Ritardo del loop asyncio quando molti veicoli chiudono la sessione insieme (es. fine della
+# fascia economica per tutta la flotta). Ogni chiusura passa da EVCharger.finish_session con
+# veicolo e presa simulati, su un loop reale: append all'archivio JSON Lines (con uno storico
+# grande), copia colonnare, stato della ricarica salvato e cancellato, righe di log con un
+# file vicino alla rotazione dei 2 MB.
+# Confronta le scritture nel loop (come prima: fsync, np.save e compattazioni nel loop, log
+# con RotatingFileHandler diretto) con il thread di scrittura e i log in coda (scrittura.py).
+# Un task misura ogni 5 ms quanto in ritardo si risveglia: riporta mediana, p99 e massimo,
+# il tempo fino ai dati su disco e le chiamate di scrittura fatte.
+# Esecuzione dalla radice del repository:
+#     python -m benchmarks.bench_scrittura [--vehicles 10,50] [--rounds 3] [--history 50]
+import argparse
+import asyncio
+import logging
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+from logging.handlers import RotatingFileHandler
+
+import ricarica
+import scrittura
+from archivio_sessioni import JsonLinesSessionStore, load_sessions
+from colonnare import export_sessions
+from generazione_dati import generate_bulk
+from scrittura import LOG_FORMAT, BackgroundWriter, setup_logging, stop_logging
+from simulazione import FakePlug, FakeTapoCloud, FakeTelegramBot, SimulatedCharger, SimulatedVehicle
+from stato_ricarica import ChargeStateStore
+
+TICK = 0.005
+LOG_BYTES = 2 * 1024 * 1024
+
+
+class InlineWriter:
+    # Comportamento precedente: ogni scrittura subito, nel loop
+    def __init__(self):
+        self.writes = 0
+
+    async def append(self, fn, *records):
+        self.writes += 1
+        fn(list(records))
+
+    def write(self, key, fn, *args):
+        self.writes += 1
+        fn(*args)
+
+    def flush(self, timeout=None):
+        return True
+
+    async def drain(self):
+        pass
+
+
+def configure_logging(path, queued):
+    stop_logging()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+    # File quasi pieno: la rotazione capita durante le chiusure
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("x" * (LOG_BYTES - 4096) + "\n")
+    if queued:
+        setup_logging(path, console_level=logging.CRITICAL)
+        return
+    handler = RotatingFileHandler(path, maxBytes=LOG_BYTES, backupCount=3, encoding="utf-8")
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+
+
+async def lag_monitor(samples, stop):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(TICK)
+        samples.append(max(0.0, loop.time() - started - TICK))
+
+
+async def complete(charger, delay):
+    await asyncio.sleep(delay)
+    charger.save_charge_state(phase="carica", target=80)
+    await charger.start_charging()
+    await charger.finish_session(40, charger.now().isoformat(), 4 * 3600, 80, None, 4 * 3600)
+    charger.clear_charge_state()
+
+
+async def run_case(n_vehicles, rounds, tmp, history, background, seed):
+    writer = BackgroundWriter() if background else InlineWriter()
+    ricarica.writer = writer
+    store = JsonLinesSessionStore(os.path.join(tmp, "sessioni.jsonl"))
+    with open(history, "rb") as src, open(store.path, "wb") as dst:
+        dst.write(src.read())
+    columnar = export_sessions(load_sessions(history), os.path.join(tmp, "colonnare"))
+    state = ChargeStateStore(os.path.join(tmp, "stato"))
+    configure_logging(os.path.join(tmp, "ev_charger.log"), queued=background)
+
+    rng = random.Random(seed)
+    cloud = FakeTapoCloud(handshake_latency=0.0)
+    chargers = []
+    for i in range(n_vehicles):
+        vehicle = SimulatedVehicle(soc=80.0, latency=0.0, rng=rng)
+        ip = f"10.0.{i // 256}.{i % 256}"
+        cloud.add_plug(ip, FakePlug(vehicle))
+        vehicle.plugged = True
+        charger = SimulatedCharger(vehicle, cloud, FakeTelegramBot(), store, vin=f"VF1SIM{i:011d}",
+                                   plug_ip=ip, columnar_store=columnar, charge_state=state)
+        charger.ensure_charge_curve()
+        charger.ensure_health_tracker()
+        chargers.append(charger)
+
+    samples, stop = [], asyncio.Event()
+    monitor = asyncio.create_task(lag_monitor(samples, stop))
+    started = time.perf_counter()
+    for _ in range(rounds):
+        # Tutti i veicoli chiudono entro mezzo secondo
+        await asyncio.gather(*(complete(c, rng.uniform(0, 0.5)) for c in chargers))
+    loop_done = time.perf_counter() - started
+    await asyncio.to_thread(writer.flush)
+    durable = time.perf_counter() - started
+    stop.set()
+    await monitor
+    configure_logging(os.path.join(tmp, "fine.log"), queued=False)
+    if background:
+        writer.close()
+    samples.sort()
+    return {
+        "median": statistics.median(samples) * 1000,
+        "p99": samples[int(len(samples) * 0.99) - 1] * 1000,
+        "max": samples[-1] * 1000,
+        "loop_s": loop_done,
+        "durable_s": durable,
+        "writes": writer.writes,
+        "records": sum(1 for _ in store.iter_records()) - sum(1 for _ in load_sessions(history)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vehicles", default="10,50")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--history", type=int, default=50, help="veicoli dello storico sintetico (un anno)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        history = os.path.join(tmp, "storico.jsonl")
+        start = datetime(2024, 1, 1)
+        n_history = generate_bulk(history, start, start + timedelta(days=365), args.history, seed=args.seed)
+        print(f"storico: {n_history} sessioni, {os.path.getsize(history) / 1e6:.0f} MB")
+        print(f"{'scritture':<14}{'veicoli':>8}{'ritardo ms':>12}{'p99':>8}{'max':>8}"
+              f"{'nel loop s':>12}{'su disco s':>12}{'scritture':>11}{'record':>8}")
+        for n in (int(v) for v in args.vehicles.split(",")):
+            for label, background in (("nel loop", False), ("in background", True)):
+                case_dir = tempfile.mkdtemp(dir=tmp)
+                r = asyncio.run(run_case(n, args.rounds, case_dir, history, background, args.seed))
+                print(f"{label:<14}{n:>8}{r['median']:>12.2f}{r['p99']:>8.2f}{r['max']:>8.1f}"
+                      f"{r['loop_s']:>12.2f}{r['durable_s']:>12.2f}{r['writes']:>11}{r['records']:>8}")
+    ricarica.writer = scrittura.writer
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# Replay offline di una settimana (o più) di ricariche con veicolo, presa e bot
+# Telegram simulati, su un event loop a orologio virtuale.
+# Riporta chiamate API per sessione, hit rate della cache dello stato batteria,
+# superamento del target, notifiche inviate
+# e tempo reale impiegato per ogni ricarica simulata.
+# Esecuzione dalla radice del repository:
+#     python -m benchmarks.bench_simulazione [--days 7] [--vehicles 1] [--seed 0] [--start 2025-06-02]
+import argparse
+import asyncio
+import logging
+import random
+import tempfile
+import time
+from datetime import datetime
+
+from archivio_sessioni import JsonLinesSessionStore
+from simulazione import (
+    FakePlug, FakeTapoCloud, FakeTelegramBot, SimulatedCharger, SimulatedVehicle,
+    daily_commute_scenario, drive_scenario, run_simulated,
+)
+
+TARGET = 80
+
+
+async def simulate_fleet(n_vehicles, days, seed, store, start=None):
+    cloud = FakeTapoCloud()
+    rigs = []
+    for i in range(n_vehicles):
+        rng = random.Random(seed * 1000 + i)
+        vehicle = SimulatedVehicle(soc=rng.uniform(30, 60), rate=rng.uniform(4, 6), rng=rng)
+        ip = f"10.0.{i // 256}.{i % 256}"
+        plug = cloud.add_plug(ip, FakePlug(vehicle))
+        bot = FakeTelegramBot()
+        charger = SimulatedCharger(vehicle, cloud, bot, store, vin=f"VF1SIM{i:011d}", plug_ip=ip)
+        events = daily_commute_scenario(days, seed=seed * 1000 + i, start=start)
+        rigs.append((vehicle, plug, bot, charger, events))
+
+    monitors = [asyncio.create_task(c.monitor_plug_status()) for _, _, _, c, _ in rigs]
+    await asyncio.gather(*(drive_scenario(v, events) for v, _, _, _, events in rigs))
+    for task in monitors:
+        task.cancel()
+    await asyncio.gather(*monitors, return_exceptions=True)
+    return cloud, rigs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--vehicles", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--start", type=datetime.fromisoformat, default=datetime(2025, 6, 2))
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = JsonLinesSessionStore(f"{tmp}/sessions.jsonl")
+        wall_start = time.perf_counter()
+        cloud, rigs = run_simulated(simulate_fleet(args.vehicles, args.days, args.seed, store, args.start),
+                                    start=args.start)
+        wall = time.perf_counter() - wall_start
+        sessions = [r for r in store.read_all() if r["end_battery_level"] > r["start_battery_level"]]
+
+    renault_calls = sum(sum(v.calls.values()) for v, _, _, _, _ in rigs)
+    tapo_calls = sum(sum(p.calls.values()) for _, p, _, _, _ in rigs) + cloud.handshakes
+    notifications = sum(len(b.messages) for _, _, b, _, _ in rigs)
+    hits = sum(c.status_cache.hits for _, _, _, c, _ in rigs)
+    lookups = hits + sum(c.status_cache.misses + c.status_cache.joined for _, _, _, c, _ in rigs)
+    overshoot = [soc - TARGET for _, p, _, _, _ in rigs for _, soc in p.off_events]
+    n = max(len(sessions), 1)
+
+    print(f"{args.vehicles} veicoli x {args.days} giorni simulati in {wall:.2f} s")
+    print(f"sessioni di ricarica:          {len(sessions)}")
+    print(f"chiamate Renault / sessione:   {renault_calls / n:.1f}")
+    print(f"cache stato batteria:          {hits / max(lookups, 1):.0%} hit ({hits}/{lookups} letture)")
+    print(f"chiamate Tapo / sessione:      {tapo_calls / n:.1f} (handshake totali: {cloud.handshakes})")
+    print(f"notifiche / sessione:          {notifications / n:.1f}")
+    if overshoot:
+        print(f"superamento target (punti SoC): medio {sum(overshoot) / len(overshoot):.2f}, max {max(overshoot):.2f}")
+    print(f"tempo reale / ricarica:        {wall / n * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
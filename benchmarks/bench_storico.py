@@ -0,0 +1,109 @@
+# Interrogazioni sullo storico di flotte sintetiche (generazione_dati.generate_bulk, un anno):
+# indice in memoria (storico.HistoryIndex) contro la scansione della lista di sessioni,
+# come fanno oggi notebook e script. Per ogni dimensione riporta il tempo di costruzione
+# dell'indice e la latenza mediana / p99 di:
+#   - sessioni della flotta in una settimana
+#   - ultime 10 sessioni di un veicolo
+#   - sessioni di un mese che hanno attraversato l'80%
+#   - aggregati giornalieri della flotta su un mese e settimanali di un veicolo su un anno
+# Esecuzione dalla radice del repository:
+#     python -m benchmarks.bench_storico [--vehicles 100,1000] [--queries 200]
+import os
+import argparse
+import random
+import statistics
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from archivio_sessioni import load_sessions
+from generazione_dati import generate_bulk
+from storico import HistoryIndex
+
+START = datetime(2024, 1, 1)
+DAYS = 365
+
+
+def scan_between(records, start, end, vin=None):
+    start, end = start.isoformat(), end.isoformat()
+    return [r for r in records if start <= r["start_time"] < end and (vin is None or r["vin"] == vin)]
+
+
+def scan_last(records, n, vin):
+    return sorted((r for r in records if r["vin"] == vin), key=lambda r: r["start_time"])[-n:]
+
+
+def scan_crossing(records, level, start, end):
+    return [r for r in scan_between(records, start, end) if r["start_battery_level"] < level <= r["end_battery_level"]]
+
+
+def scan_daily(records, start, end, vin=None):
+    totals = defaultdict(lambda: [0.0, 0])
+    for r in scan_between(records, start, end, vin):
+        row = totals[r["start_time"][:10]]
+        row[0] += r["EnergyConsumed"]
+        row[1] += 1
+    return sorted(totals.items())
+
+
+def timed(fn, args_list):
+    samples = []
+    for args in args_list:
+        started = time.perf_counter()
+        fn(*args)
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.99) - 1]
+
+
+def run_size(n_vehicles, queries, tmp):
+    path = os.path.join(tmp, f"flotta-{n_vehicles}.jsonl")
+    generate_bulk(path, START, START + timedelta(days=DAYS), n_vehicles, seed=0)
+    records = load_sessions(path)
+    started = time.perf_counter()
+    index = HistoryIndex(records)
+    build_s = time.perf_counter() - started
+
+    rng = random.Random(0)
+    vins = index.vins()
+    days = [START + timedelta(days=rng.randrange(DAYS - 31)) for _ in range(queries)]
+    picked = [rng.choice(vins) for _ in range(queries)]
+    cases = [
+        ("settimana (flotta)",
+         lambda d, v: index.between(d, d + timedelta(days=7)),
+         lambda d, v: scan_between(records, d, d + timedelta(days=7))),
+        ("ultime 10 (veicolo)",
+         lambda d, v: index.last(10, vin=v),
+         lambda d, v: scan_last(records, 10, v)),
+        ("soglia 80% (mese)",
+         lambda d, v: index.crossing(80, d, d + timedelta(days=30)),
+         lambda d, v: scan_crossing(records, 80, d, d + timedelta(days=30))),
+        ("giorni (flotta, mese)",
+         lambda d, v: index.daily(d, d + timedelta(days=30)),
+         lambda d, v: scan_daily(records, d, d + timedelta(days=30))),
+        ("settimane (veicolo)",
+         lambda d, v: index.weekly(vin=v),
+         lambda d, v: scan_daily(records, START, START + timedelta(days=DAYS), v)),
+    ]
+    print(f"\n{n_vehicles} veicoli, {len(records)} sessioni: indice costruito in {build_s:.2f} s")
+    print(f"{'interrogazione':<24}{'indice ms':>11}{'p99':>8}{'scansione ms':>14}{'p99':>8}")
+    scan_queries = list(zip(days, picked))[:max(5, queries // 10)]  # la scansione è lenta
+    for label, indexed, scan in cases:
+        median, p99 = timed(indexed, zip(days, picked))
+        scan_median, scan_p99 = timed(scan, scan_queries)
+        print(f"{label:<24}{median:>11.3f}{p99:>8.3f}{scan_median:>14.2f}{scan_p99:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vehicles", default="100,1000")
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in (int(v) for v in args.vehicles.split(",")):
+            run_size(n, args.queries, tmp)
+
+
+if __name__ == "__main__":
+    main()
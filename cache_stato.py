@@ -0,0 +1,56 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class BatteryStatusCache:
+    def __init__(self, fetch, ttl=30):
+        # fetch: coroutine senza argomenti che interroga l'API (None se fallisce)
+        self.fetch = fetch
+        self.ttl = ttl
+        self._value = None
+        self._fetched_at = None
+        self._inflight = None
+        self.hits = 0
+        self.misses = 0
+        self.joined = 0
+
+    def _clock(self):
+        # Tempo del loop (uguale al monotonic in produzione, virtuale in simulazione)
+        return asyncio.get_running_loop().time()
+
+    def age(self):
+        if self._fetched_at is None:
+            return None
+        return self._clock() - self._fetched_at
+
+    async def _refresh(self):
+        try:
+            value = await self.fetch()
+            if value is not None:
+                self._value = value
+                self._fetched_at = self._clock()
+            return value
+        finally:
+            self._inflight = None
+
+    async def get(self, force=False, max_age=None):
+        max_age = self.ttl if max_age is None else max_age
+        age = self.age()
+        if not force and age is not None and age <= max_age:
+            self.hits += 1
+            return self._value
+        if self._inflight is not None:
+            # Richiesta identica già in corso: mi accodo invece di rifare la chiamata
+            self.joined += 1
+            return await asyncio.shield(self._inflight)
+        self.misses += 1
+        self._inflight = asyncio.ensure_future(self._refresh())
+        return await asyncio.shield(self._inflight)
+
+    def invalidate(self):
+        self._fetched_at = None
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "joined": self.joined, "ttl": self.ttl}
@@ -0,0 +1,333 @@
+import os
+import json
+import math
+import logging
+import threading
+from datetime import datetime, timezone
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_COLUMNAR_PATH = "charging_data.col"
+
+# === SCHEMA FISSO ===
+# Tempi in microsecondi dall'epoca (orari locali come registrati), misure in float32,
+# VIN come codice int32 nel dizionario del manifest. total_mileage resta float64
+# perché in float32 perderebbe il decimale oltre ~1.6 milioni di km.
+TIME_COLUMNS = ["start_time", "end_time"]
+FLOAT32_COLUMNS = [
+    "start_battery_level", "end_battery_level", "start_battery_capacity", "end_battery_capacity",
+    "EnergyConsumed", "battery_autonomy", "charging_duration_hours", "energy_expected",
+    "energy_measured", "battery_health_estimate", "charging_status", "charging_time",
+]
+SCHEMA = {"vin": "int32", **{c: "int64" for c in TIME_COLUMNS},
+          **{c: "float32" for c in FLOAT32_COLUMNS}, "total_mileage": "float64"}
+COLUMNS = list(SCHEMA)
+
+# Tipo strutturato delle partizioni piccole: una riga per sessione, tutte le colonne in un solo file
+RECORD_DTYPE = np.dtype([(c, dtype) for c, dtype in SCHEMA.items()])
+
+# Partizioni piccole (es. le sessioni scritte da charge_loop) in un solo file .npy strutturato
+# invece di un file .npy per colonna. Compattazione a livelli: livello = ordine di grandezza delle
+# righe; MERGE_FANOUT partizioni dello stesso livello diventano una del livello successivo,
+# così ogni sessione viene riscritta al più una volta per livello
+SMALL_PARTITION_ROWS = 10_000
+MERGE_FANOUT = 10
+
+
+def _to_us(value):
+    dt = datetime.fromisoformat(value) if isinstance(value, str) else value
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return int(np.datetime64(dt, "us").astype(np.int64))
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def _tier(rows):
+    return int(math.log10(max(rows, 1)))
+
+
+def _save_synced(path, values):
+    # Scrittura con fsync: il manifest che nomina il file viene pubblicato solo dopo
+    with open(path, "wb") as f:
+        np.save(f, values)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _fsync_dir(path):
+    # Rende persistenti i nomi dei file appena creati (o rinominati) nella cartella
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _NpyDir:
+    # Partizione grande: un file .npy per colonna, letto in memory-map
+    def __init__(self, path):
+        self.path = path
+
+    def __getitem__(self, column):
+        return np.load(os.path.join(self.path, f"{column}.npy"), mmap_mode="r")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _NpyRecords:
+    # Partizione piccola: un .npy strutturato in memory-map, ogni colonna è una vista sul file
+    def __init__(self, path):
+        self.records = np.load(path, mmap_mode="r")
+
+    def __getitem__(self, column):
+        return self.records[column]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def normalize_health(values):
+    # battery_health_estimate a volte è in scala 0-1: la porto in percentuale
+    values = np.asarray(values, dtype=np.float32)
+    return np.where(values <= 1.5, values * 100, values).astype(np.float32)
+
+
+class ColumnarSessionStore:
+    # Scritture (anche dal thread di scrittura) serializzate da un lock; le letture nel loop
+    # non lo prendono: ogni scrittura pubblica un manifest nuovo con una nuova lista di
+    # partizioni, che le letture usano come istantanea. I file delle partizioni compattate
+    # vengono cancellati solo quando nessuna lettura è in corso
+    def __init__(self, path=DEFAULT_COLUMNAR_PATH):
+        self.path = path
+        self.manifest_path = os.path.join(path, "manifest.json")
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {"schema": SCHEMA, "vins": [], "partitions": [], "next_id": 1}
+        self._vin_codes = {vin: i for i, vin in enumerate(self.manifest["vins"])}
+        self._lock = threading.RLock()
+        self._readers_lock = threading.Lock()
+        self._readers = 0
+        self._obsolete = []
+
+    # === SCRITTURA ===
+    def _vin_code(self, vin):
+        # vins cresce solo in coda: i codici già letti restano validi
+        vin = vin or ""
+        with self._lock:
+            if vin not in self._vin_codes:
+                self.manifest["vins"].append(vin)
+                self._vin_codes[vin] = len(self.manifest["vins"]) - 1
+            return self._vin_codes[vin]
+
+    def _publish(self, partitions, next_id):
+        manifest = dict(self.manifest, partitions=partitions, next_id=next_id)
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.manifest_path)
+        _fsync_dir(self.path)
+        self.manifest = manifest
+
+    def records_to_columns(self, records):
+        columns = {
+            "vin": np.array([self._vin_code(r.get("vin")) for r in records], dtype=np.int32),
+            "start_time": np.array([_to_us(r["start_time"]) for r in records], dtype=np.int64),
+            "end_time": np.array([_to_us(r["end_time"]) for r in records], dtype=np.int64),
+            "total_mileage": np.array([_to_float(r.get("total_mileage")) for r in records], dtype=np.float64),
+        }
+        for name in FLOAT32_COLUMNS:
+            columns[name] = np.array([_to_float(r.get(name)) for r in records], dtype=np.float32)
+        columns["battery_health_estimate"] = normalize_health(columns["battery_health_estimate"])
+        return columns
+
+    def append_records(self, records):
+        if records:
+            with self._lock:
+                self.append_columns(self.records_to_columns(records))
+
+    def append_columns(self, columns, vin=None):
+        # columns: array NumPy per colonna dello schema; vin: VIN di tutte le righe (stringa)
+        # oppure uno per riga, al posto della colonna "vin" con i codici del dizionario
+        n = len(columns["start_time"])
+        if n == 0:
+            return
+        with self._lock:
+            if isinstance(vin, str):
+                columns = dict(columns, vin=np.full(n, self._vin_code(vin), dtype=np.int32))
+            elif vin is not None:
+                names, inverse = np.unique(np.asarray(vin, dtype=object), return_inverse=True)
+                codes = np.array([self._vin_code(v) for v in names], dtype=np.int32)
+                columns = dict(columns, vin=codes[inverse])
+            next_id = self.manifest["next_id"]
+            partition = self._write_partition(columns, n, next_id)
+            self._publish(self.manifest["partitions"] + [partition], next_id + 1)
+            self._compact_tiers()
+
+    def _write_partition(self, columns, n, part_id):
+        order = np.argsort(columns["start_time"], kind="stable")
+        name = f"part-{part_id:06d}"
+        arrays = {column: np.asarray(columns[column], dtype=dtype)[order] for column, dtype in SCHEMA.items()}
+        os.makedirs(self.path, exist_ok=True)
+        partition = {"name": name, "rows": n}
+        # Dati e nomi dei file su disco prima che _publish li renda visibili nel manifest
+        if n < SMALL_PARTITION_ROWS:
+            partition["file"] = f"{name}.npy"
+            records = np.empty(n, dtype=RECORD_DTYPE)
+            for column, values in arrays.items():
+                records[column] = values
+            _save_synced(os.path.join(self.path, partition["file"]), records)
+        else:
+            part_dir = os.path.join(self.path, name)
+            os.makedirs(part_dir, exist_ok=True)
+            for column, values in arrays.items():
+                _save_synced(os.path.join(part_dir, f"{column}.npy"), values)
+            _fsync_dir(part_dir)
+        _fsync_dir(self.path)
+        starts = arrays["start_time"]
+        partition["min_start"] = int(starts[0])
+        partition["max_start"] = int(starts[-1])
+        return partition
+
+    def _compact_tiers(self):
+        # Le partizioni grandi (es. import massivo) non vengono mai riscritte
+        while True:
+            tiers = {}
+            for p in self.manifest["partitions"]:
+                if p["rows"] < SMALL_PARTITION_ROWS:
+                    tiers.setdefault(_tier(p["rows"]), []).append(p)
+            full = [parts for parts in tiers.values() if len(parts) >= MERGE_FANOUT]
+            if not full:
+                return
+            self.compact(full[0])
+
+    def compact(self, partitions=None):
+        # Unisce le partizioni indicate (di default tutte) in una sola
+        with self._lock:
+            partitions = partitions or list(self.manifest["partitions"])
+            if len(partitions) < 2:
+                return
+            merged = {}
+            for p in partitions:
+                with self._open(p) as data:
+                    for c in COLUMNS:
+                        merged.setdefault(c, []).append(np.asarray(data[c]))
+            merged = {c: np.concatenate(values) for c, values in merged.items()}
+            names = {p["name"] for p in partitions}
+            kept = [p for p in self.manifest["partitions"] if p["name"] not in names]
+            next_id = self.manifest["next_id"]
+            partition = self._write_partition(merged, len(merged["start_time"]), next_id)
+            self._publish(kept + [partition], next_id + 1)
+            with self._readers_lock:
+                self._obsolete.extend(partitions)
+                obsolete, self._obsolete = (self._obsolete, []) if self._readers == 0 else ([], self._obsolete)
+            for p in obsolete:
+                self._remove(p)
+
+    def _remove(self, partition):
+        if partition.get("file"):
+            os.remove(os.path.join(self.path, partition["file"]))
+            return
+        part_dir = os.path.join(self.path, partition["name"])
+        for column in COLUMNS:
+            os.remove(os.path.join(part_dir, f"{column}.npy"))
+        os.rmdir(part_dir)
+
+    # === LETTURA ===
+    def _open(self, partition):
+        # Colonne di una partizione, sempre in memory-map: .npy strutturato per le piccole,
+        # cartella di .npy per le grandi (.npz delle versioni precedenti, finché non compattate)
+        file = partition.get("file")
+        if file and file.endswith(".npz"):
+            return np.load(os.path.join(self.path, file))
+        if file:
+            return _NpyRecords(os.path.join(self.path, file))
+        return _NpyDir(os.path.join(self.path, partition["name"]))
+
+    def read(self, start=None, end=None, vins=None, columns=None):
+        with self._readers_lock:
+            self._readers += 1
+            manifest = self.manifest
+        try:
+            return self._read(manifest, start, end, vins, columns)
+        finally:
+            with self._readers_lock:
+                self._readers -= 1
+
+    def _read(self, manifest, start, end, vins, columns):
+        # Filtro sull'intervallo [start, end) di start_time: le partizioni fuori
+        # intervallo non vengono aperte, dentro la partizione basta una ricerca binaria
+        columns = list(columns or COLUMNS)
+        start_us = _to_us(start) if start is not None else None
+        end_us = _to_us(end) if end is not None else None
+        vin_codes = None
+        if vins is not None:
+            vin_codes = np.array([self._vin_codes[v] for v in vins if v in self._vin_codes], dtype=np.int32)
+
+        pieces = {c: [] for c in columns}
+        for partition in manifest["partitions"]:
+            if start_us is not None and partition["max_start"] < start_us:
+                continue
+            if end_us is not None and partition["min_start"] >= end_us:
+                continue
+            with self._open(partition) as data:
+                starts = data["start_time"]
+                lo = int(np.searchsorted(starts, start_us, "left")) if start_us is not None else 0
+                hi = int(np.searchsorted(starts, end_us, "left")) if end_us is not None else len(starts)
+                if lo >= hi:
+                    continue
+                mask = None
+                if vin_codes is not None:
+                    mask = np.isin(data["vin"][lo:hi], vin_codes)
+                for c in columns:
+                    values = data[c][lo:hi]
+                    pieces[c].append(values[mask] if mask is not None else values)
+        return {c: (np.concatenate(pieces[c]) if pieces[c] else np.empty(0, dtype=SCHEMA[c])) for c in columns}
+
+    def vin_names(self, codes):
+        vins = np.array(self.manifest["vins"], dtype=object)
+        return vins[codes]
+
+    def to_dataframe(self, **kwargs):
+        import pandas as pd
+        data = self.read(**kwargs)
+        if "vin" in data:
+            data["vin"] = self.vin_names(data["vin"])
+        for c in TIME_COLUMNS:
+            if c in data:
+                data[c] = data[c].astype("datetime64[us]")
+        return pd.DataFrame(data)
+
+    def __len__(self):
+        return sum(p["rows"] for p in self.manifest["partitions"])
+
+
+def export_sessions(records, path=DEFAULT_COLUMNAR_PATH):
+    # Conversione una tantum dall'archivio JSON / JSON Lines
+    store = ColumnarSessionStore(path)
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= 100_000:
+            store.append_records(batch)
+            batch = []
+    store.append_records(batch)
+    return store
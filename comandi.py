@@ -0,0 +1,224 @@
+import json
+import asyncio
+import logging
+import aiohttp
+
+from metriche import metrics
+
+logger = logging.getLogger(__name__)
+
+POLL_TIMEOUT = 50   # long polling: Telegram tiene aperta la richiesta fino a 50 s se non ci sono messaggi
+
+HELP = (
+    "Comandi disponibili:\n"
+    "/stato [veicolo] - stato della batteria e della ricarica\n"
+    "/target <percentuale> [veicolo] - nuovo target per la ricarica in corso o la prossima\n"
+    "/stop [veicolo] - interrompe la ricarica fino allo scollegamento del cavo\n"
+    "/collegato [veicolo] - controlla subito il cavo\n"
+    "/storico [veicolo] - kWh e km degli ultimi 7 giorni e ultime ricariche\n"
+    "Alle domande si risponde con \"Rispondi\" sul messaggio, oppure scrivendo la risposta "
+    "seguita dal nome del veicolo se ci sono più domande aperte."
+)
+
+
+class _Question:
+    def __init__(self, charger):
+        self.charger = charger
+        self.future = asyncio.get_running_loop().create_future()
+        self.messages = []  # [(chat_id, message_id)] delle copie inviate
+
+
+class TelegramDispatcher:
+    # Un solo task di long polling per bot, attivo per tutta la vita del demone: l'offset non
+    # si perde tra una domanda e l'altra e nessun veicolo interroga getUpdates per conto suo.
+    # Le risposte arrivano alla domanda giusta (risposta al messaggio o nome del veicolo),
+    # i comandi modificano solo lo stato degli EVCharger e non aspettano mai le API
+    def __init__(self, notifier, poll_timeout=POLL_TIMEOUT):
+        self.notifier = notifier
+        self.poll_timeout = poll_timeout
+        self.chargers = {}
+        self.offset = None
+        self._questions = []
+        self._by_message = {}
+        self._task = None
+        self.updates = 0
+
+    def register(self, charger):
+        self.chargers[charger.vin] = charger
+        self._ensure_started()
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._poll(), name="telegram-dispatcher")
+
+    # === DOMANDE ===
+    async def ask(self, charger, text, timeout=300):
+        # Invia la domanda a tutte le chat e attende la prima risposta valida (None allo scadere)
+        self._ensure_started()
+        question = _Question(charger)
+        self._questions.append(question)
+        try:
+            if len(self.chargers) > 1:
+                text = f"[{charger.label()}] {text}"
+            question.messages = await self.notifier.send(text, reply_markup={"force_reply": True, "selective": False})
+            for key in question.messages:
+                self._by_message[key] = question
+            done, _ = await asyncio.wait({question.future}, timeout=timeout)
+            return question.future.result() if done else None
+        finally:
+            self._questions.remove(question)
+            for key in question.messages:
+                self._by_message.pop(key, None)
+            if not question.future.done():
+                question.future.cancel()
+
+    # === POLLING ===
+    async def _skip_backlog(self):
+        # All'avvio scarto i messaggi arrivati mentre il demone era fermo con una sola chiamata
+        # (offset=-1 restituisce solo l'ultimo update)
+        async with self.notifier.get_session().get(self.notifier.url("getUpdates"), params={"offset": -1}) as resp:
+            data = await resp.json()
+        result = data.get("result") or []
+        self.offset = result[-1]["update_id"] + 1 if result else 0
+
+    async def _poll(self):
+        backoff = 1
+        url = self.notifier.url("getUpdates")
+        while True:
+            try:
+                if self.offset is None:
+                    await self._skip_backlog()
+                params = {"offset": self.offset, "timeout": self.poll_timeout,
+                          "allowed_updates": json.dumps(["message"])}
+                with metrics.timer("telegram_call_seconds", "Durata delle chiamate all'API Telegram",
+                                   method="getUpdates"):
+                    async with self.notifier.get_session().get(
+                            url, params=params, timeout=aiohttp.ClientTimeout(total=self.poll_timeout + 15)) as resp:
+                        data = await resp.json()
+                if not data.get("ok", True):
+                    raise RuntimeError(data.get("description", "risposta non valida"))
+                backoff = 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Polling Telegram fallito ({e}), riprovo tra {backoff} s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+                continue
+            for update in data.get("result") or []:
+                self.offset = update["update_id"] + 1
+                self.updates += 1
+                try:
+                    self.handle_update(update)
+                except Exception as e:
+                    logger.error(f"Errore nella gestione del messaggio Telegram: {e}")
+
+    # === INSTRADAMENTO ===
+    def handle_update(self, update):
+        message = update.get("message") or {}
+        text = (message.get("text") or "").strip()
+        chat_id = str(message.get("chat", {}).get("id"))
+        if not text or chat_id not in {str(c) for c in self.notifier.chat_ids}:
+            # Solo le chat configurate possono rispondere o dare comandi
+            metrics.counter("telegram_updates_total", "Messaggi ricevuti", kind="ignorato").inc()
+            return
+        if text.startswith("/"):
+            metrics.counter("telegram_updates_total", "Messaggi ricevuti", kind="comando").inc()
+            self._command(chat_id, text)
+            return
+        metrics.counter("telegram_updates_total", "Messaggi ricevuti", kind="risposta").inc()
+        reply_to = (message.get("reply_to_message") or {}).get("message_id")
+        question = self._by_message.get((chat_id, reply_to))
+        answer = text.lower()
+        if question is None:
+            question, answer = self._match_question(chat_id, answer)
+        if question is None:
+            return
+        if not question.future.done():
+            question.future.set_result(answer)
+
+    def _match_question(self, chat_id, answer):
+        open_questions = [q for q in self._questions if any(c == chat_id for c, _ in q.messages)]
+        if not open_questions:
+            self.notifier.notify("Nessuna domanda in attesa. /aiuto per i comandi.", chat_ids=(chat_id,))
+            return None, None
+        # Nome del veicolo nella risposta (necessario se nella chat ci sono più domande aperte)
+        words = answer.split()
+        for question in open_questions:
+            label = question.charger.label().lower()
+            if label in words:
+                return question, " ".join(w for w in words if w != label)
+        if len(open_questions) == 1:
+            return open_questions[0], answer
+        labels = ", ".join(q.charger.label() for q in open_questions)
+        self.notifier.notify(f"Più domande in attesa ({labels}): rispondi al messaggio della domanda "
+                             f"oppure aggiungi il nome del veicolo.", chat_ids=(chat_id,))
+        return None, None
+
+    # === COMANDI ===
+    def _resolve(self, args, required=0):
+        # Veicolo indicato dopo gli argomenti obbligatori, per nome o parte finale del VIN
+        # (es. "/target 90 zoe"); se c'è un solo veicolo non serve
+        if len(args) > required:
+            wanted = args[-1].lower()
+            for charger in self.chargers.values():
+                if wanted == charger.label().lower() or (charger.vin or "").lower().endswith(wanted):
+                    return charger, args[:-1]
+        if len(self.chargers) == 1:
+            return next(iter(self.chargers.values())), args
+        return None, args
+
+    def _command(self, chat_id, text):
+        name, *args = text.split()
+        name = name.split("@")[0].lower()
+        reply = lambda message: self.notifier.notify(message, chat_ids=(chat_id,))
+        if name in ("/aiuto", "/help", "/start"):
+            reply(HELP)
+            return
+        if name not in ("/stato", "/target", "/stop", "/collegato", "/storico"):
+            reply(f"Comando sconosciuto {name}. /aiuto per l'elenco.")
+            return
+        charger, rest = self._resolve(args, required=1 if name == "/target" else 0)
+        if name == "/stato":
+            targets = [charger] if charger else list(self.chargers.values())
+            reply("\n".join(c.status_line() for c in targets) if targets else "Nessun veicolo attivo.")
+            return
+        if name == "/storico":
+            # Indice in memoria dello storico: una ricerca binaria per veicolo, nessuna API
+            targets = [charger] if charger else list(self.chargers.values())
+            reply("\n\n".join(c.history_summary() for c in targets) if targets else "Nessun veicolo attivo.")
+            return
+        if charger is None:
+            labels = ", ".join(c.label() for c in self.chargers.values())
+            reply(f"Specifica il veicolo: {labels}")
+            return
+        if name == "/target":
+            if not rest or not rest[0].rstrip("%").isdigit() or not 1 <= int(rest[0].rstrip("%")) <= 100:
+                reply("Uso: /target <percentuale> [veicolo], es. /target 90")
+                return
+            reply(charger.set_target(int(rest[0].rstrip("%"))))
+        elif name == "/stop":
+            reply(charger.request_stop())
+        else:
+            charger.trigger_plug_check()
+            reply(f"🔌 {charger.label()}: controllo del cavo in corso.")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self):
+        return {"updates": self.updates, "open_questions": len(self._questions), "offset": self.offset}
+
+
+# Un dispatcher per bot (cioè per notifier), condiviso da tutti gli EVCharger del processo
+_dispatchers = {}
+
+
+def get_dispatcher(notifier):
+    key = id(notifier)
+    if key not in _dispatchers:
+        _dispatchers[key] = TelegramDispatcher(notifier)
+    return _dispatchers[key]
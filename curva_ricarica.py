@@ -0,0 +1,205 @@
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+BAND = 10  # ampiezza delle fasce di SoC (%)
+N_BANDS = 100 // BAND
+DEFAULT_RATE = 5.0  # %/h: presa da ~1.35 kW su batteria da 27 kWh
+MIN_RATE = 0.5
+MAX_RATE = 60.0
+MAX_FACTOR = 3.0  # correzione massima in sessione rispetto alla curva appresa
+
+
+def session_hours(record):
+    # Durata reale della sessione; charging_duration_hours nei dati storici è una stima
+    try:
+        start = datetime.fromisoformat(record["start_time"])
+        end = datetime.fromisoformat(record["end_time"])
+        hours = (end - start).total_seconds() / 3600
+        if hours > 0:
+            return hours
+    except (KeyError, TypeError, ValueError):
+        pass
+    if record.get("charging_time"):
+        return record["charging_time"] / 3600
+    return record.get("charging_duration_hours")
+
+
+def band_overlaps(soc_from, soc_to):
+    # Punti di SoC percorsi in ciascuna fascia andando da soc_from a soc_to
+    overlaps = [0.0] * N_BANDS
+    for b in range(N_BANDS):
+        lo, hi = b * BAND, (b + 1) * BAND
+        overlaps[b] = max(0.0, min(soc_to, hi) - max(soc_from, lo))
+    return overlaps
+
+
+def _solve(matrix, vector):
+    # Eliminazione di Gauss con pivot parziale (sistema N_BANDS x N_BANDS)
+    n = len(vector)
+    a = [row[:] + [vector[i]] for i, row in enumerate(matrix)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(a[r][col]))
+        a[col], a[pivot] = a[pivot], a[col]
+        for r in range(col + 1, n):
+            f = a[r][col] / a[col][col]
+            for c in range(col, n + 1):
+                a[r][c] -= f * a[col][c]
+    x = [0.0] * n
+    for r in range(n - 1, -1, -1):
+        x[r] = (a[r][n] - sum(a[r][c] * x[c] for c in range(r + 1, n))) / a[r][r]
+    return x
+
+
+class ChargeCurveModel:
+    # Velocità di ricarica (%/h) costante a tratti per fasce di SoC. La durata di una
+    # sessione è lineare negli inversi delle velocità (h/%), che stimo con minimi quadrati
+    # pesati, regolarizzati verso la velocità media e tra fasce adiacenti (la curva reale
+    # è liscia): le statistiche sufficienti si aggiornano in O(1) a ogni nuova sessione.
+    def __init__(self, ridge=100.0, smoothing=300.0, prior_rate=DEFAULT_RATE):
+        self.ridge = ridge
+        self.smoothing = smoothing
+        self.prior_rate = prior_rate
+        self.ata = [[0.0] * N_BANDS for _ in range(N_BANDS)]
+        self.atb = [0.0] * N_BANDS
+        self.total_hours = 0.0
+        self.total_soc = 0.0
+        self.n_sessions = 0
+        self._rates = None
+
+    def add_session(self, record):
+        try:
+            soc_from = float(record["start_battery_level"])
+            soc_to = float(record["end_battery_level"])
+        except (KeyError, TypeError, ValueError):
+            return False
+        hours = session_hours(record)
+        if not hours or soc_to <= soc_from:
+            return False
+        overlaps = band_overlaps(soc_from, soc_to)
+        # Le sessioni brevi hanno un errore relativo alto (SoC intero): pesano meno
+        weight = (soc_to - soc_from) / BAND
+        for i in range(N_BANDS):
+            if overlaps[i]:
+                self.atb[i] += weight * overlaps[i] * hours
+                for j in range(N_BANDS):
+                    self.ata[i][j] += weight * overlaps[i] * overlaps[j]
+        self.total_hours += hours
+        self.total_soc += soc_to - soc_from
+        self.n_sessions += 1
+        self._rates = None
+        return True
+
+    @classmethod
+    def from_sessions(cls, sessions, vin=None, **kwargs):
+        model = cls(**kwargs)
+        for record in sessions:
+            if record.get("vin") in (None, vin):
+                model.add_session(record)
+        return model
+
+    @property
+    def rates(self):
+        if self._rates is None:
+            self._rates = self._fit()
+        return self._rates
+
+    def _fit(self):
+        if not self.n_sessions:
+            return [self.prior_rate] * N_BANDS
+        prior = self.total_hours / self.total_soc
+        matrix = [[self.ata[i][j] + (self.ridge if i == j else 0.0) for j in range(N_BANDS)]
+                  for i in range(N_BANDS)]
+        for i in range(N_BANDS - 1):
+            matrix[i][i] += self.smoothing
+            matrix[i + 1][i + 1] += self.smoothing
+            matrix[i][i + 1] -= self.smoothing
+            matrix[i + 1][i] -= self.smoothing
+        vector = [self.atb[i] + self.ridge * prior for i in range(N_BANDS)]
+        inverse_rates = _solve(matrix, vector)
+        return [min(MAX_RATE, max(MIN_RATE, 1 / u)) if u > 0 else MAX_RATE for u in inverse_rates]
+
+    def hours_between(self, soc_from, soc_to):
+        if soc_to <= soc_from:
+            return 0.0
+        rates = self.rates
+        return sum(o / rates[b] for b, o in enumerate(band_overlaps(soc_from, soc_to)) if o)
+
+    def seconds_between(self, soc_from, soc_to):
+        return self.hours_between(soc_from, soc_to) * 3600
+
+    def soc_after(self, soc_from, seconds):
+        # Inverso di seconds_between: SoC raggiunto dopo 'seconds' partendo da soc_from
+        hours = seconds / 3600
+        soc = soc_from
+        rates = self.rates
+        while hours > 0 and soc < 100:
+            b = min(int(soc // BAND), N_BANDS - 1)
+            band_end = (b + 1) * BAND
+            needed = (band_end - soc) / rates[b]
+            if needed >= hours:
+                return soc + hours * rates[b]
+            hours -= needed
+            soc = band_end
+        return min(soc, 100.0)
+
+    def session(self, alpha=0.5):
+        return OnlineChargeEstimate(self, alpha)
+
+
+def fit_charge_curves(sessions, vins, **kwargs):
+    # Un solo passaggio sull'archivio per tutta la flotta; le sessioni senza VIN
+    # (storico precedente alla gestione multi-veicolo) valgono per tutti
+    models = {vin: ChargeCurveModel(**kwargs) for vin in vins}
+    for record in sessions:
+        vin = record.get("vin")
+        if vin is None:
+            for model in models.values():
+                model.add_session(record)
+        elif vin in models:
+            models[vin].add_session(record)
+    return models
+
+
+class OnlineChargeEstimate:
+    # Correzione moltiplicativa della curva appresa durante la sessione in corso
+    # (temperatura, potenza effettiva della presa, ...), aggiornata a ogni lettura
+    def __init__(self, model, alpha=0.5):
+        self.model = model
+        self.alpha = alpha
+        self.factor = 1.0
+        self.position = None
+
+    def estimated_soc(self, soc):
+        # Il SoC letto è intero: stimo la parte frazionaria proiettando la curva
+        # dall'ultima lettura, altrimenti assumo il centro del punto
+        if self.position is not None and int(self.position) == soc:
+            return self.position
+        return soc + 0.5
+
+    def seconds_to(self, soc, goal):
+        return self.model.seconds_between(self.estimated_soc(soc), goal) * self.factor
+
+    def observe(self, elapsed_s, soc_before, soc_after):
+        if elapsed_s <= 0:
+            return
+        projected = self.model.soc_after(self.estimated_soc(soc_before), elapsed_s / self.factor)
+        if soc_after > soc_before:
+            predicted = self.model.seconds_between(soc_before + 0.5, soc_after + 0.5)
+            ratio = elapsed_s / predicted if predicted > 0 else 1.0
+            self.factor = min(MAX_FACTOR, (1 - self.alpha) * self.factor + self.alpha * ratio)
+        else:
+            # Nessun avanzamento: la ricarica è almeno così lenta da non aver fatto un punto
+            lower_bound = elapsed_s / max(self.model.seconds_between(soc_before + 0.5, soc_before + 1), 1)
+            self.factor = max(self.factor, min(lower_bound, MAX_FACTOR))
+        # La proiezione deve restare compatibile con la lettura appena fatta
+        self.position = min(max(projected, soc_after), soc_after + 0.99)
+
+    def next_sleep(self, soc, goal, final=False, min_sleep=300, early=0.9):
+        # Verso il target finale mi sveglio un po' prima del previsto: svegliarsi tardi
+        # vuol dire superare il target, svegliarsi presto costa una lettura in più
+        seconds = self.seconds_to(soc, goal)
+        if final:
+            seconds *= early
+        return max(min_sleep, seconds)
@@ -1,7 +1,13 @@
+import os
 import json
+import time
 import random
+import argparse
 from datetime import datetime, timedelta
 import numpy as np
+from dotenv import load_dotenv
+from archivio_sessioni import load_sessions
+from colonnare import ColumnarSessionStore
 
 # === COSTANTI ===
 KM_PER_KWH = 7.41
@@ -62,8 +68,8 @@ def generate_valid_session(start_time, mileage, health=90, reverse=False):
 
 # === GENERA SESSIONI PRIMA DI UNA DATA ===
 def generate_sessions_before(base_data, from_date, n_sessions):
-    base_data = sorted(base_data, key=lambda x: x["start_time"])
-    first = base_data[0]
+    # Basta la sessione più vecchia: min() in O(n) invece di ordinare tutto lo storico
+    first = min(base_data, key=lambda x: x["start_time"])
     mileage = first.get("total_mileage", 0)
     health = first.get("battery_health_estimate", 90)
     current_time = datetime.fromisoformat(first["start_time"]) - timedelta(hours=2)
@@ -87,8 +93,7 @@ def generate_sessions_before(base_data, from_date, n_sessions):
 
 # === GENERA SESSIONI DOPO UNA DATA ===
 def generate_sessions_after(base_data, until_date, n_sessions):
-    base_data = sorted(base_data, key=lambda x: x["start_time"])
-    last = base_data[-1]
+    last = max(base_data, key=lambda x: x["start_time"])
     mileage = last.get("total_mileage", 0)
     health = last.get("battery_health_estimate", 90)
     current_time = datetime.fromisoformat(last["end_time"]) + timedelta(hours=2)
@@ -110,21 +115,208 @@ def generate_sessions_after(base_data, until_date, n_sessions):
     return sessions
 
 
+# === GENERAZIONE MASSIVA VETTORIZZATA ===
+SKIP_PROBABILITY = 0.3
+US_PER_HOUR = 3600 * 10**6
+US_PER_DAY = 24 * US_PER_HOUR
+
+SESSION_LINE = (
+    '{{"vin": "{}", "start_time": "{}", "end_time": "{}", "start_battery_level": {}, '
+    '"end_battery_level": {}, "start_battery_capacity": {}, "end_battery_capacity": {}, '
+    '"EnergyConsumed": {}, "battery_autonomy": {}, "charging_duration_hours": {}, '
+    '"energy_expected": {}, "energy_measured": {}, "battery_health_estimate": {}, '
+    '"charging_status": {}, "charging_time": {}, "total_mileage": {}}}\n'
+)
+
+
+def _draw_steps(rng, n, health):
+    # Stesse regole di generate_valid_session, estratte in blocco per n passi
+    skip = rng.random(n) < SKIP_PROBABILITY
+    skip_days = rng.integers(1, 3, n)
+
+    start_level = rng.integers(MIN_SOC_START, MAX_SOC_START + 1, n)
+    high = np.minimum(40, 100 - start_level)
+    low = np.minimum(MIN_SOC_END - start_level, high)
+    delta = rng.integers(np.maximum(5, low), high + 1)
+    duration = np.round(np.maximum(delta / MAX_SOC_PER_HOUR, 1.0) + rng.uniform(0.1, 0.5, n), 3)
+    end_level = np.minimum(start_level + (duration * MAX_SOC_PER_HOUR).astype(np.int64), 100)
+
+    session_health = np.round(np.clip(rng.normal(health, 2, n), 75, 100), 2)
+    full_capacity = FULL_CAPACITY_KWH * (session_health / 100)
+    start_capacity = np.round(full_capacity * start_level / 100 + rng.uniform(-0.1, 0.1, n), 2)
+    end_capacity = np.round(full_capacity * end_level / 100 + rng.uniform(-0.1, 0.1, n), 2)
+    energy = np.maximum(0.1, np.round(end_capacity - start_capacity, 2))
+    measured = np.round(energy * rng.uniform(0.95, 1.1, n), 2)
+    autonomy = np.clip(end_level / 100 * 230 + rng.uniform(-10, 10, n), 100, 270).astype(np.int64)
+    status = rng.integers(0, 2, n).astype(np.float64)
+    gap_hours = rng.uniform(2, 6, n)
+
+    duration_us = np.round(duration * US_PER_HOUR).astype(np.int64)
+    step_us = np.where(skip, skip_days * US_PER_DAY, duration_us + np.round(gap_hours * US_PER_HOUR).astype(np.int64))
+    return {
+        "skip": skip, "step_us": step_us, "duration_us": duration_us,
+        "start_level": start_level, "end_level": end_level, "duration": duration,
+        "health": session_health, "start_capacity": start_capacity, "end_capacity": end_capacity,
+        "energy": energy, "measured": measured, "autonomy": autonomy, "status": status,
+        "km": np.round(energy * KM_PER_KWH, 1),
+    }
+
+
+def generate_vehicle_batches(rng, vin, start_date, end_date, mileage, health, batch_size=100_000):
+    # Genera le sessioni di un veicolo a blocchi di array NumPy, in ordine cronologico
+    epoch = np.datetime64(start_date, "us").astype(np.int64)
+    end_us = np.datetime64(end_date, "us").astype(np.int64)
+    mean_step_us = SKIP_PROBABILITY * 1.5 * US_PER_DAY + (1 - SKIP_PROBABILITY) * 10 * US_PER_HOUR
+    now = epoch + int(rng.uniform(0, 24) * US_PER_HOUR)
+    while now <= end_us:
+        n = int(min(batch_size, (end_us - now) / mean_step_us * 1.1 + 16))
+        steps = _draw_steps(rng, n, health)
+        start_us = now + np.concatenate(([0], np.cumsum(steps["step_us"][:-1])))
+        now = int(start_us[-1] + steps["step_us"][-1])
+        keep = ~steps["skip"] & (start_us <= end_us)
+        if not keep.any():
+            continue
+        batch = {k: v[keep] for k, v in steps.items() if k not in ("skip", "step_us")}
+        batch["start_us"] = start_us[keep]
+        batch["end_us"] = batch["start_us"] + batch["duration_us"]
+        batch["mileage"] = np.round(mileage + np.cumsum(batch["km"]), 1)
+        mileage = float(batch["mileage"][-1])
+        batch["vin"] = vin
+        yield batch
+
+
+def format_batch(batch):
+    starts = np.datetime_as_string(batch["start_us"].astype("datetime64[us]"))
+    ends = np.datetime_as_string(batch["end_us"].astype("datetime64[us]"))
+    columns = zip(
+        starts.tolist(), ends.tolist(), batch["start_level"].tolist(), batch["end_level"].tolist(),
+        batch["start_capacity"].tolist(), batch["end_capacity"].tolist(), batch["energy"].tolist(),
+        batch["autonomy"].tolist(), batch["duration"].tolist(), batch["energy"].tolist(),
+        batch["measured"].tolist(), batch["health"].tolist(), batch["status"].tolist(),
+        (batch["duration"] * 3600).astype(np.int64).tolist(), batch["mileage"].tolist(),
+    )
+    vin = batch["vin"]
+    return "".join(SESSION_LINE.format(vin, *row) for row in columns)
+
+
+def batch_to_columns(batch):
+    # Colonne nello schema di colonnare.py (tempi in µs, misure float32)
+    return {
+        "start_time": batch["start_us"], "end_time": batch["end_us"],
+        "start_battery_level": batch["start_level"], "end_battery_level": batch["end_level"],
+        "start_battery_capacity": batch["start_capacity"], "end_battery_capacity": batch["end_capacity"],
+        "EnergyConsumed": batch["energy"], "battery_autonomy": batch["autonomy"],
+        "charging_duration_hours": batch["duration"], "energy_expected": batch["energy"],
+        "energy_measured": batch["measured"], "battery_health_estimate": batch["health"],
+        "charging_status": batch["status"], "charging_time": (batch["duration"] * 3600).astype(np.int64),
+        "total_mileage": batch["mileage"],
+    }
+
+
+def _vehicle_batches(start_date, end_date, n_vehicles, seed, batch_size):
+    rng = np.random.default_rng(seed)
+    for v in range(n_vehicles):
+        vin = f"VF1SYN{v:011d}"
+        mileage = float(rng.uniform(5_000, 40_000))
+        health = float(rng.uniform(85, 95))
+        yield from generate_vehicle_batches(rng, vin, start_date, end_date, mileage, health, batch_size)
+
+
+def generate_bulk(out_path, start_date, end_date, n_vehicles, seed=None, batch_size=100_000):
+    # Scrive in streaming un file JSON Lines (leggibile con archivio_sessioni.load_sessions)
+    total = 0
+    with open(out_path, "w", encoding="utf-8") as f:
+        for batch in _vehicle_batches(start_date, end_date, n_vehicles, seed, batch_size):
+            f.write(format_batch(batch))
+            total += len(batch["start_us"])
+    return total
+
+
+def generate_bulk_columnar(out_path, start_date, end_date, n_vehicles, seed=None, batch_size=100_000):
+    # Come generate_bulk, ma direttamente nel formato colonnare (nessuna serializzazione JSON)
+    store = ColumnarSessionStore(out_path)
+    pending, vins, pending_rows, total = [], [], 0, 0
+    for batch in _vehicle_batches(start_date, end_date, n_vehicles, seed, batch_size):
+        pending.append(batch_to_columns(batch))
+        vins.append(np.full(len(batch["start_us"]), batch["vin"], dtype=object))
+        pending_rows += len(batch["start_us"])
+        if pending_rows >= batch_size:
+            store.append_columns({k: np.concatenate([p[k] for p in pending]) for k in pending[0]},
+                                 vin=np.concatenate(vins))
+            total += pending_rows
+            pending, vins, pending_rows = [], [], 0
+    if pending:
+        store.append_columns({k: np.concatenate([p[k] for p in pending]) for k in pending[0]},
+                             vin=np.concatenate(vins))
+        total += pending_rows
+    return total
+
+
 # === ESECUZIONE ===
-if __name__ == "__main__":
-    with open("Progetto SmartEVCharger/charging_data.json", "r") as f:
-        base_data = json.load(f)
+def sync_to_mongo(path):
+    # pymongo serve solo per l'invio: il generatore funziona anche senza
+    from sincronizzazione import open_mongo_sync, DEFAULT_DATABASE, DEFAULT_COLLECTION
 
-    start_date = datetime(2025, 4, 1)
-    end_date = datetime(2025, 8, 31)
+    load_dotenv()
+    uri = os.getenv("MONGO_URI")
+    if not uri:
+        print("⚠️ MONGO_URI non impostato: sessioni non inviate")
+        return
+    sync = open_mongo_sync(uri, os.getenv("MONGO_DB", DEFAULT_DATABASE),
+                           os.getenv("MONGO_COLLECTION", DEFAULT_COLLECTION))
+    print(f"✅ {sync.sync_file(path)} sessioni inviate a MongoDB")
 
-    before_sessions = generate_sessions_before(base_data, start_date, n_sessions=100)
-    after_sessions = generate_sessions_after(base_data, end_date, n_sessions=80)
+
+def main():
+    parser = argparse.ArgumentParser(description="Generazione di sessioni di ricarica sintetiche")
+    parser.add_argument("--mode", choices=["estendi", "massivo"], default="estendi",
+                        help="estendi: completa lo storico reale prima e dopo; massivo: flotta sintetica vettorizzata")
+    parser.add_argument("--start", type=datetime.fromisoformat, default=datetime(2025, 4, 1))
+    parser.add_argument("--end", type=datetime.fromisoformat, default=datetime(2025, 8, 31))
+    parser.add_argument("--vehicles", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=100_000)
+    parser.add_argument("--input", default="Progetto SmartEVCharger/charging_data.json")
+    parser.add_argument("--format", choices=["jsonl", "colonnare"], default="jsonl",
+                        help="formato di uscita in modalità massiva")
+    parser.add_argument("--out", default=None)
+    parser.add_argument("--mongo", action="store_true",
+                        help="invia le sessioni generate a MongoDB (MONGO_URI) con upsert incrementali")
+    args = parser.parse_args()
+
+    if args.mode == "massivo":
+        t0 = time.perf_counter()
+        if args.format == "colonnare":
+            out_path = args.out or "ricariche_sintetiche.col"
+            total = generate_bulk_columnar(out_path, args.start, args.end, args.vehicles, args.seed, args.batch_size)
+        else:
+            out_path = args.out or "ricariche_sintetiche.jsonl"
+            total = generate_bulk(out_path, args.start, args.end, args.vehicles, args.seed, args.batch_size)
+        print(f"✅ File generato: {out_path} ({total} sessioni in {time.perf_counter() - t0:.1f} s)")
+        if args.mongo and args.format == "jsonl":
+            sync_to_mongo(out_path)
+        return
+
+    if args.seed is not None:
+        random.seed(args.seed)
+        np.random.seed(args.seed)
+    # Accetta sia il vecchio array JSON sia l'archivio append-only (.jsonl / .db)
+    base_data = load_sessions(args.input)
+
+    before_sessions = generate_sessions_before(base_data, args.start, n_sessions=100)
+    after_sessions = generate_sessions_after(base_data, args.end, n_sessions=80)
 
     all_sessions = before_sessions + base_data + after_sessions
     all_sessions.sort(key=lambda x: x["start_time"])
 
-    with open("ricariche_dacia_spring.json", "w") as f:
+    out_path = args.out or "ricariche_dacia_spring.json"
+    with open(out_path, "w") as f:
         json.dump(all_sessions, f, indent=4)
 
-    print("✅ File generato: ricariche_dacia_spring.json")
+    print(f"✅ File generato: {out_path}")
+    if args.mongo:
+        sync_to_mongo(out_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from bisect import bisect_left
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Bucket (secondi) per le latenze delle chiamate esterne: Renault, Tapo, Telegram
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Bucket per ritardi del loop e sleep più lunghi del previsto
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def sample(self):
+        return self.value
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, fn=None):
+        self.value = 0
+        self.fn = fn  # valore calcolato alla lettura (es. lunghezza di una coda)
+
+    def set(self, value):
+        self.value = value
+
+    def sample(self):
+        if self.fn is None:
+            return self.value
+        try:
+            return self.fn()
+        except Exception:
+            return None
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # l'ultimo è +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def sample(self):
+        return {"count": self.count, "sum": round(self.sum, 6), "max": self.max,
+                "buckets": dict(zip([*map(str, self.buckets), "+Inf"], self.counts))}
+
+
+class _Timer:
+    # Classe invece di contextlib.contextmanager: costa la metà sul percorso caldo
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self.histogram
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+        return False
+
+
+class MetricsRegistry:
+    # Metriche identificate da (nome, etichette). Registrazione e aggiornamento costano
+    # una ricerca in un dizionario: si possono lasciare attive in produzione
+    def __init__(self):
+        self._metrics = {}
+        self._help = {}
+        self._kinds = {}
+
+    def _get(self, cls, name, help, labels, *args):
+        # Con una sola etichetta (il caso comune) non serve ordinare
+        key = (name, tuple(sorted(labels.items())) if len(labels) > 1 else tuple(labels.items()))
+        metric = self._metrics.get(key)
+        if metric is None:
+            if self._kinds.setdefault(name, cls.kind) != cls.kind:
+                raise ValueError(f"Metrica {name} già registrata come {self._kinds[name]}")
+            metric = self._metrics[key] = cls(*args)
+            if help:
+                self._help.setdefault(name, help)
+        return metric
+
+    def counter(self, name, help="", **labels):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help="", fn=None, **labels):
+        gauge = self._get(Gauge, name, help, labels)
+        if fn is not None:
+            gauge.fn = fn
+        return gauge
+
+    def histogram(self, name, help="", buckets=LATENCY_BUCKETS, **labels):
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def timer(self, name, help="", buckets=LATENCY_BUCKETS, **labels):
+        # Durata del blocco "with" (anche se contiene await); conta anche le chiamate che sollevano eccezioni
+        return _Timer(self.histogram(name, help, buckets, **labels))
+
+    # === ESPORTAZIONE ===
+    def render(self):
+        # Formato testuale di Prometheus (text/plain; version=0.0.4)
+        by_name = {}
+        for (name, labels), metric in self._metrics.items():
+            by_name.setdefault(name, []).append((labels, metric))
+        lines = []
+        for name in sorted(by_name):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {self._kinds[name]}")
+            for labels, metric in by_name[name]:
+                if metric.kind != "histogram":
+                    value = metric.sample()
+                    if value is not None:
+                        lines.append(f"{name}{_labels(labels)} {_number(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip([*metric.buckets, "+Inf"], metric.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(labels, le=bound)} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {_number(metric.sum)}")
+                lines.append(f"{name}_count{_labels(labels)} {metric.count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        return {
+            "timestamp": time.time(),
+            "metrics": [{"name": name, "labels": dict(labels), "type": metric.kind, "value": metric.sample()}
+                        for (name, labels), metric in self._metrics.items()],
+        }
+
+    def dump(self, path):
+        # Scrittura atomica: chi legge il file non vede mai un JSON a metà
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    def clear(self):
+        self._metrics.clear()
+        self._help.clear()
+        self._kinds.clear()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels, **extra):
+    items = [*labels, *extra.items()]
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Registro unico del processo, condiviso da tutti i moduli (come pool e notifier)
+metrics = MetricsRegistry()
+
+
+class LoopLagMonitor:
+    # Ritardo del loop asyncio: quanto in più del previsto dura uno sleep breve.
+    # Un valore alto vuol dire che qualcosa blocca il loop (I/O sincrono, calcoli lunghi)
+    def __init__(self, registry=metrics, interval=0.5):
+        self.interval = interval
+        self.histogram = registry.histogram("event_loop_lag_seconds", "Ritardo del loop asyncio", LAG_BUCKETS)
+        self.task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.histogram.observe(max(0.0, loop.time() - started - self.interval))
+
+    def start(self):
+        self.task = asyncio.create_task(self._run(), name="loop-lag-monitor")
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+
+class MetricsExporter:
+    # GET /metrics (Prometheus) e /metrics.json sulla porta locale; con dump_path le
+    # metriche vengono anche scritte su file ogni dump_interval secondi
+    def __init__(self, registry=metrics, host="127.0.0.1", port=None, dump_path=None, dump_interval=60):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.dump_path = dump_path
+        self.dump_interval = dump_interval
+        self.runner = None
+        self.lag_monitor = LoopLagMonitor(registry)
+        self._dump_task = None
+
+    async def _handle_text(self, request):
+        return web.Response(body=self.registry.render().encode("utf-8"),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def _handle_json(self, request):
+        return web.json_response(self.registry.snapshot())
+
+    async def _dump_loop(self):
+        while True:
+            await asyncio.sleep(self.dump_interval)
+            self._dump()
+
+    def _dump(self):
+        try:
+            self.registry.dump(self.dump_path)
+        except OSError as e:
+            logger.warning(f"Impossibile scrivere le metriche in {self.dump_path}: {e}")
+
+    async def start(self):
+        self.lag_monitor.start()
+        if self.port:
+            app = web.Application()
+            app.router.add_get("/metrics", self._handle_text)
+            app.router.add_get("/metrics.json", self._handle_json)
+            self.runner = web.AppRunner(app)
+            await self.runner.setup()
+            await web.TCPSite(self.runner, self.host, self.port).start()
+            logger.info(f"Metriche disponibili su http://{self.host}:{self.port}/metrics")
+        if self.dump_path:
+            self._dump_task = asyncio.create_task(self._dump_loop(), name="metrics-dump")
+
+    async def close(self):
+        await self.lag_monitor.close()
+        if self._dump_task is not None:
+            self._dump_task.cancel()
+            await asyncio.gather(self._dump_task, return_exceptions=True)
+            self._dump_task = None
+            self._dump()  # ultimo stato prima dell'uscita
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+def open_metrics_exporter(port=None, dump_path=None):
+    # METRICS_PORT / METRICS_FILE non impostati: nessun exporter (le metriche restano in memoria)
+    port = port or os.getenv('METRICS_PORT')
+    dump_path = dump_path or os.getenv('METRICS_FILE')
+    if not port and not dump_path:
+        return None
+    return MetricsExporter(port=int(port) if port else None, dump_path=dump_path,
+                           dump_interval=float(os.getenv('METRICS_DUMP_INTERVAL', 60)))
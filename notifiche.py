@@ -0,0 +1,234 @@
+import time
+import asyncio
+import itertools
+import logging
+import aiohttp
+from collections import OrderedDict
+from metriche import metrics
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_API = "https://api.telegram.org/bot{token}/{method}"
+
+
+class TelegramNotifier:
+    def __init__(self, bot_token, chat_ids, queue_size=200, max_in_flight=20,
+                 per_chat_interval=1.0, global_interval=1/30, progress_interval=600, name=None):
+        self.bot_token = bot_token
+        self.chat_ids = [c for c in chat_ids if c]
+        # Etichetta delle metriche: l'id del bot (la parte del token prima dei due punti, non segreta)
+        self.name = name if name is not None else (bot_token or "").split(":")[0]
+        # Limite rigido della coda: se è piena si scarta il messaggio non critico più vecchio
+        self.queue_size = queue_size
+        self.max_in_flight = max_in_flight
+        # Limiti Telegram: ~1 messaggio/s per chat, ~30 messaggi/s in totale
+        self.per_chat_interval = per_chat_interval
+        self.global_interval = global_interval
+        # I messaggi di progresso arrivano al massimo una volta ogni progress_interval per chat
+        self.progress_interval = progress_interval
+        self.session = None
+        # Coda dei messaggi da inviare, in ordine di arrivo: id -> [chat_ids, testo, chiave, critico].
+        # Un dizionario ordinato permette di scartare anche un messaggio in mezzo alla coda
+        self._pending = OrderedDict()
+        self._wakeup = None
+        self._ids = itertools.count()
+        self._task = None
+        self._in_flight = set()
+        self._chat_locks = {}
+        self._last_sent = {}
+        self._last_progress = {}
+        self._coalesced = {}
+        self._global_lock = None
+        self._global_last = 0.0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        metrics.gauge("telegram_queue_length", "Messaggi Telegram in coda", fn=lambda: len(self._pending), bot=self.name)
+        metrics.gauge("telegram_in_flight", "Invii Telegram in corso", fn=lambda: len(self._in_flight), bot=self.name)
+
+    def url(self, method):
+        return TELEGRAM_API.format(token=self.bot_token, method=method)
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60))
+        return self.session
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._pending.clear()
+            self._global_lock = asyncio.Lock()
+            self._coalesced.clear()
+            self._task = asyncio.create_task(self._sender(), name="telegram-sender")
+
+    def notify(self, text, chat_ids=None, coalesce_key=None, critical=False):
+        # Non blocca mai il chiamante: il messaggio finisce in coda e viene inviato in background.
+        # critical: fine ricarica, allarmi, scollegamenti; sono gli ultimi a essere scartati
+        self._ensure_started()
+        chat_ids = tuple(chat_ids or self.chat_ids)
+        if coalesce_key is not None:
+            now = time.monotonic()
+            chat_ids = tuple(c for c in chat_ids
+                             if now - self._last_progress.get((c, coalesce_key), float("-inf")) >= self.progress_interval)
+            if not chat_ids:
+                self.coalesced += 1
+                metrics.counter("telegram_messages_total", "Messaggi Telegram", outcome="accorpato").inc()
+                return
+            key = (chat_ids, coalesce_key)
+            if key in self._coalesced:
+                # Messaggio equivalente ancora in coda: aggiorno solo il testo
+                self._coalesced[key] = text
+                self.coalesced += 1
+                metrics.counter("telegram_messages_total", "Messaggi Telegram", outcome="accorpato").inc()
+                return
+            critical = False
+        else:
+            key = None
+
+        if len(self._pending) >= self.queue_size:
+            if not self._evict(critical):
+                self._drop("Coda Telegram piena di messaggi critici: scartato il nuovo messaggio")
+                return
+        if key is not None:
+            self._coalesced[key] = text
+            text = None
+        self._pending[next(self._ids)] = [chat_ids, text, key, critical]
+        self._wakeup.set()
+
+    def _evict(self, critical):
+        # Coda piena: si scarta il messaggio non critico più vecchio (progresso compreso).
+        # Se in coda ci sono solo messaggi critici, un nuovo messaggio critico prende il posto
+        # del critico più vecchio; uno non critico viene invece scartato (False)
+        victim = next((i for i, item in self._pending.items() if not item[3]), None)
+        if victim is None:
+            if not critical:
+                return False
+            victim = next(iter(self._pending))
+        chat_ids, text, key, was_critical = self._pending.pop(victim)
+        if key is not None:
+            self._coalesced.pop(key, None)
+        kind = "critico" if was_critical else "di progresso" if key is not None else "non critico"
+        self._drop(f"Coda Telegram piena: scartato il messaggio {kind} più vecchio")
+        return True
+
+    def _drop(self, reason):
+        self.dropped += 1
+        metrics.counter("telegram_messages_total", "Messaggi Telegram", outcome="scartato").inc()
+        logger.warning(reason)
+
+    async def _sender(self):
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            _, (chat_ids, text, key, _) = self._pending.popitem(last=False)
+            if key is not None:
+                text = self._coalesced.pop(key)
+                now = time.monotonic()
+                for chat_id in chat_ids:
+                    self._last_progress[(chat_id, key[1])] = now
+            for chat_id in chat_ids:
+                await in_flight.acquire()
+                task = asyncio.create_task(self._deliver(chat_id, text))
+                self._in_flight.add(task)
+                task.add_done_callback(lambda t: (self._in_flight.discard(t), in_flight.release()))
+
+    async def _throttle(self, chat_id):
+        wait = self._last_sent.get(chat_id, 0.0) + self.per_chat_interval - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        async with self._global_lock:
+            wait = self._global_last + self.global_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._global_last = time.monotonic()
+
+    async def _deliver(self, chat_id, text, reply_markup=None):
+        # Ritorna il messaggio inviato (con message_id) oppure None se l'invio è fallito
+        payload = {"chat_id": chat_id, "text": text}
+        if reply_markup is not None:
+            payload["reply_markup"] = reply_markup
+        lock = self._chat_locks.setdefault(chat_id, asyncio.Lock())
+        async with lock:
+            for attempt in range(2):  # max 2 tentativi
+                with metrics.timer("telegram_throttle_seconds", "Attesa per i limiti di frequenza Telegram"):
+                    await self._throttle(chat_id)
+                try:
+                    with metrics.timer("telegram_call_seconds", "Durata delle chiamate all'API Telegram",
+                                       method="sendMessage"):
+                        async with self.get_session().post(self.url("sendMessage"), json=payload,
+                                                           timeout=aiohttp.ClientTimeout(total=10)) as resp:
+                            if resp.status == 429:
+                                data = await resp.json()
+                                retry_after = data.get("parameters", {}).get("retry_after", 1)
+                                self._last_sent[chat_id] = time.monotonic() + retry_after
+                                metrics.counter("telegram_rate_limited_total", "Risposte 429 di Telegram").inc()
+                                raise RuntimeError(f"limite Telegram raggiunto, riprovo tra {retry_after} s")
+                            resp.raise_for_status()
+                            data = await resp.json()
+                    self._last_sent[chat_id] = time.monotonic()
+                    self.sent += 1
+                    metrics.counter("telegram_messages_total", "Messaggi Telegram", outcome="inviato").inc()
+                    logger.info(f"Messaggio Telegram inviato: {text[:30]}...")
+                    return data.get("result") or {}
+                except Exception as e:
+                    logger.warning(f"Invio Telegram fallito (tentativo {attempt+1}): {e}")
+                    metrics.counter("telegram_send_retries_total", "Tentativi di invio falliti").inc()
+                    self._last_sent[chat_id] = max(self._last_sent.get(chat_id, 0.0), time.monotonic())
+            self.failed += 1
+            metrics.counter("telegram_messages_total", "Messaggi Telegram", outcome="fallito").inc()
+            return None
+
+    async def send(self, text, chat_ids=None, reply_markup=None):
+        # Invio diretto (stessi limiti di frequenza della coda) quando serve il message_id,
+        # es. per le domande a cui l'utente risponde: [(chat_id, message_id)] dei messaggi inviati
+        self._ensure_started()
+        chat_ids = tuple(chat_ids or self.chat_ids)
+        results = await asyncio.gather(*(self._deliver(c, text, reply_markup) for c in chat_ids))
+        return [(str(c), r.get("message_id")) for c, r in zip(chat_ids, results) if r is not None]
+
+    async def flush(self, timeout=10):
+        if self._task is None:
+            return
+        deadline = time.monotonic() + timeout
+        while (self._pending or self._in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    async def close(self, timeout=10):
+        await self.flush(timeout)
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for task in list(self._in_flight):
+            task.cancel()
+        await asyncio.gather(*self._in_flight, return_exceptions=True)
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def stats(self):
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "queued": len(self._pending),
+        }
+
+
+# Un notifier per bot, condiviso da tutti gli EVCharger del processo
+_notifiers = {}
+
+
+def get_notifier(bot_token, chat_ids):
+    if bot_token not in _notifiers:
+        _notifiers[bot_token] = TelegramNotifier(bot_token, chat_ids)
+    else:
+        notifier = _notifiers[bot_token]
+        notifier.chat_ids.extend(c for c in chat_ids if c and c not in notifier.chat_ids)
+    return _notifiers[bot_token]
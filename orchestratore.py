@@ -0,0 +1,210 @@
+import os
+import sys
+import json
+import asyncio
+import logging
+import aiohttp
+from dotenv import load_dotenv
+from archivio_sessioni import open_store
+from ricarica import EVCharger
+from rilevamento import fit_schedulers, PlugTriggerWebhook
+from curva_ricarica import fit_charge_curves
+from analitica_batteria import fit_health_trackers
+from colonnare import ColumnarSessionStore, DEFAULT_COLUMNAR_PATH
+from sincronizzazione import open_mongo_sync, DEFAULT_DATABASE, DEFAULT_COLLECTION
+from pianificazione import load_price_schedule, open_price_schedule
+from potenza import PowerBudget
+from metriche import open_metrics_exporter
+from stato_ricarica import open_state_store
+from autenticazione import RenaultAuth
+from scrittura import writer
+
+logger = logging.getLogger(__name__)
+
+# Esempio di configurazione (flotta.json):
+# {
+#     "session_store": "charging_data.jsonl",
+#     "columnar_store": "charging_data.col",
+#     "mongo": {"uri_env": "MONGO_URI", "database": "Renault_Dati", "collection": "charging_data"},
+#     "price_file": "tariffa.json",
+#     "power_cap_kw": 3.0,
+#     "webhook_port": 8089,
+#     "metrics_port": 9108,
+#     "metrics_file": "metriche.json",
+#     "state_dir": "stato_ricarica",
+#     "accounts": [
+#         {
+#             "email": "utente@example.com",
+#             "password_env": "RENAULT_PASSWORD",
+#             "vehicles": [
+#                 {"vin": "VF1AAAAA555777999", "plug_ip": "192.168.1.50", "departure": "07:30", "name": "zoe"},
+#                 {"vin": "VF1BBBBB555777888", "plug_ip": "192.168.1.51"}
+#             ]
+#         }
+#     ]
+# }
+
+
+def load_fleet_config(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    for account in config.get("accounts", []):
+        if "password" not in account and "password_env" in account:
+            account["password"] = os.getenv(account["password_env"])
+        if not account.get("email") or not account.get("password"):
+            raise ValueError("Errore: credenziali Renault mancanti in un account della flotta.")
+        for vehicle in account.get("vehicles", []):
+            if not vehicle.get("vin") or not vehicle.get("plug_ip"):
+                raise ValueError("Errore: ogni veicolo deve avere 'vin' e 'plug_ip'.")
+    return config
+
+
+class FleetOrchestrator:
+    def __init__(self, config, charger_factory=EVCharger, restart_delay=60):
+        load_dotenv()
+        self.config = config
+        self.charger_factory = charger_factory
+        self.restart_delay = restart_delay
+        self.session_store = open_store(config.get("session_store", os.getenv('SESSION_STORE_PATH', 'charging_data.jsonl')))
+        columnar_path = config.get("columnar_store", os.getenv('COLUMNAR_STORE_PATH', DEFAULT_COLUMNAR_PATH))
+        self.columnar_store = ColumnarSessionStore(columnar_path) if columnar_path else None
+        # Un solo client MongoDB (e una sola coda locale) per tutta la flotta
+        mongo_cfg = config.get("mongo", {})
+        mongo_uri = os.getenv(mongo_cfg.get("uri_env", "MONGO_URI"))
+        self.mongo_sync = open_mongo_sync(
+            mongo_uri,
+            mongo_cfg.get("database", os.getenv('MONGO_DB', DEFAULT_DATABASE)),
+            mongo_cfg.get("collection", os.getenv('MONGO_COLLECTION', DEFAULT_COLLECTION)),
+        ) if mongo_uri else None
+        # Stessa tariffa per tutti i veicoli del sito
+        self.price_schedule = load_price_schedule(config["price_file"]) if config.get("price_file") else open_price_schedule()
+        # Un solo limite di potenza per il contatore del sito: le prese se lo contendono
+        power_cap = config.get("power_cap_kw", os.getenv('POWER_CAP_KW'))
+        self.power_budget = PowerBudget(float(power_cap)) if power_cap else None
+        self.websessions = []
+        self.auths = []
+        self.chargers = []
+        self.tasks = []
+        self.webhook = None
+        self.exporter = open_metrics_exporter(config.get("metrics_port"), config.get("metrics_file"))
+        # Un file di stato per veicolo nella stessa directory; "" disattiva la ripresa dopo un riavvio
+        self.charge_state = open_state_store(config.get("state_dir"))
+
+    async def _login_account(self, account_cfg):
+        # Un solo login e una sola websession per account, condivisi da tutti i suoi veicoli;
+        # a caldo token e veicoli arrivano dalla cache senza chiamate
+        websession = aiohttp.ClientSession()
+        self.websessions.append(websession)
+        auth = RenaultAuth(websession, account_cfg["email"], account_cfg["password"])
+        self.auths.append(auth)
+        _, vins, _ = await auth.discover()
+        return auth, set(vins)
+
+    async def setup(self):
+        for account_cfg in self.config.get("accounts", []):
+            auth, vins = await self._login_account(account_cfg)
+            for vehicle_cfg in account_cfg.get("vehicles", []):
+                vin = vehicle_cfg["vin"]
+                if vin not in vins:
+                    # Forse aggiunto dopo l'ultima discovery in cache
+                    _, fresh, _ = await auth.discover(force=True)
+                    vins = set(fresh)
+                if vin not in vins:
+                    logger.error(f"Veicolo {vin} non presente nell'account {account_cfg['email']}, ignorato")
+                    continue
+                charger = self.charger_factory(
+                    vin=vin,
+                    smart_plug_ip=vehicle_cfg["plug_ip"],
+                    renault_email=account_cfg["email"],
+                    renault_password=account_cfg["password"],
+                    tapo_email=vehicle_cfg.get("tapo_email"),
+                    tapo_password=vehicle_cfg.get("tapo_password"),
+                    session_store=self.session_store,
+                    columnar_store=self.columnar_store,
+                    mongo_sync=self.mongo_sync,
+                    price_schedule=self.price_schedule,
+                    departure=vehicle_cfg.get("departure"),
+                    power_budget=self.power_budget,
+                    charge_state=self.charge_state,
+                    name=vehicle_cfg.get("name"),
+                )
+                charger.account_id, charger.vehicle = await auth.get_vehicle(vin)
+                charger.renault_auth = auth
+                self.chargers.append(charger)
+        history = self.session_store.read_all()
+        vins = [c.vin for c in self.chargers]
+        schedulers = fit_schedulers(history, vins)
+        curves = fit_charge_curves(history, vins)
+        trackers = fit_health_trackers(history, vins)
+        for charger in self.chargers:
+            charger.plug_scheduler = schedulers[charger.vin]
+            charger.charge_curve = curves[charger.vin]
+            charger.health_tracker = trackers[charger.vin]
+        if self.config.get("webhook_port"):
+            self.webhook = PlugTriggerWebhook(self.chargers, port=self.config["webhook_port"])
+            await self.webhook.start()
+        if self.exporter is not None:
+            await self.exporter.start()
+        for auth in self.auths:
+            auth.start()
+        logger.info(f"Flotta pronta: {len(self.chargers)} veicoli")
+
+    async def _supervise(self, charger):
+        # Ogni coppia (veicolo, presa) è un task indipendente: un errore non ferma gli altri
+        while True:
+            try:
+                await charger.monitor_plug_status()
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Veicolo {charger.vin}: monitoraggio interrotto ({e}), riavvio tra {self.restart_delay} s")
+                if charger.charging_active:
+                    await charger.stop_charging()
+                await asyncio.sleep(self.restart_delay)
+
+    async def run(self):
+        self.tasks = [
+            asyncio.create_task(self._supervise(charger), name=f"charger-{charger.vin}")
+            for charger in self.chargers
+        ]
+        await asyncio.gather(*self.tasks)
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        for auth in self.auths:
+            await auth.close()
+        if self.webhook is not None:
+            await self.webhook.close()
+        if self.exporter is not None:
+            await self.exporter.close()
+        for websession in self.websessions:
+            await websession.close()
+        # Un dispatcher Telegram per bot: fermato prima del notifier che usa
+        for dispatcher in {id(c.dispatcher): c.dispatcher for c in self.chargers if c.dispatcher}.values():
+            await dispatcher.close()
+        for notifier in {id(c.notifier): c.notifier for c in self.chargers}.values():
+            await notifier.close()
+        # L'archivio si chiude solo dopo le scritture ancora in coda
+        await asyncio.to_thread(writer.flush, 10)
+        self.session_store.close()
+
+
+if __name__ == "__main__":
+    async def main(config_path):
+        orchestrator = FleetOrchestrator(load_fleet_config(config_path))
+        try:
+            await orchestrator.setup()
+            await orchestrator.run()
+        finally:
+            await orchestrator.close()
+            logger.info("Orchestratore terminato")
+
+    if sys.platform.startswith("win"):
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    try:
+        asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else "flotta.json"))
+    except Exception as e:
+        logger.error(f"Errore durante l'esecuzione dell'orchestratore: {e}")
@@ -0,0 +1,193 @@
+import os
+import csv
+import json
+import logging
+from datetime import datetime, time as dt_time, timedelta
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SLOT_MINUTES = 15
+DEFAULT_POWER_KW = 1.35   # presa domestica, come in charge_loop
+DEFAULT_MARGIN = 1.1      # tempo in più rispetto alla curva appresa, per arrivare al target in ogni caso
+US = 1_000_000
+
+
+def _us(value):
+    return int(np.datetime64(value, "us").astype(np.int64))
+
+
+def _dt(us):
+    return np.datetime64(int(us), "us").astype(datetime)
+
+
+# === PREZZI ===
+class PriceSchedule:
+    # Prezzo dell'energia (€/kWh) a slot fissi. Sottoclassi: serie storica da file
+    # oppure tariffa settimanale a fasce
+    slot_minutes = SLOT_MINUTES
+
+    def prices_at(self, slot_starts_us):
+        raise NotImplementedError
+
+    def window(self, start, end):
+        # Segmenti tra start ed end allineati agli slot (il primo e l'ultimo possono
+        # essere parziali): (inizio in µs, durata in secondi, prezzo)
+        slot_us = self.slot_minutes * 60 * US
+        start_us, end_us = _us(start), _us(end)
+        if end_us <= start_us:
+            empty = np.empty(0)
+            return empty.astype(np.int64), empty, empty
+        first = start_us - start_us % slot_us
+        grid = np.arange(first, end_us, slot_us, dtype=np.int64)
+        seg_start = np.maximum(grid, start_us)
+        seg_end = np.minimum(grid + slot_us, end_us)
+        return seg_start, (seg_end - seg_start) / US, self.prices_at(grid)
+
+
+class TimeSeriesPrices(PriceSchedule):
+    # Prezzi orari o quartorari (es. PUN esportato in CSV "timestamp,price");
+    # oltre la fine della serie ripeto l'ultima settimana disponibile
+    def __init__(self, timestamps, prices, slot_minutes=SLOT_MINUTES):
+        order = np.argsort(timestamps)
+        self.times_us = np.asarray(timestamps, dtype=np.int64)[order]
+        self.prices = np.asarray(prices, dtype=np.float64)[order]
+        self.slot_minutes = slot_minutes
+
+    def prices_at(self, slot_starts_us):
+        slot_starts_us = np.asarray(slot_starts_us, dtype=np.int64)
+        week_us = 7 * 86400 * US
+        last = self.times_us[-1]
+        shifted = np.where(slot_starts_us > last,
+                           slot_starts_us - ((slot_starts_us - last) // week_us + 1) * week_us,
+                           slot_starts_us)
+        idx = np.clip(np.searchsorted(self.times_us, shifted, "right") - 1, 0, len(self.prices) - 1)
+        return self.prices[idx]
+
+
+# Fasce orarie ARERA: F1 lun-ven 8-19, F2 lun-ven 7-8 e 19-23 e sabato 7-23, F3 il resto
+class BandTariff(PriceSchedule):
+    def __init__(self, f1, f2, f3, slot_minutes=SLOT_MINUTES):
+        self.band_prices = np.array([f1, f2, f3], dtype=np.float64)
+        self.slot_minutes = slot_minutes
+
+    def prices_at(self, slot_starts_us):
+        minutes = np.asarray(slot_starts_us, dtype=np.int64) // (60 * US)
+        hour = (minutes // 60) % 24
+        weekday = (minutes // 1440 + 3) % 7  # 1970-01-01 era giovedì; 0 = lunedì
+        workday = weekday < 5
+        f1 = workday & (hour >= 8) & (hour < 19)
+        f2 = (workday & ((hour == 7) | ((hour >= 19) & (hour < 23)))) | ((weekday == 5) & (hour >= 7) & (hour < 23))
+        band = np.where(f1, 0, np.where(f2, 1, 2))
+        return self.band_prices[band]
+
+
+def load_price_schedule(path):
+    # .csv: righe "timestamp,price" (intestazione facoltativa)
+    # .json: {"F1": 0.32, "F2": 0.29, "F3": 0.25} oppure {"slot_minutes": 60, "prices": [[timestamp, price], ...]}
+    if path.endswith(".csv"):
+        times, prices = [], []
+        with open(path, "r", encoding="utf-8") as f:
+            for row in csv.reader(f):
+                try:
+                    times.append(_us(datetime.fromisoformat(row[0].strip())))
+                    prices.append(float(row[1]))
+                except (IndexError, ValueError):
+                    continue  # intestazione o riga non valida
+        if not times:
+            raise ValueError(f"Nessun prezzo valido in {path}")
+        slot = int(np.median(np.diff(sorted(times)))) // (60 * US) if len(times) > 1 else SLOT_MINUTES
+        return TimeSeriesPrices(times, prices, slot_minutes=max(1, slot))
+    with open(path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    if "prices" in config:
+        times = [_us(datetime.fromisoformat(t)) for t, _ in config["prices"]]
+        return TimeSeriesPrices(times, [p for _, p in config["prices"]],
+                                slot_minutes=config.get("slot_minutes", SLOT_MINUTES))
+    return BandTariff(config["F1"], config["F2"], config["F3"], slot_minutes=config.get("slot_minutes", SLOT_MINUTES))
+
+
+def next_departure(now, departure):
+    # departure: "HH:MM" (ogni giorno) oppure datetime; ritorna la prossima partenza dopo now
+    if isinstance(departure, datetime):
+        return departure
+    hour, minute = (int(x) for x in departure.split(":"))
+    candidate = datetime.combine(now.date(), dt_time(hour, minute))
+    return candidate if candidate > now else candidate + timedelta(days=1)
+
+
+# === PIANO DI RICARICA ===
+class ChargePlan:
+    def __init__(self, intervals, cost, immediate_cost, needed_s, feasible):
+        self.intervals = intervals          # [(inizio, fine)] datetime, in ordine
+        self.cost = cost                    # € con il piano
+        self.immediate_cost = immediate_cost  # € ricaricando subito
+        self.needed_s = needed_s
+        self.feasible = feasible            # False se non c'è tempo prima della partenza
+
+    def starts_now(self, now, tolerance_s=60):
+        return bool(self.intervals) and (self.intervals[0][0] - now).total_seconds() <= tolerance_s
+
+    def describe(self):
+        windows = ", ".join(f"{s:%H:%M}–{e:%H:%M}" for s, e in self.intervals)
+        text = f"💶 Ricarica pianificata: {windows} (circa {self.cost:.2f} € invece di {self.immediate_cost:.2f} € subito)"
+        if not self.feasible:
+            text += " ⚠️ Tempo insufficiente prima della partenza: ricarico il più possibile"
+        return text
+
+
+def cheapest_segments(durations, prices, needed_s):
+    # Scelta ottima (zaino frazionario): gli slot più economici fino a coprire needed_s;
+    # a parità di prezzo preferisco quelli prima. Ritorna i secondi usati per segmento
+    order = np.argsort(prices, kind="stable")
+    cumulative = np.cumsum(durations[order])
+    used = np.zeros(len(durations))
+    k = int(np.searchsorted(cumulative, needed_s, "left"))
+    if k >= len(order):
+        used[:] = durations
+        return used
+    used[order[:k]] = durations[order[:k]]
+    used[order[k]] = needed_s - (cumulative[k - 1] if k else 0.0)
+    return used
+
+
+def plan_charging(schedule, curve, soc, target, start, departure, power_kw=DEFAULT_POWER_KW, margin=DEFAULT_MARGIN):
+    # curve: ChargeCurveModel appreso dallo storico. La durata necessaria dipende solo dal
+    # SoC, non da quando si ricarica, quindi il costo minimo si ottiene con gli slot più
+    # economici prima della partenza
+    needed_s = curve.seconds_between(soc, target) * margin
+    seg_start, durations, prices = schedule.window(start, departure)
+    feasible = durations.sum() >= needed_s
+    used = cheapest_segments(durations, prices, needed_s)
+    immediate = cheapest_segments(durations, np.arange(len(durations), dtype=np.float64), needed_s)
+    kwh_per_s = power_kw / 3600
+
+    intervals = []
+    seg_end = seg_start + np.round(durations * US).astype(np.int64)
+    # Pezzi di slot sotto il minuto non valgono un'accensione della presa
+    for i in np.flatnonzero(used >= 60):
+        begin = int(seg_start[i])
+        end = begin + int(round(used[i] * US))
+        # Slot usato in parte: a ridosso dello slot successivo se anche quello è nel piano
+        # (una sola accensione), altrimenti all'inizio, di seguito a quello precedente
+        if (used[i] < durations[i] and i + 1 < len(used) and used[i + 1] >= 60
+                and seg_start[i + 1] == seg_end[i] and not (intervals and intervals[-1][1] == begin)):
+            begin, end = int(seg_end[i]) - (end - begin), int(seg_end[i])
+        if intervals and intervals[-1][1] == begin:
+            intervals[-1][1] = end
+        else:
+            intervals.append([begin, end])
+    return ChargePlan(
+        [(_dt(s), _dt(e)) for s, e in intervals],
+        cost=float((used * prices).sum() * kwh_per_s),
+        immediate_cost=float((immediate * prices).sum() * kwh_per_s),
+        needed_s=needed_s,
+        feasible=bool(feasible),
+    )
+
+
+def open_price_schedule():
+    # PRICE_FILE non impostato: nessuna pianificazione, si ricarica subito
+    path = os.getenv('PRICE_FILE')
+    return load_price_schedule(path) if path else None
@@ -0,0 +1,262 @@
+import logging
+import asyncio
+import time
+from metriche import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PLUG_KW = 1.35   # assorbimento tipico della presa con la Spring
+MIN_RUN_S = 900          # una sessione ammessa non viene sospesa prima di 15 minuti
+HYSTERESIS = 1.2         # per sospendere serve un'urgenza almeno del 20% più alta
+
+
+def urgency(needed_s, seconds_left):
+    # Frazione del tempo rimasto prima della partenza che serve per arrivare al target:
+    # oltre 1 il target non è più raggiungibile
+    return needed_s / max(seconds_left, 60.0)
+
+
+class PowerLease:
+    __slots__ = ("key", "urgency", "expected_kw", "measured_kw", "seq", "granted", "granted_at", "revoked")
+
+    def __init__(self, key, urgency, expected_kw, seq):
+        self.key = key
+        self.urgency = urgency
+        self.expected_kw = expected_kw
+        self.measured_kw = None
+        self.seq = seq
+        self.granted = asyncio.get_running_loop().create_future()
+        self.granted_at = None
+        self.revoked = False
+
+    @property
+    def kw(self):
+        # Potenza riservata: la prevista, o la misurata (P110) se più alta. Una lettura bassa
+        # (es. a inizio ricarica) non libera potenza che la presa può tornare ad assorbire
+        if self.measured_kw is None:
+            return self.expected_kw
+        return max(self.expected_kw, self.measured_kw)
+
+
+class _IndexedHeap:
+    # Heap binario che conosce la posizione di ogni chiave: cambi di priorità e rimozioni
+    # in O(log n) nel caso peggiore, senza voci obsolete da scartare né ricostruzioni
+    def __init__(self):
+        self._items = []  # [(priorità, chiave)], la priorità minima in cima
+        self._pos = {}
+
+    def __len__(self):
+        return len(self._items)
+
+    def top(self):
+        return self._items[0][1] if self._items else None
+
+    def push(self, key, priority):
+        # Inserisce la chiave o ne aggiorna la priorità
+        i = self._pos.get(key)
+        if i is None:
+            i = len(self._items)
+            self._items.append((priority, key))
+            self._pos[key] = i
+            self._up(i)
+            return
+        old = self._items[i][0]
+        self._items[i] = (priority, key)
+        self._up(i) if priority < old else self._down(i)
+
+    def remove(self, key):
+        i = self._pos.pop(key, None)
+        if i is None:
+            return
+        last = self._items.pop()
+        if i < len(self._items):
+            self._items[i] = last
+            self._pos[last[1]] = i
+            self._up(i)
+            self._down(self._pos[last[1]])
+
+    def _swap(self, i, j):
+        items = self._items
+        items[i], items[j] = items[j], items[i]
+        self._pos[items[i][1]] = i
+        self._pos[items[j][1]] = j
+
+    def _up(self, i):
+        items = self._items
+        while i > 0:
+            parent = (i - 1) // 2
+            if not items[i][0] < items[parent][0]:
+                return
+            self._swap(i, parent)
+            i = parent
+
+    def _down(self, i):
+        items = self._items
+        n = len(items)
+        while True:
+            child = 2 * i + 1
+            if child >= n:
+                return
+            if child + 1 < n and items[child + 1][0] < items[child][0]:
+                child += 1
+            if not items[child][0] < items[i][0]:
+                return
+            self._swap(i, child)
+            i = child
+
+
+class PowerBudget:
+    # Limite di potenza del contatore condiviso da tutte le prese del sito. Le richieste
+    # che non entrano nel limite restano in coda per urgenza; se in coda c'è un veicolo
+    # molto più urgente di uno in carica, quest'ultimo viene sospeso (rotazione). Se la
+    # potenza misurata porta il carico oltre il limite si sospendono le meno urgenti.
+    # Code e sessioni attive sono heap indicizzati: ogni decisione è O(log n) anche nel caso peggiore.
+    def __init__(self, cap_kw, min_run_s=MIN_RUN_S, hysteresis=HYSTERESIS):
+        self.cap_kw = cap_kw
+        self.min_run_s = min_run_s
+        self.hysteresis = hysteresis
+        self.active = {}
+        self.waiting = {}
+        self._active_heap = _IndexedHeap()   # (urgenza, seq): la meno urgente in cima, sospese escluse
+        self._waiting_heap = _IndexedHeap()  # (-urgenza, seq): la più urgente in cima
+        self._seq = 0
+        self.load_kw = 0.0
+        self.revoked_kw = 0.0    # potenza delle sessioni sospese che non hanno ancora spento la presa
+        self.decisions = 0
+        self.decision_s = 0.0
+        self.max_decision_s = 0.0
+        self.preemptions = 0
+        self.sheds = 0
+        metrics.gauge("power_budget_load_kw", "Potenza impegnata dalle prese in carica", fn=lambda: self.load_kw)
+        metrics.gauge("power_budget_cap_kw", "Limite di potenza del sito", fn=lambda: self.cap_kw)
+        metrics.gauge("power_budget_waiting", "Veicoli in coda per il limite di potenza", fn=lambda: len(self.waiting))
+        metrics.gauge("power_budget_preemptions", "Ricariche sospese a favore di veicoli più urgenti",
+                      fn=lambda: self.preemptions)
+
+    def _next_seq(self):
+        self._seq += 1
+        return self._seq
+
+    def _clock(self):
+        return asyncio.get_running_loop().time()
+
+    # === API PER GLI EVCHARGER ===
+    def request(self, key, urgency, expected_kw=DEFAULT_PLUG_KW):
+        started = time.perf_counter()
+        lease = self.active.get(key) or self.waiting.get(key)
+        if lease is None:
+            lease = PowerLease(key, urgency, expected_kw, self._next_seq())
+            self.waiting[key] = lease
+            self._waiting_heap.push(key, (-urgency, lease.seq))
+        self._rebalance()
+        self._record(started)
+        return lease
+
+    def release(self, key):
+        started = time.perf_counter()
+        lease = self.active.pop(key, None)
+        if lease is not None:
+            self._active_heap.remove(key)
+            self.load_kw -= lease.kw
+            if lease.revoked:
+                self.revoked_kw -= lease.kw
+        else:
+            lease = self.waiting.pop(key, None)
+            self._waiting_heap.remove(key)
+            if lease is not None and not lease.granted.done():
+                lease.granted.cancel()
+        self._rebalance()
+        self._record(started)
+
+    def update(self, key, urgency=None, measured_kw=None):
+        started = time.perf_counter()
+        lease = self.active.get(key) or self.waiting.get(key)
+        if lease is None:
+            return
+        if measured_kw is not None and key in self.active:
+            previous_kw = lease.kw
+            lease.measured_kw = measured_kw
+            self.load_kw += lease.kw - previous_kw
+            if lease.revoked:
+                self.revoked_kw += lease.kw - previous_kw
+        if urgency is not None and urgency != lease.urgency:
+            lease.urgency = urgency
+            lease.seq = self._next_seq()
+            if key in self.active:
+                if not lease.revoked:
+                    self._active_heap.push(key, (urgency, lease.seq))
+            else:
+                self._waiting_heap.push(key, (-urgency, lease.seq))
+        self._shed()
+        self._rebalance()
+        self._record(started)
+
+    # === ALLOCAZIONE ===
+    def _rebalance(self):
+        while True:
+            key = self._waiting_heap.top()
+            if key is None:
+                return
+            candidate = self.waiting[key]
+            # Una presa sola oltre il limite viene comunque ammessa se il sito è vuoto
+            if self.load_kw + candidate.expected_kw <= self.cap_kw + 1e-9 or not self.active:
+                self._waiting_heap.remove(key)
+                del self.waiting[key]
+                self.active[candidate.key] = candidate
+                self.load_kw += candidate.kw
+                candidate.granted_at = self._clock()
+                self._active_heap.push(key, (candidate.urgency, candidate.seq))
+                if not candidate.granted.done():
+                    candidate.granted.set_result(True)
+                continue
+            self._rotate(candidate)
+            return
+
+    def _shed(self):
+        # Potenza misurata risalita oltre il limite: sospendo le sessioni meno urgenti finché
+        # il carico rientra, senza isteresi né durata minima (il limite del contatore è fisso).
+        # Come all'ammissione, una sessione sola resta comunque attiva
+        while self.load_kw - self.revoked_kw > self.cap_kw + 1e-9 and len(self._active_heap) > 1:
+            victim = self.active[self._active_heap.top()]
+            self._revoke(victim)
+            self.sheds += 1
+            logger.info(f"Limite di potenza superato ({self.load_kw - self.revoked_kw + victim.kw:.1f} kW): "
+                        f"sospendo {victim.key} (urgenza {victim.urgency:.2f})")
+
+    def _revoke(self, lease):
+        # La potenza resta impegnata finché il veicolo sospeso non spegne la presa (release)
+        lease.revoked = True
+        self._active_heap.remove(lease.key)
+        self.revoked_kw += lease.kw
+
+    def _rotate(self, candidate):
+        if self.load_kw - self.revoked_kw + candidate.expected_kw <= self.cap_kw + 1e-9:
+            return  # le sospensioni già decise bastano: si aspetta che le prese si spengano
+        key = self._active_heap.top()
+        victim = self.active[key] if key is not None else None
+        if victim is None or candidate.urgency < victim.urgency * self.hysteresis:
+            return
+        if self._clock() - victim.granted_at < self.min_run_s:
+            return
+        self._revoke(victim)
+        self.preemptions += 1
+        logger.info(f"Limite di potenza: sospendo {victim.key} (urgenza {victim.urgency:.2f}) "
+                    f"a favore di {candidate.key} ({candidate.urgency:.2f})")
+
+    def _record(self, started):
+        elapsed = time.perf_counter() - started
+        self.decisions += 1
+        self.decision_s += elapsed
+        self.max_decision_s = max(self.max_decision_s, elapsed)
+
+    def stats(self):
+        return {
+            "cap_kw": self.cap_kw,
+            "load_kw": round(self.load_kw, 2),
+            "active": len(self.active),
+            "waiting": len(self.waiting),
+            "preemptions": self.preemptions,
+            "sheds": self.sheds,
+            "decision_avg_us": round(self.decision_s / self.decisions * 1e6, 1) if self.decisions else None,
+            "decision_max_us": round(self.max_decision_s * 1e6, 1),
+        }
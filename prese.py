@@ -0,0 +1,126 @@
+import time
+import asyncio
+import logging
+from tapo import ApiClient
+from metriche import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class PlugPool:
+    def __init__(self, tapo_email, tapo_password, state_ttl=300, client_factory=ApiClient, model="p100"):
+        self.tapo_email = tapo_email
+        self.tapo_password = tapo_password
+        # "p110" per le prese con misura di energia (potenza reale per il limite del sito)
+        self.model = model
+        # Oltre questo tempo lo stato noto della presa non basta per saltare un comando
+        # (qualcuno potrebbe averla accesa o spenta dall'app Tapo)
+        self.state_ttl = state_ttl
+        self.client_factory = client_factory
+        self._handles = {}
+        self._locks = {}
+        self._states = {}
+        self.handshakes = 0
+        self.handshake_total_s = 0.0
+        self.handshake_max_s = 0.0
+        self.writes = 0
+        self.skipped_writes = 0
+        self.reconnects = 0
+
+    def _lock(self, ip):
+        if ip not in self._locks:
+            self._locks[ip] = asyncio.Lock()
+        return self._locks[ip]
+
+    async def _connect(self, ip):
+        start = time.perf_counter()
+        client = self.client_factory(self.tapo_email, self.tapo_password)
+        handle = await getattr(client, self.model)(ip)
+        elapsed = time.perf_counter() - start
+        self.handshakes += 1
+        self.handshake_total_s += elapsed
+        self.handshake_max_s = max(self.handshake_max_s, elapsed)
+        metrics.histogram("tapo_handshake_seconds", "Durata degli handshake con le prese Tapo").observe(elapsed)
+        logger.info(f"Handshake Tapo con {ip} completato in {elapsed*1000:.0f} ms")
+        return handle
+
+    async def _handle(self, ip):
+        handle = self._handles.get(ip)
+        if handle is None:
+            handle = await self._connect(ip)
+            self._handles[ip] = handle
+        return handle
+
+    def invalidate(self, ip):
+        self._handles.pop(ip, None)
+        self._states.pop(ip, None)
+
+    def known_state(self, ip):
+        entry = self._states.get(ip)
+        if entry is None or asyncio.get_running_loop().time() - entry[1] > self.state_ttl:
+            return None
+        return entry[0]
+
+    async def _call(self, ip, op, action):
+        # Un solo tentativo di riconnessione: se la sessione è scaduta
+        # l'handle viene scartato e rifatto l'handshake
+        for attempt in range(2):
+            handle = await self._handle(ip)
+            try:
+                with metrics.timer("tapo_call_seconds", "Durata dei comandi alle prese Tapo", op=op):
+                    return await action(handle)
+            except Exception as e:
+                self.invalidate(ip)
+                metrics.counter("tapo_call_errors_total", "Comandi Tapo falliti", op=op).inc()
+                if attempt == 1:
+                    raise
+                self.reconnects += 1
+                logger.warning(f"Sessione Tapo con {ip} non valida ({e}), riconnessione")
+
+    async def set_state(self, ip, on):
+        async with self._lock(ip):
+            if self.known_state(ip) == on:
+                self.skipped_writes += 1
+                metrics.counter("tapo_skipped_writes_total", "Comandi saltati perché la presa era già nello stato richiesto").inc()
+                logger.debug(f"Presa {ip} già {'accesa' if on else 'spenta'}, comando saltato")
+                return False
+            await self._call(ip, "on" if on else "off", lambda handle: handle.on() if on else handle.off())
+            self.writes += 1
+            self._states[ip] = (on, asyncio.get_running_loop().time())
+            return True
+
+    async def is_on(self, ip):
+        async with self._lock(ip):
+            info = await self._call(ip, "get_device_info", lambda handle: handle.get_device_info())
+            self._states[ip] = (info.device_on, asyncio.get_running_loop().time())
+            return info.device_on
+
+    async def current_power(self, ip):
+        # Potenza assorbita in kW, None se la presa non la misura (P100)
+        async with self._lock(ip):
+            handle = await self._handle(ip)
+            if not hasattr(handle, "get_current_power"):
+                return None
+            result = await self._call(ip, "get_current_power", lambda handle: handle.get_current_power())
+            return result.current_power / 1000
+
+    def stats(self):
+        return {
+            "handshakes": self.handshakes,
+            "handshake_avg_ms": round(self.handshake_total_s / self.handshakes * 1000, 1) if self.handshakes else None,
+            "handshake_max_ms": round(self.handshake_max_s * 1000, 1),
+            "writes": self.writes,
+            "skipped_writes": self.skipped_writes,
+            "reconnects": self.reconnects,
+        }
+
+
+# Un pool per credenziali Tapo, condiviso da tutti gli EVCharger del processo
+_pools = {}
+
+
+def get_plug_pool(tapo_email, tapo_password, model="p100"):
+    key = (tapo_email, tapo_password, model)
+    if key not in _pools:
+        _pools[key] = PlugPool(tapo_email, tapo_password, model=model)
+    return _pools[key]
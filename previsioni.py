@@ -0,0 +1,292 @@
+import os
+import json
+import time
+import logging
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from analitica_batteria import HEALTH_MIN, HEALTH_MAX, health_percent
+
+logger = logging.getLogger(__name__)
+
+METRICS = ["battery_health_estimate", "energy_measured", "battery_autonomy"]
+ORDER = (2, 0, 2)         # come nel notebook di analisi
+HORIZON_DAYS = 30
+HISTORY_DAYS = 730        # le serie più lunghe vengono troncate agli ultimi due anni
+MIN_DAYS = 21             # sotto questa lunghezza ARIMA(2,0,2) non è stimabile in modo sensato
+BUDGET_S = 2.0            # tempo massimo di stima per singolo modello
+COLD_MAXITER = 50
+WARM_MAXITER = 20
+DAY_US = 86_400_000_000
+
+DEFAULT_CACHE_PATH = "previsioni_cache.json"
+DEFAULT_OUTPUT_PATH = "previsioni.npz"
+
+
+# === SERIE GIORNALIERE ===
+def daily_series(start_us, values, history_days=HISTORY_DAYS):
+    # Media giornaliera (più ricariche nello stesso giorno) e interpolazione
+    # lineare dei giorni senza ricariche, come nel notebook
+    values = np.asarray(values, dtype=np.float64)
+    valid = np.isfinite(values)
+    if not valid.any():
+        return None, np.empty(0)
+    days = np.asarray(start_us, dtype=np.int64)[valid] // DAY_US
+    values = values[valid]
+    first = max(int(days.min()), int(days.max()) - history_days + 1)
+    keep = days >= first
+    days, values = days[keep] - first, values[keep]
+    unique, inverse = np.unique(days, return_inverse=True)
+    means = np.bincount(inverse, weights=values) / np.bincount(inverse)
+    series = np.interp(np.arange(unique[-1] + 1), unique, means)
+    return first, series
+
+
+def collect_series(source):
+    # source: ColumnarSessionStore (lettura colonnare, veloce) oppure un iterabile di
+    # sessioni (SessionStore.iter_records, load_sessions). Ritorna, per (vin, metrica),
+    # (primo giorno, serie giornaliera, numero di sessioni, ultimo start_time in µs)
+    if hasattr(source, "read") and hasattr(source, "vin_names"):
+        data = source.read(columns=["vin", "start_time"] + METRICS)
+        vins = source.vin_names(data["vin"])
+        starts = data["start_time"]
+        columns = {m: data[m].astype(np.float64) for m in METRICS}
+        # Stesso filtro di health_percent (la copia colonnare è già in percentuale)
+        health = columns["battery_health_estimate"]
+        health[(health < HEALTH_MIN) | (health > HEALTH_MAX)] = np.nan
+    else:
+        records = source.iter_records() if hasattr(source, "iter_records") else source
+        vins, starts, columns = [], [], {m: [] for m in METRICS}
+        for record in records:
+            try:
+                start = np.datetime64(record["start_time"], "us").astype(np.int64)
+            except (KeyError, TypeError, ValueError):
+                continue
+            vins.append(record.get("vin") or "")
+            starts.append(start)
+            for m in METRICS:
+                value = health_percent(record.get(m)) if m == "battery_health_estimate" else record.get(m)
+                columns[m].append(np.nan if value is None else value)
+        vins = np.array(vins, dtype=object)
+        starts = np.array(starts, dtype=np.int64)
+        columns = {m: np.array(v, dtype=np.float64) for m, v in columns.items()}
+
+    series = {}
+    if len(starts) == 0:
+        return series
+    order = np.argsort(vins.astype(str), kind="stable")
+    sorted_vins = vins[order].astype(str)
+    bounds = np.flatnonzero(sorted_vins[1:] != sorted_vins[:-1]) + 1
+    for idx in np.split(order, bounds):
+        vin = str(vins[idx[0]])
+        for m in METRICS:
+            values = columns[m][idx]
+            valid = np.isfinite(values)
+            if not valid.any():
+                continue
+            first, daily = daily_series(starts[idx], values)
+            series[(vin, m)] = (first, daily, int(valid.sum()), int(starts[idx][valid].max()))
+    return series
+
+
+# === STIMA DI UN MODELLO (processo worker) ===
+class _BudgetExceeded(Exception):
+    pass
+
+
+def fit_one(task):
+    # task: (chiave, serie, parametri iniziali o None, budget in secondi, orizzonte)
+    # Ritorna (chiave, parametri, media, limite inferiore, superiore, esito, secondi)
+    from statsmodels.tsa.statespace.sarimax import SARIMAX
+
+    key, series, start_params, budget_s, horizon = task
+    started = time.perf_counter()
+    deadline = started + budget_s
+    last = []
+
+    def check_budget(xk):
+        last[:] = [np.array(xk)]
+        if time.perf_counter() > deadline:
+            raise _BudgetExceeded
+
+    status = "ok"
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            model = SARIMAX(series, order=ORDER, trend="c", concentrate_scale=True)
+            if start_params is not None and len(start_params) != len(model.start_params):
+                start_params = None
+            try:
+                result = model.fit(
+                    start_params=start_params,
+                    maxiter=WARM_MAXITER if start_params is not None else COLD_MAXITER,
+                    callback=check_budget,
+                    disp=False,
+                )
+            except _BudgetExceeded:
+                # Tempo esaurito: uso l'ultima iterazione dell'ottimizzatore
+                # (i parametri nel callback sono nello spazio non vincolato)
+                status = "budget"
+                params = model.transform_params(last[0])
+                result = model.filter(params)
+            forecast = result.get_forecast(horizon)
+            conf = forecast.conf_int(alpha=0.05)
+            return (key, [float(p) for p in result.params], forecast.predicted_mean.astype(np.float32),
+                    conf[:, 0].astype(np.float32), conf[:, 1].astype(np.float32),
+                    status, time.perf_counter() - started)
+    except Exception as e:
+        return key, None, None, None, None, f"errore: {e}", time.perf_counter() - started
+
+
+# === CACHE E OUTPUT ===
+def load_cache(path=DEFAULT_CACHE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        cache = json.load(f)
+    if cache.get("order") != list(ORDER):
+        logger.info("Ordine del modello cambiato: cache delle previsioni ignorata")
+        return {}
+    return cache.get("series", {})
+
+
+def save_cache(entries, path=DEFAULT_CACHE_PATH):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"order": list(ORDER), "series": entries}, f)
+    os.replace(tmp, path)
+
+
+def load_forecasts(path=DEFAULT_OUTPUT_PATH):
+    # {(vin, metrica): {"origin": datetime64[D], "mean", "lower", "upper"}}
+    if not os.path.exists(path):
+        return {}
+    with np.load(path, allow_pickle=False) as data:
+        vins, metrics = data["vins"], data["metrics"]
+        return {
+            (str(vins[v]), str(metrics[m])): {
+                "origin": np.datetime64(int(o), "D"),
+                "mean": data["mean"][i], "lower": data["lower"][i], "upper": data["upper"][i],
+            }
+            for i, (v, m, o) in enumerate(zip(data["vin_idx"], data["metric_idx"], data["origin_day"]))
+        }
+
+
+def save_forecasts(forecasts, path=DEFAULT_OUTPUT_PATH):
+    # Formato compatto: una matrice float32 (serie x giorni) per media e intervallo,
+    # VIN e metriche come indici in due dizionari
+    keys = sorted(forecasts)
+    vins = sorted({vin for vin, _ in keys})
+    vin_index = {vin: i for i, vin in enumerate(vins)}
+    horizon = max((len(f["mean"]) for f in forecasts.values()), default=0)
+
+    def matrix(name):
+        out = np.full((len(keys), horizon), np.nan, dtype=np.float32)
+        for i, key in enumerate(keys):
+            values = forecasts[key][name]
+            out[i, :len(values)] = values
+        return out
+
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        np.savez_compressed(
+            f,
+            vins=np.array(vins, dtype=str),
+            metrics=np.array(METRICS, dtype=str),
+            vin_idx=np.array([vin_index[vin] for vin, _ in keys], dtype=np.int32),
+            metric_idx=np.array([METRICS.index(m) for _, m in keys], dtype=np.int8),
+            origin_day=np.array([forecasts[k]["origin"].astype(np.int64) for k in keys], dtype=np.int32),
+            mean=matrix("mean"), lower=matrix("lower"), upper=matrix("upper"),
+        )
+    os.replace(tmp, path)
+
+
+# === PIPELINE NOTTURNA ===
+def run_forecasts(source, cache_path=DEFAULT_CACHE_PATH, out_path=DEFAULT_OUTPUT_PATH,
+                  horizon=HORIZON_DAYS, budget_s=BUDGET_S, workers=None):
+    # Rifà la stima solo delle serie con sessioni nuove; le altre mantengono la
+    # previsione precedente. Le stime ripartono dai parametri della notte prima.
+    started = time.perf_counter()
+    series = collect_series(source)
+    cache = load_cache(cache_path)
+    previous = load_forecasts(out_path)
+    forecasts, tasks = {}, []
+    stats = {"series": len(series), "fitted": 0, "reused": 0, "short": 0,
+             "budget": 0, "failed": 0, "warm": 0, "fit_s": 0.0, "max_fit_s": 0.0}
+
+    for key, (first, daily, n_sessions, last_start) in series.items():
+        cache_key = "/".join(key)
+        entry = cache.get(cache_key)
+        origin = np.datetime64(first + len(daily), "D")
+        if len(daily) < MIN_DAYS:
+            stats["short"] += 1
+            continue
+        if (entry and entry["sessions"] == n_sessions and entry["last_start"] == last_start
+                and key in previous and len(previous[key]["mean"]) == horizon):
+            forecasts[key] = previous[key]
+            stats["reused"] += 1
+            continue
+        start_params = entry["params"] if entry else None
+        stats["warm"] += start_params is not None
+        tasks.append((key, daily, start_params, budget_s, horizon))
+        cache[cache_key] = {"sessions": n_sessions, "last_start": last_start, "params": start_params,
+                            "origin": int(origin.astype(np.int64))}
+
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(fit_one, tasks, chunksize=max(1, len(tasks) // (workers * 8))))
+    else:
+        results = [fit_one(task) for task in tasks]
+
+    for key, params, mean, lower, upper, status, elapsed in results:
+        stats["fit_s"] += elapsed
+        stats["max_fit_s"] = max(stats["max_fit_s"], elapsed)
+        cache_key = "/".join(key)
+        if params is None:
+            stats["failed"] += 1
+            logger.warning(f"Previsione {cache_key} fallita ({status})")
+            # Niente parametri validi: la prossima esecuzione riprova da zero
+            del cache[cache_key]
+            continue
+        stats["fitted"] += 1
+        stats["budget"] += status == "budget"
+        cache[cache_key]["params"] = params
+        forecasts[key] = {"origin": np.datetime64(cache[cache_key]["origin"], "D"),
+                          "mean": mean, "lower": lower, "upper": upper}
+
+    save_forecasts(forecasts, out_path)
+    save_cache({k: v for k, v in cache.items() if v.get("params") is not None}, cache_path)
+    stats["fit_s"] = round(stats["fit_s"], 2)
+    stats["max_fit_s"] = round(stats["max_fit_s"], 3)
+    stats["elapsed_s"] = round(time.perf_counter() - started, 2)
+    logger.info(f"Previsioni aggiornate: {stats}")
+    return stats
+
+
+def main():
+    import argparse
+    from archivio_sessioni import load_sessions
+    from colonnare import ColumnarSessionStore, DEFAULT_COLUMNAR_PATH
+
+    parser = argparse.ArgumentParser(description="Previsioni ARIMA notturne per tutta la flotta")
+    parser.add_argument("--store", default=DEFAULT_COLUMNAR_PATH,
+                        help="archivio colonnare (cartella) oppure file JSON / JSON Lines / SQLite")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_PATH)
+    parser.add_argument("--out", default=DEFAULT_OUTPUT_PATH)
+    parser.add_argument("--horizon", type=int, default=HORIZON_DAYS, help="giorni di previsione")
+    parser.add_argument("--budget", type=float, default=BUDGET_S, help="secondi massimi per modello")
+    parser.add_argument("--workers", type=int, default=None, help="processi (predefinito: numero di CPU)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    source = ColumnarSessionStore(args.store) if os.path.isdir(args.store) else load_sessions(args.store)
+    stats = run_forecasts(source, args.cache, args.out, args.horizon, args.budget, args.workers)
+    print(f"✅ Previsioni scritte in {args.out}: {stats['fitted']} stimate, {stats['reused']} riusate, "
+          f"{stats['short']} serie troppo corte, {stats['failed']} fallite ({stats['elapsed_s']} s)")
+
+
+if __name__ == "__main__":
+    main()
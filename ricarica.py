@@ -2,94 +2,153 @@ import os
 import asyncio
 import logging
 import aiohttp
-import time
-from logging.handlers import RotatingFileHandler
-from tapo import ApiClient
-from renault_api.renault_client import RenaultClient
 from dotenv import load_dotenv
-from datetime import datetime, time as dt_time
-import json
+from datetime import datetime, time as dt_time, timedelta
 import sys
+from archivio_sessioni import open_store
+from prese import get_plug_pool
+from notifiche import get_notifier
+from comandi import get_dispatcher
+from cache_stato import BatteryStatusCache
+from rilevamento import AdaptivePlugScheduler, PlugTriggerWebhook
+from curva_ricarica import ChargeCurveModel
+from analitica_batteria import BatteryHealthTracker
+from storico import HistoryIndex
+from colonnare import ColumnarSessionStore, DEFAULT_COLUMNAR_PATH
+from sincronizzazione import open_mongo_sync, DEFAULT_DATABASE, DEFAULT_COLLECTION
+from pianificazione import open_price_schedule, next_departure, plan_charging
+from potenza import PowerBudget, urgency, DEFAULT_PLUG_KW
+from metriche import metrics, open_metrics_exporter, LAG_BUCKETS
+from stato_ricarica import open_state_store, PHASE_WAITING, PHASE_CHARGING
+from autenticazione import RenaultAuth, AUTH_ERRORS
+from anomalia import ChargeAnomalyDetector, ACTION_BACKOFF, ACTION_STOP
+from scrittura import setup_logging, writer
 
-log_handler = RotatingFileHandler(
-    'ev_charger.log',
-    maxBytes=2*1024*1024, 
-    backupCount=3,
-    encoding='utf-8'
-)
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        log_handler,
-        logging.StreamHandler(sys.stderr)
-    ]
-)
-console_logger = logging.getLogger()
-console_logger.handlers[1].setLevel(logging.WARNING)
+ATTEMPT_BUCKETS = (1, 2, 3)
+BACKOFF_BUCKETS = (1, 2, 4, 8)
+OVERSHOOT_BUCKETS = (-10, -5, -2, -1, 0, 1, 2, 3, 5, 10)
+
+# ev_charger.log (rotazione a 2 MB) e stderr dai WARNING in su, scritti dal thread dei log
+setup_logging()
 
 logger = logging.getLogger(__name__)
 logging.getLogger("renault_api.kamereon.models").setLevel(logging.ERROR)
 
+# Default dei parametri configurabili da variabili d'ambiente: passando None la funzione è disattivata
+FROM_ENV = object()
+
 class EVCharger:
-    def __init__(self):
-        load_dotenv()
-        self.tapo_email = os.getenv('TAPO_EMAIL')
-        self.tapo_password = os.getenv('TAPO_PASSWORD')
-        self.smart_plug_ip = os.getenv('SMART_PLUG_IP')
-        self.renault_email = os.getenv('RENAULT_EMAIL')
-        self.renault_password = os.getenv('RENAULT_PASSWORD')
+    def __init__(self, vin=None, smart_plug_ip=None, renault_email=None, renault_password=None,
+                 tapo_email=None, tapo_password=None, session_store=None, columnar_store=FROM_ENV,
+                 mongo_sync=FROM_ENV, price_schedule=None, departure=None, power_budget=None, charge_state=FROM_ENV,
+                 name=None, notifier=None, plug_pool=None, load_env=True):
+        # notifier e plug_pool sostituiscono quelli condivisi (es. simulazione); load_env=False non legge .env
+        if load_env:
+            load_dotenv()
+        self.tapo_email = tapo_email or os.getenv('TAPO_EMAIL')
+        self.tapo_password = tapo_password or os.getenv('TAPO_PASSWORD')
+        self.smart_plug_ip = smart_plug_ip or os.getenv('SMART_PLUG_IP')
+        self.renault_email = renault_email or os.getenv('RENAULT_EMAIL')
+        self.renault_password = renault_password or os.getenv('RENAULT_PASSWORD')
+        self.vin = vin or os.getenv('RENAULT_VIN')
+        # Nome breve del veicolo nei messaggi e nei comandi Telegram (default: ultime 4 cifre del VIN)
+        self.name = name or os.getenv('VEHICLE_NAME')
         self.websession = None
+        self.renault_auth = None
         self.vehicle = None
-        self.last_update_id = None
         self.charging_active = False
+        self.plug_scheduler = None
+        self.charge_curve = None
+        self.health_tracker = None
+        self.history_index = None
         self.TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
         self.TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
         self.TELEGRAM_CHAT_ID1 = os.getenv("TELEGRAM_CHAT_ID1")
+        extra_chat_ids = [c.strip() for c in os.getenv("TELEGRAM_CHAT_IDS", "").split(",") if c.strip()]
+        if notifier is None:
+            notifier = get_notifier(self.TELEGRAM_BOT_TOKEN,
+                                    [self.TELEGRAM_CHAT_ID, self.TELEGRAM_CHAT_ID1] + extra_chat_ids)
+            # Un solo long polling per bot: risposte e comandi instradati al veicolo giusto
+            self.dispatcher = get_dispatcher(notifier) if self.TELEGRAM_BOT_TOKEN else None
+        else:
+            self.dispatcher = None
+        self.notifier = notifier
         self.last_known_battery_status = None
+        self.status_cache = BatteryStatusCache(
+            lambda: self.safe_api_call(self.vehicle.get_battery_status),
+            ttl=float(os.getenv('BATTERY_STATUS_TTL', 30))
+        )
+        if session_store is None:
+            session_store = open_store(os.getenv('SESSION_STORE_PATH', 'charging_data.jsonl'))
+        self.session_store = session_store
+        # Copia colonnare per le analisi; COLUMNAR_STORE_PATH vuoto la disattiva
+        if columnar_store is FROM_ENV:
+            columnar_path = os.getenv('COLUMNAR_STORE_PATH', DEFAULT_COLUMNAR_PATH)
+            columnar_store = ColumnarSessionStore(columnar_path) if columnar_path else None
+        self.columnar_store = columnar_store
+        # Invio delle sessioni a MongoDB solo se MONGO_URI è configurato
+        if mongo_sync is FROM_ENV:
+            mongo_uri = os.getenv('MONGO_URI')
+            mongo_sync = open_mongo_sync(mongo_uri, os.getenv('MONGO_DB', DEFAULT_DATABASE),
+                                         os.getenv('MONGO_COLLECTION', DEFAULT_COLLECTION)) if mongo_uri else None
+        self.mongo_sync = mongo_sync
+        # Con PRICE_FILE la ricarica viene spostata negli slot più economici prima della partenza
+        self.price_schedule = price_schedule or open_price_schedule()
+        self.departure = departure or os.getenv('DEPARTURE_TIME', '07:30')
+        # Limite di potenza del sito (kW), condiviso da tutte le prese; POWER_CAP_KW vuoto = nessun limite
+        if power_budget is None and os.getenv('POWER_CAP_KW'):
+            power_budget = PowerBudget(float(os.getenv('POWER_CAP_KW')))
+        self.power_budget = power_budget
+        self.power_lease = None
+        self.charge_target = 80
+        self.target_override = None  # target impostato con /target, vale per la ricarica in corso o la prossima
+        self.stop_requested = False  # /stop: niente ricarica fino allo scollegamento del cavo
+        # SoC a cui la ricarica si è conclusa o è stata rifiutata: nessuna nuova domanda finché il
+        # cavo resta collegato e il SoC non scende (veicolo usato tra due controlli); None = nessuna attesa
+        self.await_unplug = None
+        self.control_event = asyncio.Event()  # sveglia le attese al cambio di target o allo stop
+        # Rilevamento di anomalie sulle letture della ricarica in corso; ANOMALY_DETECTION=0 lo disattiva
+        self.detect_anomalies = os.getenv('ANOMALY_DETECTION', '1') != '0'
+        self.anomalies = None       # ChargeAnomalyDetector della sessione in corso
+        self.anomaly_stop = None    # anomalia che ha fermato la ricarica
+        self._observed_status = None
+        self.plug_pool = plug_pool or get_plug_pool(self.tapo_email, self.tapo_password,
+                                                    os.getenv('TAPO_PLUG_MODEL', 'p100'))
+        # Stato della ricarica su disco (CHARGE_STATE_DIR): dopo un riavvio la sessione riprende
+        self.charge_state = open_state_store() if charge_state is FROM_ENV else charge_state
+        self.saved_state = {}
+        self.account_id = None
+        self.monitor_started = None
 
         if not all([self.tapo_email, self.tapo_password, self.smart_plug_ip,
                    self.renault_email, self.renault_password]):
             raise ValueError("Errore: alcune credenziali non sono state caricate correttamente.")
 
+    def now(self):
+        return datetime.now()
+
     async def send_telegram_message(self, message, force=False):
         important_keywords = ["⚠️", "✅", "🛑", "⚡", "Ricarica terminata", "cavo scollegato"]
-        if not force and not any(k in message for k in important_keywords):
-            # Skip messaggi non critici per evitare spam
-            logger.debug(f"Messaggio Telegram ignorato per limitazione: {message}")
+        critical = any(k in message for k in important_keywords)
+        if not force and not critical:
+            # Messaggi non critici (es. progresso): accorpati e limitati per chat per evitare spam
+            self.notifier.notify(message, coalesce_key=f"progress-{self.vin}")
             return
-
-        url = f"https://api.telegram.org/bot{self.TELEGRAM_BOT_TOKEN}/sendMessage"
-        payloads = [
-            {"chat_id": self.TELEGRAM_CHAT_ID, "text": message},
-            {"chat_id": self.TELEGRAM_CHAT_ID1, "text": message},
-        ]
-        
-        async with aiohttp.ClientSession() as session:
-            for payload in payloads:
-                for attempt in range(2):  # max 2 tentativi
-                    try:
-                        async with session.post(url, json=payload, timeout=10) as resp:
-                            resp.raise_for_status()
-                            logger.info(f"Messaggio Telegram inviato: {message[:30]}...")
-                            break
-                    except Exception as e:
-                        logger.warning(f"Invio Telegram fallito (tentativo {attempt+1}): {e}")
-                        await asyncio.sleep(1)
+        # Invio in background: un'API Telegram lenta non rallenta il ciclo di ricarica.
+        # A coda piena i messaggi critici sono gli ultimi a essere scartati
+        self.notifier.notify(message, critical=critical)
 
     async def setup(self):
         max_retries = 3
         for attempt in range(max_retries):
             try:
                 self.websession = aiohttp.ClientSession()
-                client = RenaultClient(websession=self.websession, locale="it_IT")
-                await client.session.login(self.renault_email, self.renault_password)
-                account_list = await client.get_person()
-                account_id = account_list.accounts[0].accountId
-                account = await client.get_api_account(account_id)
-                vehicles = await client.session.get_account_vehicles(account_id)
-                vin = vehicles.vehicleLinks[0].vin
-                self.vehicle = await account.get_api_vehicle(vin)
+                # Token, account e veicoli dalla cache (RENAULT_AUTH_CACHE): a caldo nessuna
+                # chiamata qui, i token vengono verificati dalla prima lettura della batteria
+                self.renault_auth = RenaultAuth(self.websession, self.renault_email, self.renault_password)
+                self.account_id, self.vehicle = await self.renault_auth.get_vehicle(self.vin)
+                self.vin = self.vehicle.vin
+                self.renault_auth.start()
                 return
             except Exception as e:
                 logger.error(f"Setup fallito (tentativo {attempt+1}/{max_retries}): {e}")
@@ -101,65 +160,133 @@ class EVCharger:
 
     async def safe_api_call(self, func, *args, **kwargs):
         max_retries = 3
+        call = func.__name__
         for attempt in range(max_retries):
             try:
-                result = await func(*args, **kwargs)
+                with metrics.timer("renault_call_seconds", "Durata delle chiamate all'API Renault", call=call):
+                    result = await func(*args, **kwargs)
                 if result is not None:
+                    metrics.histogram("renault_call_attempts", "Tentativi necessari per una chiamata riuscita",
+                                      ATTEMPT_BUCKETS, call=call).observe(attempt + 1)
                     return result
+                metrics.counter("renault_call_retries_total", "Tentativi falliti", call=call, reason="vuoto").inc()
+            except AUTH_ERRORS as e:
+                # Token scaduti o revocati: nuovo login e nuovo tentativo subito, senza backoff
+                logger.warning(f"Autenticazione Renault rifiutata per {call}: {e}")
+                metrics.counter("renault_call_retries_total", "Tentativi falliti", call=call, reason="autenticazione").inc()
+                if self.renault_auth is not None:
+                    try:
+                        await self.renault_auth.recover()
+                    except Exception as login_error:
+                        logger.error(f"Nuovo login Renault fallito: {login_error}")
             except Exception as e:
-                logger.warning(f"Tentativo {attempt+1} fallito per {func.__name__}: {e}")
+                logger.warning(f"Tentativo {attempt+1} fallito per {call}: {e}")
+                metrics.counter("renault_call_retries_total", "Tentativi falliti", call=call, reason="errore").inc()
                 if attempt < max_retries - 1:
+                    metrics.histogram("renault_backoff_seconds", "Attese prima di un nuovo tentativo",
+                                      BACKOFF_BUCKETS, call=call).observe(2 ** attempt)
                     await asyncio.sleep(2 ** attempt)
         
-        logger.error(f"Chiamata API {func.__name__} fallita dopo {max_retries} tentativi")
+        logger.error(f"Chiamata API {call} fallita dopo {max_retries} tentativi")
+        metrics.counter("renault_call_failures_total", "Chiamate fallite dopo tutti i tentativi", call=call).inc()
         return None
 
-    async def get_batterystatus(self):
-        status = await self.safe_api_call(self.vehicle.get_battery_status)
+    async def get_batterystatus(self, force=False):
+        status = await self.status_cache.get(force=force)
         if status:
             self.last_known_battery_status = status
+            await self.observe_status(status)
         return status
 
-    async def get_plug_status(self):
-        status = await self.safe_api_call(self.vehicle.get_battery_status)
+    async def get_plug_status(self, force=False):
+        metrics.counter("plug_status_checks_total", "Controlli dello stato del cavo", vin=self.vin).inc()
+        # Per il solo stato del cavo basta una lettura vecchia al massimo un intervallo di controllo:
+        # i controlli ogni 60 secondi di safe_sleep usano a turno la lettura del controllo precedente
+        status = await self.status_cache.get(force=force, max_age=self.check_interval())
         if status:
             self.last_known_battery_status = status
+            await self.observe_status(status)
             is_plugged = status.plugStatus != 0
             logger.info(f"Stato cavo: {'Collegato' if is_plugged else 'Scollegato'}")
             return is_plugged
         return False
 
-    async def get_last_update_id(self):
-        url = f"https://api.telegram.org/bot{self.TELEGRAM_BOT_TOKEN}/getUpdates"
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as resp:
-                    data = await resp.json()
-                    if "result" in data and data["result"]:
-                        return data["result"][-1]["update_id"]
-        except Exception as e:
-            logger.error(f"Errore nel recupero dell'ultimo update_id: {e}")
-        return None
+    # === ANOMALIE DURANTE LA RICARICA ===
+    async def observe_status(self, status):
+        # Ogni lettura già fatta dal ciclo di ricarica passa dal rilevatore: nessuna chiamata in più.
+        # Le letture servite dalla cache sono la stessa risposta, contata una volta sola
+        if self.anomalies is None or status is self._observed_status:
+            return
+        self._observed_status = status
+        for anomaly in self.anomalies.observe(asyncio.get_running_loop().time(), status):
+            await self.handle_anomaly(anomaly)
 
-    async def wait_for_user_response(self, timeout=300):
-        url = f"https://api.telegram.org/bot{self.TELEGRAM_BOT_TOKEN}/getUpdates"
-        start_time = time.time()
-        last_update_id = await self.get_last_update_id() or 0
-        while time.time() - start_time < timeout:
-            try:
-                params = {"offset": last_update_id + 1, "timeout": 10}
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(url, params=params) as resp:
-                        data = await resp.json()
-                        if "result" in data and data["result"]:
-                            for update in data["result"]:
-                                if "message" in update and "text" in update["message"]:
-                                    last_update_id = update["update_id"]
-                                    return update["message"]["text"].strip().lower()
-            except Exception as e:
-                logger.error(f"Errore nel recupero del messaggio: {e}")
-            await asyncio.sleep(2)
-        return None
+    async def handle_anomaly(self, anomaly):
+        metrics.counter("charge_anomalies_total", "Anomalie rilevate durante la ricarica",
+                        vin=self.vin, kind=anomaly.kind, action=anomaly.action).inc()
+        logger.warning(f"Anomalia di ricarica ({anomaly.kind}, {anomaly.action}): {anomaly.message}")
+        if anomaly.action == ACTION_STOP:
+            # Come /stop: presa spenta e nessuna nuova ricarica fino allo scollegamento del cavo
+            self.anomaly_stop = anomaly
+            self.stop_requested = True
+            self.control_event.set()
+            return
+        suffix = " Controlli del cavo diradati." if anomaly.action == ACTION_BACKOFF else ""
+        await self.send_telegram_message(f"⚠️ {self.label()}: {anomaly.message}.{suffix}", force=True)
+
+    def check_interval(self):
+        # Intervallo dei controlli del cavo durante la ricarica, allungato se la batteria è ferma
+        backoff = self.anomalies.backoff if self.anomalies is not None else 1
+        return 60 * backoff
+
+    def label(self):
+        return self.name or (self.vin or "")[-4:]
+
+    async def ask_user(self, prompt, timeout=300):
+        # Domanda con risposta instradata dal dispatcher: più veicoli possono attendere insieme
+        if self.dispatcher is None:
+            await self.send_telegram_message(prompt, force=True)
+            return None
+        return await self.dispatcher.ask(self, prompt, timeout=timeout)
+
+    # === COMANDI TELEGRAM ===
+    # Chiamati dal dispatcher: aggiornano solo lo stato, il ciclo di ricarica li applica
+    def status_line(self):
+        status = self.last_known_battery_status
+        if status is None:
+            return f"🔋 {self.label()}: stato non ancora disponibile"
+        if self.charging_active:
+            state = f"in carica, target {self.charge_target}%"
+        else:
+            state = "cavo collegato" if status.plugStatus else "cavo scollegato"
+        line = f"🔋 {self.label()}: {status.batteryLevel}% ({state})"
+        if self.stop_requested:
+            line += " - ricarica fermata fino allo scollegamento"
+        elif self.await_unplug is not None and status.plugStatus:
+            line += " - ricarica conclusa, in attesa dello scollegamento"
+        return line
+
+    def set_target(self, target):
+        self.charge_target = target
+        self.target_override = target
+        if self.saved_state:
+            self.save_charge_state(target=target)
+        resumed = self.stop_requested or self.await_unplug is not None
+        self.stop_requested = False
+        self.await_unplug = None
+        self.control_event.set()
+        if self.charging_active:
+            return f"🎯 {self.label()}: target della ricarica in corso portato al {target}%."
+        if resumed:
+            self.trigger_plug_check()
+        return f"🎯 {self.label()}: target {target}% per la prossima ricarica."
+
+    def request_stop(self):
+        self.stop_requested = True
+        self.control_event.set()
+        if self.charging_active or self.saved_state:
+            return f"🛑 {self.label()}: interrompo la ricarica. Riprenderà dopo lo scollegamento del cavo (o con /target)."
+        return f"🛑 {self.label()}: nessuna ricarica in corso, non ne avvierò finché il cavo resta collegato."
 
     async def ask_continue_charging(self):
         battery_status = await self.get_batterystatus()
@@ -167,9 +294,7 @@ class EVCharger:
             return False
             
         battery_percentage = battery_status.batteryLevel
-        await self.send_telegram_message(f"⚡ La ricarica non è necessaria. La batteria è al {battery_percentage}%. Si desidera continuare la ricarica? Rispondi 'sì','no' o inserisci la percentuale desiderata.", force=True)
-        
-        response = await self.wait_for_user_response()
+        response = await self.ask_user(f"⚡ La ricarica non è necessaria. La batteria è al {battery_percentage}%. Si desidera continuare la ricarica? Rispondi 'sì','no' o inserisci la percentuale desiderata.")
         if response in ["sì", "si"]:
             await self.send_telegram_message("✅ Continuo la ricarica fino all'80%.", force=True)
             return 80
@@ -183,56 +308,145 @@ class EVCharger:
             await self.send_telegram_message("⏳ Nessuna risposta valida. Ricarica terminata.", force=True)
             return False
 
+    def power_urgency(self, battery_percentage=None):
+        if battery_percentage is None:
+            status = self.last_known_battery_status
+            battery_percentage = status.batteryLevel if status else 0
+        now = self.now()
+        needed = self.ensure_charge_curve().seconds_between(battery_percentage, self.charge_target)
+        return urgency(needed, (next_departure(now, self.departure) - now).total_seconds())
+
+    def power_revoked(self):
+        return self.power_lease is not None and self.power_lease.revoked
+
+    async def acquire_power(self):
+        # Attende che il limite di potenza del sito lasci spazio a questa presa,
+        # continuando a controllare il cavo e ad aggiornare l'urgenza
+        lease = self.power_budget.request(self.vin, self.power_urgency(), DEFAULT_PLUG_KW)
+        if not lease.granted.done():
+            await self.send_telegram_message("⏳ Limite di potenza del sito raggiunto: ricarica in coda.", force=True)
+        while not lease.granted.done():
+            await asyncio.wait({lease.granted}, timeout=900)
+            if lease.granted.done():
+                break
+            if self.stop_requested or not await self.get_plug_status():
+                self.power_budget.release(self.vin)
+                return None
+            self.power_budget.update(self.vin, urgency=self.power_urgency())
+        if lease.granted.cancelled():
+            return None
+        self.power_lease = lease
+        return lease
+
     async def start_charging(self):
+        if self.power_budget is not None and self.power_lease is None:
+            if await self.acquire_power() is None:
+                return False
         try:
-            client = ApiClient(self.tapo_email, self.tapo_password)
-            plug = await client.p100(self.smart_plug_ip)
-            await plug.on()
+            await self.plug_pool.set_state(self.smart_plug_ip, True)
             logger.info("Presa attivata, ricarica avviata.")
             self.charging_active = True
             return True
         except Exception as e:
             logger.error(f"Errore di autenticazione Tapo: {e}")
+            self.release_power()
             return False
 
+    def release_power(self):
+        if self.power_budget is not None:
+            self.power_budget.release(self.vin)
+            self.power_lease = None
+
     async def stop_charging(self):
         try:
-            client = ApiClient(self.tapo_email, self.tapo_password)
-            plug = await client.p100(self.smart_plug_ip)
-            await plug.off()
+            await self.plug_pool.set_state(self.smart_plug_ip, False)
             logger.info("Presa spenta, ricarica terminata.")
             self.charging_active = False
+            # Solo a presa spenta: se lo spegnimento fallisce la potenza resta impegnata
+            self.release_power()
             return True
         except Exception as e:
             logger.error(f"Errore nello spegnimento della presa: {e}")
             return False
 
-    async def safe_sleep(self, sleep_time: float) -> bool:
-        chunk_size = 60  # controlla ogni 60 secondi
+    async def safe_sleep(self, sleep_time: float, chunk_size: float = None, wake: bool = False) -> bool:
+        # chunk_size: ogni quanto controllare il cavo (default check_interval(): 60 secondi durante la ricarica)
+        # wake: un comando Telegram (es. nuovo target) termina subito lo sleep; /stop lo interrompe sempre
         slept = 0
+        loop = asyncio.get_running_loop()
+        oversleep = metrics.histogram("sleep_oversleep_seconds", "Ritardo del risveglio rispetto allo sleep richiesto",
+                                      LAG_BUCKETS, vin=self.vin)
         while slept < sleep_time:
-            chunk = min(chunk_size, sleep_time - slept)
-            await asyncio.sleep(chunk)
-            slept += chunk
-            
+            chunk = min(chunk_size or self.check_interval(), sleep_time - slept)
+            started = loop.time()
+            try:
+                await asyncio.wait_for(self.control_event.wait(), chunk)
+                slept += loop.time() - started
+            except asyncio.TimeoutError:
+                oversleep.observe(max(0.0, loop.time() - started - chunk))
+                slept += chunk
+            if self.control_event.is_set():
+                self.control_event.clear()
+                if self.stop_requested:
+                    logger.info("Ricarica interrotta su richiesta")
+                    return False
+                if wake:
+                    return True
+
+            if self.power_revoked():
+                logger.info("Ricarica sospesa per il limite di potenza del sito")
+                return False
             # Controlla lo stato del cavo durante lo sleep
             if not await self.get_plug_status():
                 logger.warning("⚠️ Rilevato scollegamento durante lo sleep!")
                 return False
         return True
 
-    async def charge_loop(self, battery_percentage, time_estimate, target):
-        first_battery_percentage = battery_percentage
+    async def charge_loop(self, battery_percentage, time_estimate, target, until=None, resume=None,
+                          keep_open=False):
+        # until: fine della fascia pianificata (tempo del loop); None = fino al target
+        # resume: sessione già iniziata (stato salvato da un processo precedente o fascia
+        # precedente della stessa ricarica), che continua invece di ripartire
+        # keep_open: a una pausa per fascia o potenza la sessione resta aperta e viene
+        # ritornata, il record si scrive una volta sola a fine ricarica
+        first_battery_percentage = resume["first_battery_percentage"] if resume else battery_percentage
         battery_status = await self.get_batterystatus()
         if not battery_status:
             logger.error("Impossibile ottenere lo stato della batteria all'inizio del ciclo.")
-            return
-        start_time = datetime.now().isoformat()
+            return resume if keep_open else None
+        start_time = resume["start_time"] if resume else self.now().isoformat()
         battery_percentage = battery_status.batteryLevel
-        charging_time_real = ((battery_status.chargingRemainingTime)*(target-battery_percentage)/(100-battery_percentage))*60
-        charging_time_real_start = ((battery_status.chargingRemainingTime)*(target-battery_percentage)/(100-battery_percentage))*60
-        checkpoints = list(range(((first_battery_percentage // 10) + 1) * 10, target, 10))
-        initial_remaining = target-battery_percentage
+        if resume:
+            charging_time_real_start = resume["charging_time_real_start"]
+            checkpoints = list(resume["checkpoints"])
+        else:
+            charging_time_real_start = ((battery_status.chargingRemainingTime)*(target-battery_percentage)/(100-battery_percentage))*60
+            checkpoints = list(range(((first_battery_percentage // 10) + 1) * 10, target, 10))
+        # Curva di ricarica appresa dallo storico, corretta in base alle letture di questa sessione
+        curve = self.ensure_charge_curve().session()
+        self.start_anomaly_detection(battery_status)
+        loop = asyncio.get_running_loop()
+        last_reading = charge_started = loop.time()
+        # Secondi di ricarica delle fasce precedenti della stessa sessione
+        charged_before = resume.get("charged_s", 0.0) if resume else 0.0
+        if resume and resume.get("phase") == PHASE_CHARGING:
+            charge_started -= (self.now() - datetime.fromisoformat(resume["charge_started"])).total_seconds()
+        # Motivo della pausa: "fascia" (piano tariffario), "potenza" (limite del sito), "stop" (comando)
+        # o "anomalia" (rilevatore)
+        paused = None
+        handed_over = False
+        open_session = None
+        # Scrittura anticipata: se il processo muore da qui in poi, il successivo riprende la sessione
+        await self.checkpoint_charge_state(
+            phase=PHASE_CHARGING,
+            first_battery_percentage=first_battery_percentage,
+            start_time=start_time,
+            charging_time_real_start=charging_time_real_start,
+            checkpoints=checkpoints,
+            charged_s=charged_before,
+            charge_started=(self.now() - timedelta(seconds=loop.time() - charge_started)).isoformat(),
+            until=(self.now() + timedelta(seconds=until - loop.time())).isoformat() if until is not None else None,
+        )
         
         try:
             while battery_percentage < target:
@@ -240,6 +454,17 @@ class EVCharger:
                     logger.error("Errore nel recupero del livello batteria durante la ricarica.")
                     break
 
+                if until is not None and loop.time() >= until - 60:
+                    logger.info(f"Fine della fascia pianificata con batteria al {battery_percentage}%")
+                    paused = "fascia"
+                    break
+                if self.power_revoked():
+                    paused = "potenza"
+                    break
+                if self.stop_requested:
+                    paused = self.pause_reason()
+                    break
+
                 # Controllo scollegamento con log dettagliato
                 is_plugged = await self.get_plug_status()
                 if not is_plugged:
@@ -251,6 +476,7 @@ class EVCharger:
                 # Gestione checkpoint
                 if checkpoints and battery_percentage >= checkpoints[0]:
                     next_checkpoint = checkpoints.pop(0)
+                    self.save_charge_state(checkpoints=checkpoints)
                     logger.info(f"🔋 Batteria: {battery_percentage}% - Raggiunto checkpoint {next_checkpoint}%")
                     await self.send_telegram_message(
                         f"🔋 Batteria: {battery_percentage}% - Prossimo checkpoint {checkpoints[0] if checkpoints else target}%",
@@ -259,14 +485,9 @@ class EVCharger:
             
                 # Fase finale con sleep frazionato
                 elif not checkpoints:
-                    current_remaining = target - battery_percentage
-                    progress_ratio = current_remaining / initial_remaining
-                    exponent = 1.5  
-                    remaining_time_sec = charging_time_real * (progress_ratio ** exponent)
-                    
-                    min_sleep = 300  
-                    max_sleep = 1800  
-                    sleep_time = max(min_sleep, min(remaining_time_sec, max_sleep))
+                    sleep_time = curve.next_sleep(battery_percentage, target, final=True)
+                    if until is not None:
+                        sleep_time = max(60, min(sleep_time, until - loop.time()))
                     
                     logger.info(f"Ultimo sleep progressivo: {sleep_time//60} min {sleep_time%60} sec")
                     await self.send_telegram_message(
@@ -275,13 +496,17 @@ class EVCharger:
                         force=False  # evita spam in questa fase
                     )
                     
-                    if not await self.safe_sleep(sleep_time):
-                        # Cavo scollegato durante lo sleep, interrompo
+                    if not await self.safe_sleep(sleep_time, wake=True):
+                        # Cavo scollegato (o ricarica sospesa) durante lo sleep, interrompo
+                        paused = self.pause_reason()
                         break
                 else:
-                    estimated_time_sec = (charging_time_real*(checkpoints[0]-battery_percentage))/(target-battery_percentage)
+                    estimated_time_sec = curve.next_sleep(battery_percentage, checkpoints[0])
+                    if until is not None:
+                        estimated_time_sec = max(60, min(estimated_time_sec, until - loop.time()))
                     logger.info(f"Dormo {estimated_time_sec // 60} min fino a circa {checkpoints[0]}%")
-                    if not await self.safe_sleep(estimated_time_sec):
+                    if not await self.safe_sleep(estimated_time_sec, wake=True):
+                        paused = self.pause_reason()
                         break
                 
                 # Aggiorno stato batteria
@@ -289,68 +514,184 @@ class EVCharger:
                 if battery_status is None:
                     break
                 new_battery_percentage = battery_status.batteryLevel
+                if self.power_lease is not None:
+                    await self.report_power(new_battery_percentage)
             
                 # Adatto la stima tempo ricarica
-                if new_battery_percentage <= battery_percentage:
-                    charging_time_real *= 0.9
+                now = loop.time()
+                curve.observe(now - last_reading, battery_percentage, new_battery_percentage)
+                last_reading = now
                 
                 battery_percentage = new_battery_percentage
-                charging_time_real = ((battery_status.chargingRemainingTime)*(target-battery_percentage)/(100-battery_percentage))*60
 
+                if self.charge_target != target:
+                    # Nuovo target da /target: checkpoint ricalcolati dal livello attuale
+                    target = self.charge_target
+                    checkpoints = list(range(((battery_percentage // 10) + 1) * 10, target, 10))
+                    self.save_charge_state(target=target, checkpoints=checkpoints)
+                    logger.info(f"Nuovo target {target}% con batteria al {battery_percentage}%")
                 if battery_percentage >= target:
                     break
+        except asyncio.CancelledError:
+            # Arresto del processo (es. riavvio del dyno): con lo stato su disco la sessione
+            # viene ripresa dal processo successivo, quindi niente record parziale e presa com'è
+            handed_over = self.charge_state is not None
+            raise
         finally:
-            end_time = datetime.now().isoformat()
-            end_status = await self.get_batterystatus()
-            if not end_status:
-                logger.warning("Usando ultimo stato batteria noto per salvataggio")
-                end_status = self.last_known_battery_status
-                return
-            start_battery_capacity = (first_battery_percentage*27)/100
-            end_battery_capacity = (end_status.batteryLevel*27)/100
-            energy_consumed = round(end_battery_capacity - start_battery_capacity, 2)
-            charging_duration_hours = (charging_time_real_start) / 3600
-            energy_expected = (end_status.batteryLevel - first_battery_percentage)/ 100
-            energy_measured = charging_duration_hours * 1.35
-            battery_health = ((energy_measured / energy_expected)/27) * 100 if energy_expected > 0 else None
-            cockpit = await self.vehicle.get_cockpit()
-            total_mileage_value = cockpit.totalMileage
-            
-            data = {
-                "start_time": start_time,
-                "end_time": end_time,
-                "start_battery_level": first_battery_percentage,
-                "end_battery_level": end_status.batteryLevel,
-                "start_battery_capacity": start_battery_capacity,
-                "end_battery_capacity": end_battery_capacity,
-                "EnergyConsumed": energy_consumed,
-                "battery_autonomy": end_status.batteryAutonomy,
-                "charging_duration_hours": charging_duration_hours,
-                "energy_expected": energy_expected,
-                "energy_measured": energy_measured,
-                "battery_health_estimate": round(battery_health, 2) if battery_health else None,
-                "charging_status": end_status.chargingStatus,
-                "total_mileage": total_mileage_value
-            }
-            file_path = "charging_data.json"
-            try:
-                if os.path.exists(file_path):
-                    with open(file_path, 'r') as f:
-                        all_data = json.load(f)
-                else:
-                    all_data = []
+            charged_s = charged_before + loop.time() - charge_started
+            if handed_over:
+                logger.warning(f"Arresto durante la ricarica al {battery_percentage}%: la sessione riprenderà al riavvio")
+            elif keep_open and paused in ("fascia", "potenza"):
+                open_session = {
+                    "phase": PHASE_WAITING,
+                    "first_battery_percentage": first_battery_percentage,
+                    "start_time": start_time,
+                    "charging_time_real_start": charging_time_real_start,
+                    "checkpoints": checkpoints,
+                    "charged_s": charged_s,
+                    "paused": paused,
+                }
+                self.save_charge_state(**open_session)
+                self.anomalies = None
+                await self.stop_charging()
+                await self.send_pause_message(paused, battery_percentage)
+            else:
+                await self.finish_session(first_battery_percentage, start_time, charging_time_real_start,
+                                          target, paused, charged_s)
+            self.anomalies = None
+        return open_session
 
-                all_data.append(data)
+    def start_anomaly_detection(self, battery_status):
+        self.anomaly_stop = None
+        self.anomalies = None
+        if self.detect_anomalies:
+            self.anomalies = ChargeAnomalyDetector(self.ensure_charge_curve(), self.ensure_health_tracker())
+            self.anomalies.observe(asyncio.get_running_loop().time(), battery_status)
+            self._observed_status = battery_status
 
-                with open(file_path, 'w') as f:
-                    json.dump(all_data, f, indent=4)
-                logger.info("Dati di ricarica salvati in charging_data.json")
+    async def finish_session(self, first_battery_percentage, start_time, charging_time_real_start,
+                             target, paused, elapsed_s, notify=True):
+        # Sessione chiusa: la lettura finale non passa più dal rilevatore
+        detector, self.anomalies = self.anomalies, None
+        end_time = self.now().isoformat()
+        end_status = await self.get_batterystatus()
+        if not end_status:
+            logger.warning("Usando ultimo stato batteria noto per salvataggio")
+            end_status = self.last_known_battery_status
+            return
+        start_battery_capacity = (first_battery_percentage*27)/100
+        end_battery_capacity = (end_status.batteryLevel*27)/100
+        energy_consumed = round(end_battery_capacity - start_battery_capacity, 2)
+        charging_duration_hours = (charging_time_real_start) / 3600
+        if paused:
+            # La stima iniziale vale fino al target: per una fascia interrotta uso il tempo reale
+            charging_duration_hours = elapsed_s / 3600
+        energy_expected = (end_status.batteryLevel - first_battery_percentage)/ 100
+        energy_measured = charging_duration_hours * 1.35
+        battery_health = ((energy_measured / energy_expected)/27) * 100 if energy_expected > 0 else None
+        # Stessi tentativi e metriche delle altre chiamate: senza cockpit il record si salva lo stesso
+        cockpit = await self.safe_api_call(self.vehicle.get_cockpit)
+        total_mileage_value = cockpit.totalMileage if cockpit is not None else None
+        
+        data = {
+            "vin": self.vin,
+            "start_time": start_time,
+            "end_time": end_time,
+            "start_battery_level": first_battery_percentage,
+            "end_battery_level": end_status.batteryLevel,
+            "start_battery_capacity": start_battery_capacity,
+            "end_battery_capacity": end_battery_capacity,
+            "EnergyConsumed": energy_consumed,
+            "battery_autonomy": end_status.batteryAutonomy,
+            "charging_duration_hours": charging_duration_hours,
+            "energy_expected": energy_expected,
+            "energy_measured": energy_measured,
+            "battery_health_estimate": round(battery_health, 2) if battery_health else None,
+            "charging_status": end_status.chargingStatus,
+            "total_mileage": total_mileage_value
+        }
+        if detector is not None:
+            # Confronto con il trend prima che la sessione entri nel tracker
+            for anomaly in detector.check_health(data["battery_health_estimate"]):
+                await self.handle_anomaly(anomaly)
+        try:
+            # Su disco dal thread di scrittura: più veicoli che finiscono insieme condividono
+            # un solo fsync e una sola partizione colonnare, senza fermare il loop.
+            # append ritorna quando il record è su disco (o rilancia l'errore di scrittura)
+            await writer.append(self.session_store.extend, data)
+            # Il record è su disco: solo ora la sessione non ha più niente da riprendere
+            self.clear_charge_state()
+            self.ensure_charge_curve().add_session(data)
+            self.ensure_health_tracker().add_session(data)
+            if self.history_index is not None:
+                self.history_index.add(data)
+            logger.info(f"Dati di ricarica salvati su {self.session_store.path}")
+        except Exception as e:
+            logger.error(f"Errore nel salvataggio della sessione: {e}")
+        if self.columnar_store is not None:
+            try:
+                await writer.append(self.columnar_store.append_records, data)
+            except Exception as e:
+                logger.error(f"Errore nella copia colonnare della sessione: {e}")
+        if self.mongo_sync is not None:
+            try:
+                # pymongo è bloccante: l'invio non deve fermare il loop
+                await asyncio.to_thread(self.mongo_sync.push, [data])
             except Exception as e:
-                logger.error(f"Errore nel salvataggio JSON: {e}")
+                logger.error(f"Errore nell'invio della sessione a MongoDB: {e}")
 
-            await self.stop_charging()
-            logger.info("Livello batteria target raggiunto. Ricarica completata.")
-            await self.send_telegram_message(f"✅ Livello batteria {target}% raggiunto. Ricarica completata.", force=True)
+        await self.stop_charging()
+        metrics.counter("charge_sessions_total", "Sessioni di ricarica salvate",
+                        vin=self.vin, result=paused or "completata").inc()
+        if not paused:
+            # Quanto si è andati oltre il target (negativo: ricarica interrotta prima)
+            metrics.histogram("soc_overshoot_percent", "SoC finale meno target", OVERSHOOT_BUCKETS,
+                              vin=self.vin).observe(end_status.batteryLevel - target)
+        logger.info(f"Statistiche prese Tapo: {self.plug_pool.stats()}")
+        logger.info(f"Statistiche cache stato batteria: {self.status_cache.stats()}")
+        if not notify:
+            return
+        if paused in ("fascia", "potenza"):
+            await self.send_pause_message(paused, end_status.batteryLevel)
+            return
+        if paused == "stop":
+            await self.send_telegram_message(
+                f"🛑 Ricarica interrotta su richiesta con batteria al {end_status.batteryLevel}%.", force=True)
+            return
+        if paused == "scollegato":
+            await self.send_telegram_message(
+                f"⚠️ Cavo scollegato durante il riavvio: ricarica chiusa con batteria al {end_status.batteryLevel}%.",
+                force=True)
+            return
+        if paused == "anomalia":
+            await self.send_telegram_message(
+                f"⚠️ {self.label()}: ricarica interrotta, {self.anomaly_stop.message}. "
+                f"Riprenderà dopo lo scollegamento del cavo (o con /target).", force=True)
+            return
+        logger.info("Livello batteria target raggiunto. Ricarica completata.")
+        message = f"✅ Livello batteria {target}% raggiunto. Ricarica completata."
+        health = self.ensure_health_tracker().describe()
+        if health:
+            message += f"\n{health}"
+        await self.send_telegram_message(message, force=True)
+
+    async def send_pause_message(self, paused, battery_percentage):
+        if paused == "fascia":
+            await self.send_telegram_message(
+                f"⏸️ Fascia economica terminata: batteria al {battery_percentage}%, ricarica in pausa.",
+                force=True)
+        else:
+            await self.send_telegram_message(
+                f"⏸️ Limite di potenza del sito: ricarica sospesa al {battery_percentage}% "
+                f"a favore di un veicolo più urgente, riprenderà appena possibile.", force=True)
+
+    async def close_session(self, session, target):
+        # Ricarica terminata tra una fascia e l'altra (stop, cavo scollegato, piano vuoto):
+        # il messaggio della pausa è già partito, resta da scrivere il record
+        paused = self.pause_reason() or session.get("paused") or "interrotta"
+        await self.finish_session(session["first_battery_percentage"], session["start_time"],
+                                  session["charging_time_real_start"], target, paused,
+                                  session.get("charged_s", 0.0), notify=paused in ("stop", "anomalia"))
 
     async def run_charging_cycle(self):
         logger.info("Avvio del ciclo di ricarica.")
@@ -361,58 +702,329 @@ class EVCharger:
 
         battery_percentage = battery_status.batteryLevel
 
-        if battery_percentage >= 50:
+        if self.target_override is not None and battery_percentage < self.target_override:
+            # Target già scelto con /target: nessuna domanda
+            target = self.target_override
+            time_estimate = round(self.ensure_charge_curve().seconds_between(battery_percentage, target) / 60)
+            await self.send_telegram_message(f"Ricarica fino al {target}% richiesta. Batteria attuale: {battery_percentage}% - Tempo stimato: {time_estimate} min", force=True)
+            await self.charge_to_target(battery_percentage, time_estimate, target)
+
+        elif battery_percentage >= 50:
             target = await self.ask_continue_charging()
             if not target:
                 await self.stop_charging()
-                await self.send_telegram_message("Si prega di scollegare il veicolo. Attendo 7 ore prima di riprovare.", force=True)
-                await asyncio.sleep(3600*7)
+                await self.send_telegram_message("Si prega di scollegare il veicolo. Non riproverò finché il cavo resta collegato (/target per ricaricare).", force=True)
+                self.await_unplug = battery_percentage
                 return
-            time_estimate = round(((battery_status.chargingRemainingTime)*(target-battery_percentage)/(100-battery_percentage)))
-            await self.start_charging()
+            time_estimate = round(self.ensure_charge_curve().seconds_between(battery_percentage, target) / 60)
             await self.send_telegram_message(f"Ricarica in corso. Batteria attuale: {battery_percentage}% - Tempo stimato per {target}%: {time_estimate} min", force=True)
-            await self.charge_loop(battery_percentage, time_estimate, target)
+            await self.charge_to_target(battery_percentage, time_estimate, target)
 
         elif battery_percentage < 50:
             target = 80
-            time_estimate = round(((battery_status.chargingRemainingTime)*(target-battery_percentage)/(100-battery_percentage)))
+            time_estimate = round(self.ensure_charge_curve().seconds_between(battery_percentage, target) / 60)
             await self.send_telegram_message(f"Batteria bassa ({battery_percentage}%). Avvio ricarica fino all'80%: {time_estimate} min", force=True)
-            if await self.start_charging():
-                await self.charge_loop(battery_percentage, time_estimate, target)
-            else:
-                logger.error("Impossibile avviare la ricarica.")
+            await self.charge_to_target(battery_percentage, time_estimate, target)
         else:
             await self.stop_charging()
             await self.send_telegram_message(f"Batteria al {battery_percentage}%, ricarica non necessaria.", force=True)
 
+    def pause_reason(self):
+        # Perché uno sleep è stato interrotto: None se per lo scollegamento del cavo
+        if self.anomaly_stop is not None and self.stop_requested:
+            return "anomalia"
+        if self.stop_requested:
+            return "stop"
+        return "potenza" if self.power_revoked() else None
+
+    async def report_power(self, battery_percentage):
+        # Potenza reale (solo P110) e urgenza aggiornata per il limite di potenza del sito
+        try:
+            kw = await self.plug_pool.current_power(self.smart_plug_ip)
+        except Exception as e:
+            logger.warning(f"Lettura della potenza della presa fallita: {e}")
+            kw = None
+        self.power_budget.update(self.vin, urgency=self.power_urgency(battery_percentage), measured_kw=kw)
+
+    # === STATO PERSISTENTE DELLA RICARICA ===
+    def save_charge_state(self, **fields):
+        if self.charge_state is None:
+            return
+        self.saved_state.update(fields, vin=self.vin, updated=self.now().isoformat())
+        # Copia: il thread di scrittura serializza lo stato mentre il ciclo continua ad aggiornarlo.
+        # Per lo stesso veicolo conta solo l'ultimo stato in attesa
+        writer.write(("stato", self.vin), self.charge_state.save, self.vin, dict(self.saved_state))
+
+    async def checkpoint_charge_state(self, **fields):
+        # Come save_charge_state, ma ritorna quando lo stato è su disco: va chiamato prima di
+        # accendere la presa, così un processo che muore subito dopo lascia sempre lo stato
+        # da cui il successivo riprende (e spegne la presa se la fascia non è quella giusta)
+        if self.charge_state is None:
+            return
+        self.saved_state.update(fields, vin=self.vin, updated=self.now().isoformat())
+        try:
+            await writer.persist(("stato", self.vin), self.charge_state.save, self.vin, dict(self.saved_state))
+        except Exception as e:
+            logger.error(f"Stato della ricarica non salvato, la ripresa dopo un riavvio non è garantita: {e}")
+
+    def clear_charge_state(self):
+        self.saved_state = {}
+        if self.charge_state is not None:
+            writer.write(("stato", self.vin), self.charge_state.clear, self.vin)
+
+    def stored_sessions(self):
+        # Storico su disco (letture rare: avvio). Le sessioni chiuse sono già su disco:
+        # finish_session aspetta la scrittura del record
+        return self.session_store.iter_records()
+
+    async def resume_interrupted(self):
+        # Sessione lasciata a metà da un riavvio: riprendo con il target salvato, senza
+        # chiedere di nuovo all'utente e senza aspettare il prossimo controllo del cavo.
+        # Prima le scritture dello stato ancora in coda (es. stato cancellato poco prima)
+        await writer.drain()
+        state = self.charge_state.load(self.vin) if self.charge_state is not None else None
+        if not state:
+            return False
+        battery_status = await self.get_batterystatus(force=True)
+        if battery_status is None:
+            logger.error("Stato batteria non disponibile: la sessione interrotta verrà ripresa più tardi")
+            return False
+        self.saved_state = state
+        loop = asyncio.get_running_loop()
+        metrics.histogram("restart_to_control_seconds", "Dall'avvio del monitoraggio alla ripresa della sessione"
+                          ).observe(loop.time() - self.monitor_started)
+        battery_percentage = battery_status.batteryLevel
+        target = state["target"]
+        if battery_status.plugStatus == 0:
+            # Scollegato durante il riavvio: niente da riprendere. Se la ricarica era già
+            # partita la sessione si chiude con il tempo di ricarica noto fino all'ultimo salvataggio
+            logger.info(f"Sessione interrotta non ripresa ({state.get('phase')}): cavo scollegato")
+            try:
+                if state.get("start_time"):
+                    charged_s = state.get("charged_s", 0.0)
+                    if state.get("phase") == PHASE_CHARGING:
+                        charged_s += max(0.0, (datetime.fromisoformat(state["updated"])
+                                               - datetime.fromisoformat(state["charge_started"])).total_seconds())
+                    await self.finish_session(state["first_battery_percentage"], state["start_time"],
+                                              state["charging_time_real_start"], target, "scollegato", charged_s)
+                else:
+                    await self.stop_charging()
+            finally:
+                # Con una sessione iniziata lo stato lo cancella finish_session, a record scritto:
+                # se la scrittura fallisce il prossimo riavvio riprova
+                if not self.saved_state.get("start_time"):
+                    self.clear_charge_state()
+            return True
+        logger.info(f"Ripresa della sessione interrotta ({state.get('phase')}): batteria al {battery_percentage}%, target {target}%")
+        await self.send_telegram_message(
+            f"🔄 Riavvio: riprendo la ricarica interrotta al {battery_percentage}% (target {target}%).", force=True)
+        await self.charge_to_target(battery_percentage, None, target, resume=state)
+        return True
+
+    async def charge_to_target(self, battery_percentage, time_estimate, target, resume=None):
+        if resume is None:
+            self.saved_state = {}
+            self.save_charge_state(phase=PHASE_WAITING, target=target)
+        cancelled = False
+        try:
+            await self._charge_to_target(battery_percentage, time_estimate, target, resume)
+        except asyncio.CancelledError:
+            # Arresto del processo: lo stato resta su disco per il prossimo
+            cancelled = True
+            raise
+        finally:
+            # Qualsiasi altra uscita (target raggiunto, cavo scollegato, stop, errore): niente da riprendere.
+            # Una sessione iniziata resta su disco finché finish_session non ha scritto il record
+            if not cancelled:
+                if not self.saved_state.get("start_time"):
+                    self.clear_charge_state()
+                self.target_override = None
+                # Target raggiunto con il cavo ancora collegato: il monitoraggio non richiede
+                # di nuovo finché il veicolo non viene scollegato
+                status = self.last_known_battery_status
+                if status is not None and status.plugStatus != 0 and status.batteryLevel >= self.charge_target:
+                    self.await_unplug = status.batteryLevel
+
+    async def _charge_to_target(self, battery_percentage, time_estimate, target, resume=None):
+        self.charge_target = target
+        departure = next_departure(self.now(), self.departure) if self.price_schedule else None
+        # Sessione aperta tra una fascia e l'altra: un solo record per tutta la ricarica
+        session = resume if resume is not None and resume.get("start_time") else None
+        try:
+            if resume is not None and resume.get("phase") == PHASE_CHARGING:
+                # La presa era accesa al momento del riavvio: continuo la stessa sessione
+                until = resume.get("until")
+                if until is not None:
+                    until = asyncio.get_running_loop().time() + (datetime.fromisoformat(until) - self.now()).total_seconds()
+                await self.checkpoint_charge_state()
+                if not await self.start_charging():
+                    logger.error("Impossibile riprendere la ricarica.")
+                    return
+                # Da qui la sessione è di charge_loop: la chiude oppure la ritorna ancora aperta
+                session = None
+                session = await self.charge_loop(battery_percentage, time_estimate, target, until=until,
+                                                 resume=resume, keep_open=True)
+                status = await self.get_batterystatus()
+                if status is None or status.plugStatus == 0 or self.stop_requested:
+                    return
+                battery_percentage = status.batteryLevel
+            while battery_percentage < self.charge_target:
+                if self.stop_requested:
+                    await self.stop_charging()
+                    return
+                target = self.charge_target
+                self.save_charge_state(phase=PHASE_WAITING)
+                now = self.now()
+                until = None
+                if departure is not None and now < departure:
+                    # Ripianifico a ogni fascia: il SoC reale può discostarsi dalla curva
+                    plan = plan_charging(self.price_schedule, self.ensure_charge_curve(),
+                                         battery_percentage, target, now, departure)
+                    if not plan.intervals:
+                        return
+                    await self.send_telegram_message(plan.describe(), force=True)
+                    begin, end = plan.intervals[0]
+                    if not plan.starts_now(now):
+                        await self.stop_charging()
+                        logger.info(f"Ricarica rimandata alle {begin:%H:%M}")
+                        # Controllo del cavo diradato: l'attesa può durare ore
+                        if not await self.safe_sleep((begin - now).total_seconds(), chunk_size=900):
+                            return
+                    until = end
+                # Senza tariffa (o a partenza passata) si ricarica subito fino al target;
+                # si torna qui dopo una pausa per fascia o per il limite di potenza.
+                # Prima della presa lo stato deve essere su disco
+                await self.checkpoint_charge_state()
+                if not await self.start_charging():
+                    logger.error("Impossibile avviare la ricarica.")
+                    return
+                if until is not None:
+                    until = asyncio.get_running_loop().time() + (until - self.now()).total_seconds()
+                session, previous = None, session
+                session = await self.charge_loop(battery_percentage, time_estimate, target, until=until,
+                                                 resume=previous, keep_open=True)
+                status = await self.get_batterystatus()
+                if status is None or status.plugStatus == 0 or self.stop_requested:
+                    return
+                battery_percentage = status.batteryLevel
+        except asyncio.CancelledError:
+            # Con lo stato su disco la sessione aperta passa al processo successivo
+            if self.charge_state is not None:
+                session = None
+            raise
+        finally:
+            if session is not None:
+                await self.close_session(session, self.charge_target)
+
+    def ensure_charge_curve(self):
+        if self.charge_curve is None:
+            self.charge_curve = ChargeCurveModel.from_sessions(self.stored_sessions(), self.vin)
+        return self.charge_curve
+
+    def ensure_health_tracker(self):
+        if self.health_tracker is None:
+            self.health_tracker = BatteryHealthTracker.from_sessions(self.stored_sessions(), self.vin)
+        return self.health_tracker
+
+    def ensure_history_index(self):
+        # Costruito alla prima richiesta (/storico), poi aggiornato a ogni sessione salvata.
+        # Sessioni di questo veicolo e quelle senza VIN (storico precedente alla flotta)
+        if self.history_index is None:
+            self.history_index = HistoryIndex(r for r in self.stored_sessions() if r.get("vin") in (None, "", self.vin))
+        return self.history_index
+
+    def history_summary(self, days=7, sessions=3):
+        index = self.ensure_history_index()
+        if not len(index):
+            return f"📊 {self.label()}: nessuna ricarica registrata."
+        lines = [f"📊 {self.label()}: ultimi {days} giorni"]
+        rows = index.daily(self.now().date() - timedelta(days=days - 1))
+        for row in rows:
+            lines.append(f"{row['date']:%d/%m}  {row['kwh']:.1f} kWh  {row['km']:.0f} km  {row['sessions']} ricaric{'a' if row['sessions'] == 1 else 'he'}")
+        if not rows:
+            lines.append("nessuna ricarica")
+        lines.append("Ultime ricariche:")
+        for record in reversed(index.last(sessions)):
+            lines.append(f"{str(record.get('start_time', ''))[:16].replace('T', ' ')}  "
+                         f"{record.get('start_battery_level')}% → {record.get('end_battery_level')}%")
+        return "\n".join(lines)
+
+    def ensure_plug_scheduler(self):
+        if self.plug_scheduler is None:
+            self.plug_scheduler = AdaptivePlugScheduler.from_sessions(self.stored_sessions(), self.vin)
+        return self.plug_scheduler
+
+    def trigger_plug_check(self):
+        self.ensure_plug_scheduler().trigger()
+
     async def monitor_plug_status(self):
         logger.info("Monitoraggio del cavo di ricarica avviato.")
+        self.monitor_started = asyncio.get_running_loop().time()
+        scheduler = self.ensure_plug_scheduler()
+        if self.dispatcher is not None:
+            self.dispatcher.register(self)
+        # Prima di tutto la sessione interrotta da un eventuale riavvio
+        await self.resume_interrupted()
+        if self.mongo_sync is not None:
+            # Sessioni rimaste in coda durante un periodo offline
+            await asyncio.to_thread(self.mongo_sync.flush)
+        triggered = False
         while True:
-            is_plugged = await self.get_plug_status()
-            if is_plugged:
+            is_plugged = await self.get_plug_status(force=triggered)
+            held = (self.await_unplug is not None
+                    and self.last_known_battery_status.batteryLevel >= self.await_unplug)
+            if is_plugged and self.stop_requested:
+                logger.info("Ricarica fermata con /stop: attendo lo scollegamento del cavo.")
+            elif is_plugged and held:
+                logger.info("Ricarica conclusa o rifiutata: attendo lo scollegamento del cavo.")
+            elif is_plugged:
+                self.await_unplug = None
                 logger.info("Cavo collegato!")
                 await self.send_telegram_message("⚡ Cavo collegato! Controllo lo stato della ricarica...", force=True)
                 await self.run_charging_cycle()
             else:
                 logger.info("Cavo scollegato rilevato nel monitoraggio.")
-            await asyncio.sleep(900)  # Controllo ogni 15 minuti
+                self.stop_requested = False
+                self.await_unplug = None
+                self.anomaly_stop = None
+            # Controllo frequente nelle fasce orarie abituali di collegamento, diradato altrimenti
+            interval = scheduler.next_interval(self.now())
+            logger.debug(f"Prossimo controllo del cavo tra {interval//60:.0f} min")
+            triggered = await scheduler.wait(interval)
 
     async def close(self):
+        if self.dispatcher is not None:
+            await self.dispatcher.close()
+        # Sessioni e stato ancora in coda di scrittura
+        await asyncio.to_thread(writer.flush, 10)
+        if self.renault_auth is not None:
+            await self.renault_auth.close()
         if self.websession:
             await self.websession.close()
+        await self.notifier.close()
 
 if __name__ == "__main__":
     async def main():
+        exporter = webhook = charger = None
         try:
             charger = EVCharger()
             await charger.setup()
-            remaining_call = await charger.vehicle.get_battery_status()
-            battery = remaining_call.batteryLevel
-            remaining = round(remaining_call.chargingRemainingTime*(80-battery)/(100-battery))*60
-            logger.info(f"Tempo stimato di ricarica restante: {remaining} secondi")
+            if os.getenv('PLUG_WEBHOOK_PORT'):
+                webhook = PlugTriggerWebhook([charger], port=int(os.getenv('PLUG_WEBHOOK_PORT')))
+                await webhook.start()
+            exporter = open_metrics_exporter()
+            if exporter is not None:
+                await exporter.start()
+            # La prima lettura della batteria è quella del monitoraggio: a caldo è l'unica
+            # chiamata Renault prima del ciclo di controllo
             await charger.monitor_plug_status()
         finally:
-            await charger.close()
+            if webhook is not None:
+                await webhook.close()
+            if exporter is not None:
+                await exporter.close()
+            if charger is not None:
+                await charger.close()
             logger.info("Sessione terminata")
 
     if sys.platform.startswith("win"):
@@ -0,0 +1,165 @@
+import math
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+SLOT_MINUTES = 30
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+SLOTS_PER_WEEK = 7 * SLOTS_PER_DAY
+# Ampiezza (in slot, per lato) delle fasce abituali: ore del giorno con almeno un collegamento vicino
+WINDOW_SLOTS = 2
+
+
+def _slot(dt):
+    return dt.weekday() * SLOTS_PER_DAY + (dt.hour * 60 + dt.minute) // SLOT_MINUTES
+
+
+class AdaptivePlugScheduler:
+    def __init__(self, min_interval=120, max_interval=1800, base_interval=900, uniform_interval=1200,
+                 window_interval=None):
+        # base_interval: polling fisso finché non c'è storico da cui imparare
+        # uniform_interval: polling in uno slot con la probabilità di collegamento di un
+        # veicolo che si collega una volta al giorno a orari casuali
+        # window_interval: intervallo massimo nelle fasce abituali (default base_interval),
+        # così un collegamento a un orario sparso non aspetta più che con il polling fisso
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.base_interval = base_interval
+        self.uniform_interval = uniform_interval
+        self.window_interval = base_interval if window_interval is None else window_interval
+        self.likelihood = None
+        self.window = None
+        self._event = asyncio.Event()
+
+    @property
+    def trained(self):
+        return self.likelihood is not None
+
+    # === APPRENDIMENTO DALLO STORICO ===
+    def fit(self, start_times):
+        start_times = sorted(start_times)
+        if not start_times:
+            return self
+        weeks = max(1.0, (start_times[-1] - start_times[0]).total_seconds() / (7 * 86400))
+        weekly = [0.0] * SLOTS_PER_WEEK
+        daily = [0.0] * SLOTS_PER_DAY
+        for dt in start_times:
+            s = _slot(dt)
+            weekly[s] += 1
+            daily[s % SLOTS_PER_DAY] += 1
+        # Collegamenti attesi per slot in una settimana tipo: metà dal giorno specifico,
+        # metà dallo stesso orario negli altri giorni (lo storico è scarso), smussati
+        # sugli slot adiacenti
+        raw = [0.5 * weekly[s] / weeks + 0.5 * daily[s % SLOTS_PER_DAY] / (7 * weeks)
+               for s in range(SLOTS_PER_WEEK)]
+        self.likelihood = [
+            (raw[s - 1] + 2 * raw[s] + raw[(s + 1) % SLOTS_PER_WEEK]) / 4
+            for s in range(SLOTS_PER_WEEK)
+        ]
+        # Fasce abituali: ore del giorno con almeno un collegamento entro WINDOW_SLOTS slot,
+        # in qualsiasi giorno (es. il weekend, con orari sparsi su tutta la giornata)
+        self.window = [
+            any(daily[(s + k) % SLOTS_PER_DAY] for k in range(-WINDOW_SLOTS, WINDOW_SLOTS + 1))
+            for s in range(SLOTS_PER_DAY)
+        ]
+        return self
+
+    @classmethod
+    def from_sessions(cls, sessions, vin=None, **kwargs):
+        start_times = []
+        for record in sessions:
+            if record.get("vin") not in (None, vin):
+                continue
+            try:
+                start_times.append(datetime.fromisoformat(record["start_time"]))
+            except (KeyError, TypeError, ValueError):
+                continue
+        return cls(**kwargs).fit(start_times)
+
+    # === CALCOLO DEL PROSSIMO CONTROLLO ===
+    def slot_interval(self, slot):
+        # Legge della radice quadrata: l'intervallo che minimizza chiamate + ritardo
+        # atteso è inversamente proporzionale a sqrt(probabilità di collegamento)
+        p = max(self.likelihood[slot % SLOTS_PER_WEEK], 1e-9)
+        interval = self.uniform_interval * math.sqrt((1 / SLOTS_PER_DAY) / p)
+        limit = self.window_interval if self.window[slot % SLOTS_PER_DAY] else self.max_interval
+        return max(self.min_interval, min(limit, interval))
+
+    def next_interval(self, now):
+        if not self.trained:
+            return self.base_interval
+        s = _slot(now)
+        interval = self.slot_interval(s)
+        # Non dormo oltre l'inizio di uno slot in cui si controlla più spesso
+        if self.slot_interval(s + 1) < interval:
+            slot_start = now.replace(minute=now.minute - now.minute % SLOT_MINUTES, second=0, microsecond=0)
+            to_next = (slot_start + timedelta(minutes=SLOT_MINUTES) - now).total_seconds()
+            interval = min(interval, max(self.min_interval, to_next))
+        return interval
+
+    # === TRIGGER ESTERNI (webhook, comandi Telegram) ===
+    def trigger(self):
+        self._event.set()
+
+    async def wait(self, seconds):
+        # True se svegliato da un trigger esterno, False allo scadere del tempo
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout=seconds)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._event.clear()
+
+
+def fit_schedulers(sessions, vins, **kwargs):
+    # Un solo passaggio sull'archivio per tutta la flotta
+    start_times = {vin: [] for vin in vins}
+    legacy = []
+    for record in sessions:
+        try:
+            dt = datetime.fromisoformat(record["start_time"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        vin = record.get("vin")
+        if vin is None:
+            legacy.append(dt)
+        elif vin in start_times:
+            start_times[vin].append(dt)
+    return {vin: AdaptivePlugScheduler(**kwargs).fit(times + legacy) for vin, times in start_times.items()}
+
+
+class PlugTriggerWebhook:
+    # POST /plug/<vin> (o /plug per tutti i veicoli) forza un controllo immediato del cavo
+    def __init__(self, chargers, host="127.0.0.1", port=8089):
+        self.chargers = {c.vin: c for c in chargers}
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    async def _handle(self, request):
+        vin = request.match_info.get("vin")
+        targets = [self.chargers[vin]] if vin in self.chargers else (
+            list(self.chargers.values()) if vin is None else [])
+        if not targets:
+            return web.json_response({"ok": False, "error": "veicolo sconosciuto"}, status=404)
+        for charger in targets:
+            charger.trigger_plug_check()
+        logger.info(f"Webhook: controllo cavo immediato per {[c.vin for c in targets]}")
+        return web.json_response({"ok": True, "triggered": [c.vin for c in targets]})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/plug", self._handle)
+        app.router.add_post("/plug/{vin}", self._handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        logger.info(f"Webhook rilevamento cavo in ascolto su {self.host}:{self.port}")
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
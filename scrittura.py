@@ -0,0 +1,250 @@
+import sys
+import queue
+import atexit
+import asyncio
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from metriche import metrics
+
+logger = logging.getLogger(__name__)
+
+LOG_PATH = 'ev_charger.log'
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+LOG_QUEUE_SIZE = 10000   # record di log in attesa al massimo, oltre vengono scartati (e contati)
+MAX_PENDING = 10000      # scritture in attesa al massimo, oltre chi scrive aspetta (senza bloccare il loop)
+BATCH_BUCKETS = (1, 2, 5, 10, 50, 100, 1000)
+
+
+# === LOG IN CODA ===
+class _BoundedQueueHandler(QueueHandler):
+    # Il loop non aspetta mai il disco: se il thread dei log resta indietro i record in più si perdono
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.counter("log_records_dropped_total", "Record di log scartati a coda piena").inc()
+
+
+_listener = None
+_queue_handler = None
+
+
+def setup_logging(path=LOG_PATH, level=logging.INFO, console_level=logging.WARNING,
+                  max_bytes=2*1024*1024, backup_count=3, queue_size=LOG_QUEUE_SIZE):
+    # File con rotazione e stderr scritti da un thread (QueueListener): nel loop resta solo
+    # l'inserimento in coda. Come basicConfig non fa nulla se il logging è già configurato
+    global _listener, _queue_handler
+    root = logging.getLogger()
+    if _listener is not None or root.handlers:
+        return _listener
+    formatter = logging.Formatter(LOG_FORMAT)
+    file_handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+    console_handler = logging.StreamHandler(sys.stderr)
+    console_handler.setLevel(console_level)
+    for handler in (file_handler, console_handler):
+        handler.setFormatter(formatter)
+    log_queue = queue.Queue(queue_size)
+    _queue_handler = _BoundedQueueHandler(log_queue)
+    root.addHandler(_queue_handler)
+    root.setLevel(level)
+    _listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def stop_logging():
+    # Scrive i record rimasti in coda e chiude i file
+    global _listener, _queue_handler
+    if _listener is None:
+        return
+    logging.getLogger().removeHandler(_queue_handler)
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
+    _queue_handler = None
+
+
+# === SCRITTURE SU DISCO IN BACKGROUND ===
+class BackgroundWriter:
+    # Un thread unico per le scritture del demone (archivio sessioni, copia colonnare, stato
+    # della ricarica), così fsync, np.save e compattazioni non fermano il loop condiviso dai veicoli.
+    #   - await append(fn, record): i record per la stessa funzione (es. store.extend) arrivati
+    #     mentre il thread lavora vengono scritti con una chiamata sola (un fsync per lotto);
+    #     append ritorna quando il lotto è su disco e rilancia l'eventuale errore di scrittura
+    #   - write(key, fn, *args): per la stessa chiave conta solo l'ultima scrittura in attesa
+    #     (es. lo stato di un veicolo riscritto più volte), senza attendere
+    #   - await persist(key, fn, *args): come write, ma ritorna quando quella scrittura (o una
+    #     successiva per la stessa chiave) è su disco, senza aspettare le altre chiavi
+    # await drain() (nel loop) o flush() (fuori dal loop) aspettano che tutto sia su disco
+    def __init__(self, max_pending=MAX_PENDING):
+        self.max_pending = max_pending
+        self._cond = threading.Condition()
+        self._batches = {}  # fn -> (record in attesa, [(loop, future)] di chi aspetta)
+        self._latest = {}   # chiave -> (fn, args, [(loop, future)] di chi aspetta)
+        self._drains = []   # [(loop, future)] di drain() in attesa
+        self._pending = 0
+        self._busy = False
+        self._closing = False
+        self._thread = None
+        self.writes = 0
+        self.batches = 0
+        self.errors = 0
+        self.waits = 0
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._closing = False
+            self._thread = threading.Thread(target=self._run, name="scrittura", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        batch_sizes = metrics.histogram("io_batch_records", "Record scritti per lotto", BATCH_BUCKETS)
+        while True:
+            with self._cond:
+                while not self._batches and not self._latest:
+                    if self._closing:
+                        return
+                    self._cond.wait()
+                batches, self._batches = self._batches, {}
+                latest, self._latest = self._latest, {}
+                self._busy = True
+            for fn, (records, waiters) in batches.items():
+                batch_sizes.observe(len(records))
+                error = self._call(fn, records)
+                for loop, future in waiters:
+                    _resolve(loop, future, error)
+            for fn, args, waiters in latest.values():
+                error = self._call(fn, *args)
+                for loop, future in waiters:
+                    _resolve(loop, future, error)
+            with self._cond:
+                self._pending -= sum(len(records) for records, _ in batches.values()) + len(latest)
+                self.batches += len(batches)
+                if not self._batches and not self._latest:
+                    # Risolti prima di tornare inattivo: chi aspetta il thread (flush) li trova già in coda nel loop
+                    for loop, future in self._drains:
+                        _resolve(loop, future, None)
+                    self._drains = []
+                self._busy = False
+                self._cond.notify_all()
+
+    def _call(self, fn, *args):
+        name = getattr(fn, "__qualname__", repr(fn))
+        try:
+            with metrics.timer("io_write_seconds", "Durata delle scritture in background", call=name):
+                fn(*args)
+            self.writes += 1
+        except Exception as e:
+            self.errors += 1
+            metrics.counter("io_errors_total", "Scritture in background fallite", call=name).inc()
+            logger.error(f"Scrittura in background fallita ({name}): {e}")
+            return e
+        return None
+
+    async def append(self, fn, *records):
+        if self._pending >= self.max_pending:
+            # Disco molto più lento delle sessioni: chi scrive aspetta in un thread, il loop no
+            self.waits += 1
+            metrics.counter("io_queue_waits_total", "Scritture in attesa di spazio in coda").inc()
+            await asyncio.to_thread(self._wait_room)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._cond:
+            batch, waiters = self._batches.setdefault(fn, ([], []))
+            batch.extend(records)
+            waiters.append((loop, future))
+            self._pending += len(records)
+            self._start()
+            self._cond.notify_all()
+        # Il lotto può contenere record di altri veicoli: si aspetta quello intero
+        await future
+
+    def write(self, key, fn, *args):
+        # Memoria limitata dal numero di chiavi (un file per veicolo): nessuna attesa
+        self._put(key, fn, args, None)
+
+    async def persist(self, key, fn, *args):
+        # Chi aspetta una scrittura sostituita aspetta quella che la sostituisce
+        future = asyncio.get_running_loop().create_future()
+        self._put(key, fn, args, (asyncio.get_running_loop(), future))
+        await future
+
+    def _put(self, key, fn, args, waiter):
+        with self._cond:
+            previous = self._latest.get(key)
+            if previous is None:
+                self._pending += 1
+            waiters = previous[2] if previous is not None else []
+            if waiter is not None:
+                waiters.append(waiter)
+            self._latest[key] = (fn, args, waiters)
+            self._start()
+            self._cond.notify_all()
+
+    def _wait_room(self):
+        with self._cond:
+            self._cond.wait_for(lambda: self._pending < self.max_pending)
+
+    def _idle(self):
+        return not self._batches and not self._latest and not self._busy
+
+    async def drain(self):
+        # Come flush, ma nel loop e senza occupare un thread dell'executor
+        future = self.idle_future(asyncio.get_running_loop())
+        if future is not None:
+            await future
+
+    def idle_future(self, loop):
+        # Future del loop risolta quando il thread non ha più niente da scrivere (None se è già
+        # fermo): per chi nel loop non può fare await, es. il selettore dell'orologio virtuale
+        with self._cond:
+            if self._idle():
+                return None
+            future = loop.create_future()
+            self._drains.append((loop, future))
+            return future
+
+    def flush(self, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(self._idle, timeout)
+
+    def close(self, timeout=10):
+        self.flush(timeout)
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def stats(self):
+        return {"writes": self.writes, "batches": self.batches, "pending": self._pending,
+                "errors": self.errors, "waits": self.waits}
+
+
+def _resolve(loop, future, error):
+    def done():
+        if future.done():
+            return
+        if error is None:
+            future.set_result(None)
+        else:
+            future.set_exception(error)
+    try:
+        loop.call_soon_threadsafe(done)
+    except RuntimeError:
+        pass  # loop già chiuso: nessuno aspetta più
+
+
+# Un solo writer per processo, condiviso da tutti i veicoli (come metrics)
+writer = BackgroundWriter()
+
+
+@atexit.register
+def _shutdown():
+    # Prima le scritture (possono ancora loggare errori), poi i log rimasti in coda
+    writer.close()
+    stop_logging()
@@ -0,0 +1,303 @@
+import asyncio
+import logging
+import random
+import re
+import selectors
+from collections import Counter
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from prese import PlugPool
+from ricarica import EVCharger
+from scrittura import writer
+
+logger = logging.getLogger(__name__)
+
+
+# === EVENT LOOP CON OROLOGIO VIRTUALE ===
+class _VirtualSelector:
+    # Quando il loop dovrebbe attendere il prossimo timer, il tempo virtuale salta
+    # direttamente alla sua scadenza invece di dormire davvero. Con scritture in corso il tempo
+    # virtuale resta fermo e il loop attende sul selettore reale, come per un socket: la future
+    # di writer.idle_future lo risveglia (call_soon_threadsafe) e chi attende una scrittura
+    # riprende allo stesso istante virtuale. Il loop non si blocca mai su un lock del writer
+    def __init__(self, selector, loop):
+        self._selector = selector
+        self._loop = loop
+        self._writing = None
+
+    def select(self, timeout=None):
+        if timeout is None:
+            return self._selector.select(None)
+        events = self._selector.select(0)
+        if not events and timeout > 0:
+            if self._writing is None or self._writing.done():
+                self._writing = writer.idle_future(self._loop)
+            if self._writing is not None:
+                return self._selector.select(None)
+            self._loop.advance(timeout)
+        return events
+
+    def __getattr__(self, name):
+        return getattr(self._selector, name)
+
+
+class VirtualClockEventLoop(asyncio.SelectorEventLoop):
+    def __init__(self, start=None):
+        self._virtual_time = 0.0
+        self.start_datetime = start or datetime(2025, 6, 2)
+        super().__init__(_VirtualSelector(selectors.DefaultSelector(), self))
+
+    def time(self):
+        return self._virtual_time
+
+    def advance(self, seconds):
+        self._virtual_time += seconds
+
+    def now(self):
+        return self.start_datetime + timedelta(seconds=self._virtual_time)
+
+
+def run_simulated(coro, start=None):
+    loop = VirtualClockEventLoop(start)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+        # Il thread di scrittura lavora in tempo reale: a fine simulazione tutto è su disco
+        writer.flush()
+
+
+def _loop_time():
+    return asyncio.get_running_loop().time()
+
+
+# === VEICOLO SIMULATO (API Renault) ===
+class SimulatedVehicle:
+    def __init__(self, soc=40.0, rate=5.0, taper_from=80, mileage=20000.0,
+                 km_per_pct=2.3, latency=0.4, rng=None):
+        # rate: %/h fino a taper_from, poi in calo lineare fino a metà velocità al 100%
+        self.soc = soc
+        self.rate = rate
+        self.taper_from = taper_from
+        self.mileage = mileage
+        self.km_per_pct = km_per_pct
+        self.latency = latency
+        self.rng = rng or random.Random(0)
+        self.plugged = False
+        self.plug = None
+        self.stalled = False
+        self.calls = Counter()
+        self._last = None
+
+    def rate_at(self, soc):
+        if soc < self.taper_from:
+            return self.rate
+        return self.rate * (1 - 0.5 * (soc - self.taper_from) / (100 - self.taper_from))
+
+    def is_charging(self):
+        return self.plugged and self.plug is not None and self.plug.device_on and self.soc < 100 and not self.stalled
+
+    def advance(self):
+        now = _loop_time()
+        if self._last is not None and self.is_charging():
+            remaining = (now - self._last) / 3600
+            while remaining > 0 and self.soc < 100:
+                dt = min(remaining, 0.02)
+                self.soc = min(100.0, self.soc + self.rate_at(self.soc) * dt)
+                remaining -= dt
+        self._last = now
+
+    def plug_in(self):
+        self.advance()
+        self.plugged = True
+
+    def unplug(self):
+        self.advance()
+        self.plugged = False
+
+    def drive(self, km):
+        self.advance()
+        self.soc = max(5.0, self.soc - km / self.km_per_pct)
+        self.mileage += km
+
+    async def get_battery_status(self):
+        self.calls["get_battery_status"] += 1
+        await asyncio.sleep(self.latency)
+        self.advance()
+        level = int(self.soc)
+        remaining = sum(60 / self.rate_at(s) for s in range(level, 100))
+        return SimpleNamespace(
+            timestamp=self.now_iso(),
+            batteryLevel=level,
+            batteryAutonomy=int(self.soc * self.km_per_pct),
+            plugStatus=1 if self.plugged else 0,
+            chargingStatus=1.0 if self.is_charging() else 0.0,
+            chargingRemainingTime=round(remaining * self.rng.uniform(0.8, 1.25)),
+            batteryTemperature=None,
+            batteryCapacity=None,
+            batteryAvailableEnergy=None,
+            chargingInstantaneousPower=None,
+        )
+
+    async def get_cockpit(self):
+        self.calls["get_cockpit"] += 1
+        await asyncio.sleep(self.latency)
+        return SimpleNamespace(totalMileage=round(self.mileage, 1), fuelAutonomy=None, fuelQuantity=None)
+
+    def now_iso(self):
+        loop = asyncio.get_running_loop()
+        return loop.now().isoformat() if isinstance(loop, VirtualClockEventLoop) else datetime.now().isoformat()
+
+
+# === PRESA TAPO SIMULATA ===
+class FakePlug:
+    def __init__(self, vehicle=None, power_w=1350):
+        self.vehicle = vehicle
+        self.power_w = power_w
+        self.device_on = False
+        self.calls = Counter()
+        self.off_events = []  # (istante, SoC) a ogni spegnimento durante una ricarica
+        if vehicle is not None:
+            vehicle.plug = self
+
+    async def _set(self, on):
+        self.calls["on" if on else "off"] += 1
+        await asyncio.sleep(0.2)
+        if self.vehicle is not None:
+            self.vehicle.advance()
+            if self.device_on and not on and self.vehicle.plugged:
+                self.off_events.append((_loop_time(), self.vehicle.soc))
+        self.device_on = on
+
+    async def on(self):
+        await self._set(True)
+
+    async def off(self):
+        await self._set(False)
+
+    async def get_device_info(self):
+        self.calls["get_device_info"] += 1
+        await asyncio.sleep(0.2)
+        return SimpleNamespace(device_on=self.device_on)
+
+    async def get_current_power(self):
+        self.calls["get_current_power"] += 1
+        await asyncio.sleep(0.2)
+        charging = self.vehicle.is_charging() if self.vehicle is not None else self.device_on
+        return SimpleNamespace(current_power=self.power_w if charging else 0)
+
+
+class FakeTapoCloud:
+    # Sostituto di tapo.ApiClient: client_factory va passato a PlugPool
+    def __init__(self, handshake_latency=0.8):
+        self.plugs = {}
+        self.handshake_latency = handshake_latency
+        self.handshakes = 0
+
+    def add_plug(self, ip, plug):
+        self.plugs[ip] = plug
+        return plug
+
+    def client_factory(self, email, password):
+        cloud = self
+
+        class _Client:
+            async def p100(self, ip):
+                cloud.handshakes += 1
+                await asyncio.sleep(cloud.handshake_latency)
+                return cloud.plugs[ip]
+
+            p110 = p100
+
+        return _Client()
+
+
+# === BOT TELEGRAM SIMULATO ===
+def reply_yes_below(target=80):
+    # Risposta tipica dell'utente: continua se la batteria è sotto il target, altrimenti no
+    def reply(prompt):
+        match = re.search(r"al (\d+)%", prompt)
+        if match and int(match.group(1)) < target:
+            return "sì"
+        return "no"
+    return reply
+
+
+class FakeTelegramBot:
+    # Sostituto di TelegramNotifier: registra i messaggi e risponde alle domande
+    def __init__(self, reply=None, reply_delay=45):
+        self.reply = reply or reply_yes_below()
+        self.reply_delay = reply_delay
+        self.messages = []
+        self.prompts = 0
+
+    def notify(self, text, chat_ids=None, coalesce_key=None, critical=False):
+        self.messages.append((_loop_time(), text))
+
+    async def answer(self, timeout=300):
+        self.prompts += 1
+        prompt = self.messages[-1][1] if self.messages else ""
+        answer = self.reply(prompt)
+        if answer is None or self.reply_delay > timeout:
+            await asyncio.sleep(timeout)
+            return None
+        await asyncio.sleep(self.reply_delay)
+        return answer
+
+    async def flush(self, timeout=10):
+        pass
+
+    async def close(self, timeout=10):
+        pass
+
+    def stats(self):
+        return {"sent": len(self.messages), "prompts": self.prompts}
+
+
+# === EVCHARGER COLLEGATO AI BACKEND SIMULATI ===
+class SimulatedCharger(EVCharger):
+    def __init__(self, vehicle, cloud, bot, session_store, vin="VF1SIM00000000001", plug_ip="10.0.0.1",
+                 columnar_store=None, charge_state=None):
+        super().__init__(vin=vin, smart_plug_ip=plug_ip, renault_email="sim@example.com",
+                         renault_password="sim", tapo_email="sim@example.com", tapo_password="sim",
+                         session_store=session_store, columnar_store=columnar_store, mongo_sync=None,
+                         charge_state=charge_state, notifier=bot, load_env=False,
+                         plug_pool=PlugPool("sim@example.com", "sim", client_factory=cloud.client_factory))
+        self.vehicle = vehicle
+
+    def now(self):
+        loop = asyncio.get_running_loop()
+        return loop.now() if isinstance(loop, VirtualClockEventLoop) else datetime.now()
+
+    async def ask_user(self, prompt, timeout=300):
+        self.notifier.notify(prompt)
+        return await self.notifier.answer(timeout)
+
+
+# === SCENARI ===
+def daily_commute_scenario(days=7, seed=0, start=None):
+    # Rientro serale verso le 18:30, partenza al mattino verso le 7:30, 40-120 km al giorno.
+    # Ritorna [(secondi dall'inizio al collegamento, secondi allo scollegamento, km percorsi prima)].
+    # start: inizio dell'orologio virtuale, lo stesso da passare a run_simulated (default 2 giugno 2025,
+    # mezzanotte); gli orari sono riferiti ai giorni a partire da quello di start
+    rng = random.Random(seed)
+    start = start or datetime(2025, 6, 2)
+    midnight = (datetime.combine(start.date(), datetime.min.time()) - start).total_seconds()
+    events = []
+    for day in range(days):
+        plug_in = midnight + day * 86400 + 18.5 * 3600 + rng.gauss(0, 1800)
+        unplug = midnight + (day + 1) * 86400 + 7.5 * 3600 + rng.gauss(0, 900)
+        events.append((plug_in, unplug, rng.uniform(40, 120)))
+    return events
+
+
+async def drive_scenario(vehicle, events):
+    loop = asyncio.get_running_loop()
+    for plug_in, unplug, km in events:
+        await asyncio.sleep(max(0.0, plug_in - loop.time()))
+        vehicle.drive(km)
+        vehicle.plug_in()
+        await asyncio.sleep(max(0.0, unplug - loop.time()))
+        vehicle.unplug()
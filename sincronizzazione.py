@@ -0,0 +1,209 @@
+import os
+import json
+import logging
+import threading
+from itertools import chain, islice
+
+from pymongo import ASCENDING, MongoClient, UpdateOne
+from pymongo.errors import PyMongoError
+
+from archivio_sessioni import JsonLinesSessionStore, load_sessions
+
+logger = logging.getLogger(__name__)
+
+# Stessi nomi usati dal notebook di analisi
+DEFAULT_DATABASE = "Renault_Dati"
+DEFAULT_COLLECTION = "charging_data"
+DEFAULT_STATE_PATH = "mongo_sync.json"
+DEFAULT_OUTBOX_PATH = "mongo_outbox.jsonl"
+BATCH_SIZE = 1000
+
+
+def session_key(record):
+    # Chiave naturale di una sessione: (veicolo, inizio ricarica). Le sessioni senza
+    # VIN (storico precedente alla gestione multi-veicolo) hanno vin null
+    return {"vin": record.get("vin"), "start_time": record["start_time"]}
+
+
+def _upsert(record):
+    document = {k: v for k, v in record.items() if k != "_id"}
+    return UpdateOne(session_key(record), {"$set": document}, upsert=True)
+
+
+class MongoSessionSync:
+    # collection: una Collection di pymongo (o di mongomock nei test)
+    def __init__(self, collection, state_path=DEFAULT_STATE_PATH, outbox_path=DEFAULT_OUTBOX_PATH,
+                 batch_size=BATCH_SIZE):
+        self.collection = collection
+        self.state_path = state_path
+        self.outbox = JsonLinesSessionStore(outbox_path)
+        self.batch_size = batch_size
+        self.state = self._load_state()
+        self.sent = 0
+        self.failures = 0
+        # push/flush arrivano da thread diversi (asyncio.to_thread, uno per veicolo)
+        self._lock = threading.RLock()
+
+    # === STATO PERSISTENTE (high-water mark per sorgente) ===
+    def _load_state(self):
+        if os.path.exists(self.state_path):
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        return {"sources": {}, "read_mark": None}
+
+    def _save_state(self):
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.state_path)
+
+    def ensure_indexes(self):
+        self.collection.create_index([("vin", ASCENDING), ("start_time", ASCENDING)], unique=True)
+        self.collection.create_index([("end_time", ASCENDING)])
+
+    # === SCRITTURA ===
+    def _write(self, records):
+        # Upsert in blocco: reinviare una sessione già presente non crea duplicati
+        for i in range(0, len(records), self.batch_size):
+            batch = records[i:i + self.batch_size]
+            self.collection.bulk_write([_upsert(r) for r in batch], ordered=False)
+            self.sent += len(batch)
+            yield len(batch)
+
+    def push(self, records):
+        # Le nuove sessioni passano sempre dalla coda locale: se Mongo non è
+        # raggiungibile restano lì e partono al primo invio riuscito
+        with self._lock:
+            self.outbox.extend(records)
+            return self.flush()
+
+    def flush(self):
+        with self._lock:
+            return self._flush()
+
+    def _flush(self):
+        pending = self.outbox.read_all()
+        if not pending:
+            return 0
+        done = 0
+        try:
+            for n in self._write(pending):
+                done += n
+        except PyMongoError as e:
+            self.failures += 1
+            logger.warning(f"MongoDB non raggiungibile ({e}): {len(pending) - done} sessioni restano in coda")
+        self._rewrite_outbox(pending[done:])
+        return done
+
+    def _rewrite_outbox(self, remaining):
+        tmp = self.outbox.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in remaining))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.outbox.path)
+
+    def pending(self):
+        return len(self.outbox.read_all())
+
+    def sync_records(self, source_id, records):
+        with self._lock:
+            return self._sync_records(source_id, records)
+
+    def _sync_records(self, source_id, records):
+        # records: sessioni in ordine di archivio (store append-only o file generato).
+        # Vengono inviate solo quelle oltre l'high-water mark della sorgente; se il file è
+        # stato riscritto (es. generazione_dati.py --mode estendi aggiunge sessioni in testa)
+        # riparto da capo, tanto gli upsert sono idempotenti
+        records = iter(records)
+        first = next(records, None)
+        if first is None:
+            return 0
+        fingerprint = session_key(first)
+        mark = self.state["sources"].get(source_id)
+        if mark is None or mark["first"] != fingerprint:
+            mark = {"first": fingerprint, "count": 0}
+            self.state["sources"][source_id] = mark
+            records = chain((first,), records)
+        else:
+            records = islice(records, mark["count"] - 1, None) if mark["count"] else chain((first,), records)
+        total = 0
+        try:
+            while True:
+                batch = list(islice(records, self.batch_size))
+                if not batch:
+                    break
+                for n in self._write(batch):
+                    mark["count"] += n
+                    total += n
+                self._save_state()
+        except PyMongoError as e:
+            self.failures += 1
+            logger.warning(f"Sincronizzazione di {source_id} interrotta ({e}): riprende dalla sessione {mark['count']}")
+        self._save_state()
+        return total
+
+    def sync_store(self, store):
+        return self.sync_records(os.path.abspath(store.path), store.iter_records())
+
+    def sync_file(self, path):
+        return self.sync_records(os.path.abspath(path), load_sessions(path))
+
+    # === LETTURA INCREMENTALE (analisi) ===
+    def fetch_since(self, end_time=None):
+        # Sessioni terminate dopo end_time, in ordine: usa l'indice su end_time
+        query = {"end_time": {"$gt": end_time}} if end_time else {}
+        return list(self.collection.find(query, {"_id": 0}).sort("end_time", ASCENDING))
+
+    def fetch_new(self):
+        # Come fetch_since, ricordando fin dove si è già letto
+        documents = self.fetch_since(self.state.get("read_mark"))
+        if documents:
+            self.state["read_mark"] = documents[-1]["end_time"]
+            self._save_state()
+        return documents
+
+    def stats(self):
+        return {"sent": self.sent, "failures": self.failures, "pending": self.pending()}
+
+
+def open_mongo_sync(uri, database=DEFAULT_DATABASE, collection=DEFAULT_COLLECTION,
+                    state_path=DEFAULT_STATE_PATH, outbox_path=DEFAULT_OUTBOX_PATH):
+    # Timeout breve: senza rete le sessioni finiscono nella coda locale invece di bloccare
+    client = MongoClient(uri, serverSelectionTimeoutMS=5000)
+    sync = MongoSessionSync(client[database][collection], state_path, outbox_path)
+    try:
+        sync.ensure_indexes()
+    except PyMongoError as e:
+        logger.warning(f"Impossibile creare gli indici MongoDB ({e})")
+    return sync
+
+
+def main():
+    import argparse
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Invio delle sessioni di ricarica a MongoDB")
+    parser.add_argument("sources", nargs="*", default=["charging_data.jsonl"],
+                        help="archivi da sincronizzare (JSON, JSON Lines, SQLite)")
+    parser.add_argument("--uri", default=os.getenv("MONGO_URI"))
+    parser.add_argument("--db", default=os.getenv("MONGO_DB", DEFAULT_DATABASE))
+    parser.add_argument("--collection", default=os.getenv("MONGO_COLLECTION", DEFAULT_COLLECTION))
+    args = parser.parse_args()
+    if not args.uri:
+        parser.error("serve --uri oppure la variabile MONGO_URI")
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    sync = open_mongo_sync(args.uri, args.db, args.collection)
+    flushed = sync.flush()
+    for source in args.sources:
+        sent = sync.sync_file(source)
+        print(f"✅ {source}: {sent} sessioni inviate")
+    print(f"Coda locale: {flushed} inviate, {sync.pending()} in attesa")
+
+
+if __name__ == "__main__":
+    main()
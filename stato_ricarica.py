@@ -0,0 +1,66 @@
+import os
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STATE_DIR = "stato_ricarica"
+
+# Fasi salvate per ogni veicolo:
+#   "attesa": ricarica decisa (target noto) ma presa spenta, es. in attesa della fascia economica
+#   "carica": charge_loop in corso, con i dati della sessione da completare
+PHASE_WAITING = "attesa"
+PHASE_CHARGING = "carica"
+
+
+class ChargeStateStore:
+    # Un piccolo file JSON per veicolo, riscritto in modo atomico (tmp + fsync + rename) a ogni
+    # cambio di stato: dopo un riavvio il processo successivo ritrova la sessione in corso.
+    # Le scritture sono poche per sessione (avvio, checkpoint, pause), non una per lettura
+    def __init__(self, directory=DEFAULT_STATE_DIR):
+        self.directory = directory
+        self.writes = 0
+
+    def _path(self, vin):
+        return os.path.join(self.directory, f"{vin}.json")
+
+    def load(self, vin):
+        path = self._path(vin)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            # Il rename atomico evita i file a metà: un file illeggibile è stato modificato a mano
+            logger.error(f"Stato di ricarica di {vin} illeggibile ({e}), ignorato")
+            return None
+
+    def save(self, vin, state):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(vin)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        self.writes += 1
+
+    def clear(self, vin):
+        try:
+            os.remove(self._path(vin))
+        except FileNotFoundError:
+            pass
+
+    def pending(self):
+        # VIN con una sessione da riprendere
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name[:-5] for name in os.listdir(self.directory) if name.endswith(".json"))
+
+
+def open_state_store(directory=None):
+    # CHARGE_STATE_DIR vuoto disattiva la ripresa dopo un riavvio
+    directory = os.getenv('CHARGE_STATE_DIR', DEFAULT_STATE_DIR) if directory is None else directory
+    return ChargeStateStore(directory) if directory else None
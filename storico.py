@@ -0,0 +1,369 @@
+import os
+import json
+import logging
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from datetime import date, datetime, timezone
+from heapq import merge
+from operator import itemgetter
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1)
+EPOCH_DAY = EPOCH.toordinal()
+MAX_LEVEL = 100
+# Foglie dell'albero dei segmenti sui livelli di SoC (potenza di 2 > MAX_LEVEL)
+LEVEL_LEAVES = 128
+
+
+# === CHIAVI TEMPORALI ===
+def _to_datetime(value):
+    # Orari locali come registrati da ricarica.py; quelli con fuso vengono portati in UTC
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    elif not isinstance(value, datetime) and isinstance(value, date):
+        value = datetime(value.year, value.month, value.day)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _key(value):
+    return (_to_datetime(value) - EPOCH).total_seconds()
+
+
+def _day(value):
+    return _to_datetime(value).date().toordinal()
+
+
+def _day_of_key(key):
+    return EPOCH_DAY + int(key // 86400)
+
+
+def _monday(day):
+    # Ordinale 1 = lunedì 1 gennaio dell'anno 1
+    return day - (day - 1) % 7
+
+
+def _soc_nodes(record):
+    # La sessione attraversa X se start < X <= end, cioè per i livelli interi in [start + 1, end]:
+    # l'intervallo si scompone in al più 2·log2(LEVEL_LEAVES) nodi dell'albero dei segmenti
+    try:
+        lo = max(0, int(float(record["start_battery_level"]) // 1) + 1)
+        hi = min(MAX_LEVEL, int(float(record["end_battery_level"]) // 1))
+    except (KeyError, TypeError, ValueError):
+        return ()
+    nodes = []
+    lo, hi = lo + LEVEL_LEAVES, hi + LEVEL_LEAVES + 1
+    while lo < hi:
+        if lo & 1:
+            nodes.append(lo)
+            lo += 1
+        if hi & 1:
+            hi -= 1
+            nodes.append(hi)
+        lo >>= 1
+        hi >>= 1
+    return nodes
+
+
+def _level_path(level):
+    # Nodi che contengono il livello: dalla foglia alla radice
+    node = level + LEVEL_LEAVES
+    while node:
+        yield node
+        node >>= 1
+
+
+def _number(record, field):
+    try:
+        value = float(record.get(field))
+    except (TypeError, ValueError):
+        return None
+    return value if value == value else None  # NaN come valore mancante
+
+
+def _km_between(previous, record):
+    # Km percorsi tra due ricariche dello stesso veicolo (differenza di contachilometri)
+    if previous is None:
+        return 0.0
+    before, after = _number(previous, "total_mileage"), _number(record, "total_mileage")
+    return max(0.0, after - before) if before is not None and after is not None else 0.0
+
+
+class _Timeline:
+    # Sessioni ordinate per start_time (chiavi in un array di float per le ricerche binarie)
+    # e, per le soglie di SoC, un albero dei segmenti sui livelli: ogni nodo tiene, ordinate per
+    # start_time, le sessioni il cui intervallo di livelli lo copre. Una sessione sta in al più
+    # 14 nodi e un livello è coperto dagli 8 nodi sul cammino foglia-radice, tutti disgiunti
+    def __init__(self):
+        self.keys = array("d")
+        self.records = []
+        self.nodes = {}
+
+    def node(self, node):
+        entry = self.nodes.get(node)
+        if entry is None:
+            entry = self.nodes[node] = (array("d"), [])
+        return entry
+
+    @staticmethod
+    def _insert(keys, records, key, record):
+        # Quasi sempre in coda; una sessione iniziata prima ma finita dopo un'altra
+        # (flotta) finisce poco prima della coda, con uno spostamento breve
+        if not keys or key >= keys[-1]:
+            keys.append(key)
+            records.append(record)
+            return len(keys) - 1
+        pos = bisect_right(keys, key)
+        keys.insert(pos, key)
+        records.insert(pos, record)
+        return pos
+
+    def insert(self, key, record):
+        pos = self._insert(self.keys, self.records, key, record)
+        for node in _soc_nodes(record):
+            self._insert(*self.node(node), key, record)
+        return pos
+
+    @staticmethod
+    def span(keys, start, end):
+        lo = bisect_left(keys, start) if start is not None else 0
+        hi = bisect_left(keys, end) if end is not None else len(keys)
+        return lo, hi
+
+    def between(self, start, end):
+        lo, hi = self.span(self.keys, start, end)
+        return self.records[lo:hi]
+
+    def last(self, n, before):
+        _, hi = self.span(self.keys, None, before)
+        return self.records[max(0, hi - n):hi]
+
+    def crossing(self, level, start, end):
+        # Una ricerca binaria per nodo del cammino, poi fusione dei tratti già ordinati:
+        # O(log n + k log 8), senza scandire le celle né riordinare i risultati
+        slices = []
+        for node in _level_path(level):
+            entry = self.nodes.get(node)
+            if entry is not None:
+                keys, records = entry
+                lo, hi = self.span(keys, start, end)
+                if lo < hi:
+                    slices.append(zip(keys[lo:hi], records[lo:hi]))
+        if len(slices) == 1:
+            return [record for _, record in slices[0]]
+        return [record for _, record in merge(*slices, key=itemgetter(0))]
+
+
+class _Totals:
+    # Aggregati per giorno (o settimana): chiavi ordinate per le ricerche per intervallo
+    def __init__(self):
+        self.keys = []
+        self.rows = {}
+
+    def add(self, key, kwh, km, sessions):
+        row = self.rows.get(key)
+        if row is None:
+            row = self.rows[key] = [0.0, 0.0, 0]
+            if not self.keys or key > self.keys[-1]:
+                self.keys.append(key)
+            else:
+                insort(self.keys, key)
+        row[0] += kwh
+        row[1] += km
+        row[2] += sessions
+
+    def between(self, start, end):
+        lo = bisect_left(self.keys, start) if start is not None else 0
+        hi = bisect_left(self.keys, end) if end is not None else len(self.keys)
+        return [(key, self.rows[key]) for key in self.keys[lo:hi]]
+
+
+class HistoryIndex:
+    # Indici in memoria sullo storico delle sessioni: per tempo (flotta e singolo veicolo),
+    # per soglia di SoC attraversata e aggregati giornalieri / settimanali aggiornati a ogni
+    # sessione. Le interrogazioni costano O(log n + k) invece di una scansione dello storico
+    def __init__(self, records=()):
+        self._all = _Timeline()
+        self._vins = {}
+        self._daily = {None: _Totals()}
+        self._weekly = {None: _Totals()}
+        self.extend(records)
+
+    @classmethod
+    def from_store(cls, store):
+        return cls(store.iter_records())
+
+    def extend(self, records):
+        # Ordinamento del blocco: la costruzione da uno storico disordinato resta O(n log n)
+        keyed = []
+        for record in records:
+            try:
+                keyed.append((_key(record["start_time"]), record))
+            except (KeyError, TypeError, ValueError):
+                logger.warning(f"Sessione senza start_time valido ignorata: {str(record)[:80]}")
+        keyed.sort(key=itemgetter(0))
+        if keyed and (not self._all.keys or keyed[0][0] >= self._all.keys[-1]):
+            self._append_sorted(keyed)
+            return
+        for key, record in keyed:
+            self._add(key, record)
+
+    def _vin_timeline(self, vin):
+        timeline = self._vins.get(vin)
+        if timeline is None:
+            timeline = self._vins[vin] = _Timeline()
+            self._daily[vin] = _Totals()
+            self._weekly[vin] = _Totals()
+        return timeline
+
+    def _append_sorted(self, keyed):
+        # Blocco successivo a tutto l'indice (costruzione iniziale, sessioni nuove in ordine):
+        # in ogni timeline e in ogni nodo le sessioni vanno solo in coda
+        self._all.keys.extend(key for key, _ in keyed)
+        self._all.records.extend(record for _, record in keyed)
+        for key, record in keyed:
+            vin = record.get("vin") or ""
+            timeline = self._vin_timeline(vin)
+            previous = timeline.records[-1] if timeline.records else None
+            timeline.keys.append(key)
+            timeline.records.append(record)
+            for node in _soc_nodes(record):
+                for owner in (self._all, timeline):
+                    keys, records = owner.node(node)
+                    keys.append(key)
+                    records.append(record)
+            self._count(vin, key, _number(record, "EnergyConsumed") or 0.0, _km_between(previous, record), 1)
+
+    def add(self, record):
+        self.extend([record])
+
+    def _add(self, key, record):
+        vin = record.get("vin") or ""
+        self._all.insert(key, record)
+        timeline = self._vin_timeline(vin)
+        pos = timeline.insert(key, record)
+        previous = timeline.records[pos - 1] if pos > 0 else None
+        self._count(vin, key, _number(record, "EnergyConsumed") or 0.0, _km_between(previous, record), 1)
+        if pos + 1 < len(timeline.records):
+            # Inserita prima di una sessione già indicizzata: cambiano i km di quella successiva
+            following = timeline.records[pos + 1]
+            delta = _km_between(record, following) - _km_between(previous, following)
+            if delta:
+                self._count(vin, timeline.keys[pos + 1], 0.0, delta, 0)
+
+    def _count(self, vin, start_key, kwh, km, sessions):
+        day = _day_of_key(start_key)
+        week = _monday(day)
+        for key in (None, vin):
+            self._daily[key].add(day, kwh, km, sessions)
+            self._weekly[key].add(week, kwh, km, sessions)
+
+    def _timeline(self, vin):
+        if vin is None:
+            return self._all
+        return self._vins.get(vin) or _Timeline()
+
+    # === INTERROGAZIONI ===
+    def between(self, start=None, end=None, vin=None):
+        # Sessioni iniziate in [start, end), in ordine cronologico
+        return self._timeline(vin).between(_key(start) if start is not None else None,
+                                           _key(end) if end is not None else None)
+
+    def last(self, n, vin=None, before=None):
+        # Ultime n sessioni (iniziate prima di before), in ordine cronologico
+        return self._timeline(vin).last(n, _key(before) if before is not None else None)
+
+    def crossing(self, level, start=None, end=None, vin=None):
+        # Sessioni che hanno attraversato il livello di SoC (start < level <= end)
+        if level != int(level) or not 0 <= level <= MAX_LEVEL:
+            raise ValueError(f"Livello di SoC non valido: {level} (intero tra 0 e {MAX_LEVEL})")
+        return self._timeline(vin).crossing(int(level), _key(start) if start is not None else None,
+                                            _key(end) if end is not None else None)
+
+    def daily(self, start=None, end=None, vin=None):
+        # [{"date", "kwh", "km", "sessions"}] per i giorni in [start, end) con almeno una sessione
+        return self._rows(self._daily, _day(start) if start is not None else None,
+                          _day(end) if end is not None else None, vin)
+
+    def weekly(self, start=None, end=None, vin=None):
+        # Come daily, per settimana (date = lunedì); start ed end vengono portati al lunedì
+        start = _day(start) if start is not None else None
+        end = _day(end) if end is not None else None
+        if start is not None:
+            start = _monday(start)
+        if end is not None:
+            end = _monday(end)
+        return self._rows(self._weekly, start, end, vin)
+
+    def _rows(self, totals, start, end, vin):
+        totals = totals.get(vin)
+        if totals is None:
+            return []
+        return [{"date": date.fromordinal(key), "kwh": round(kwh, 3), "km": round(km, 1), "sessions": n}
+                for key, (kwh, km, n) in totals.between(start, end)]
+
+    def vins(self):
+        return sorted(self._vins)
+
+    def __len__(self):
+        return len(self._all.records)
+
+
+# === RIGA DI COMANDO ===
+def _format_session(record):
+    return (f"{record.get('start_time', '')[:16]}  {record.get('vin') or '-':<17}  "
+            f"{record.get('start_battery_level')}% → {record.get('end_battery_level')}%  "
+            f"{_number(record, 'EnergyConsumed') or 0:.2f} kWh")
+
+
+def _format_totals(row):
+    return f"{row['date']}  {row['kwh']:>8.2f} kWh  {row['km']:>8.1f} km  {row['sessions']:>4} sessioni"
+
+
+def main():
+    import argparse
+    from archivio_sessioni import load_sessions
+
+    parser = argparse.ArgumentParser(description="Interrogazioni sullo storico delle ricariche")
+    parser.add_argument("--store", default=os.getenv("SESSION_STORE_PATH", "charging_data.jsonl"),
+                        help="archivio JSON / JSON Lines / SQLite")
+    parser.add_argument("--vin", default=None, help="solo questo veicolo")
+    parser.add_argument("--da", type=datetime.fromisoformat, default=None, help="inizio (incluso)")
+    parser.add_argument("--a", type=datetime.fromisoformat, default=None, help="fine (esclusa)")
+    parser.add_argument("--json", action="store_true", help="una riga JSON per risultato")
+    commands = parser.add_subparsers(dest="comando", required=True)
+    commands.add_parser("sessioni", help="sessioni iniziate nell'intervallo")
+    last = commands.add_parser("ultime", help="ultime N sessioni")
+    last.add_argument("n", type=int)
+    threshold = commands.add_parser("soglia", help="sessioni che hanno attraversato un livello di SoC")
+    threshold.add_argument("livello", type=int)
+    commands.add_parser("giorni", help="kWh, km e sessioni per giorno")
+    commands.add_parser("settimane", help="kWh, km e sessioni per settimana")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    index = HistoryIndex(load_sessions(args.store))
+    if args.comando == "sessioni":
+        rows = index.between(args.da, args.a, vin=args.vin)
+    elif args.comando == "ultime":
+        rows = index.last(args.n, vin=args.vin, before=args.a)
+    elif args.comando == "soglia":
+        rows = index.crossing(args.livello, args.da, args.a, vin=args.vin)
+    elif args.comando == "giorni":
+        rows = index.daily(args.da, args.a, vin=args.vin)
+    else:
+        rows = index.weekly(args.da, args.a, vin=args.vin)
+    totals = args.comando in ("giorni", "settimane")
+    for row in rows:
+        if args.json:
+            print(json.dumps(row, ensure_ascii=False, default=str))
+        else:
+            print(_format_totals(row) if totals else _format_session(row))
+    if not args.json:
+        print(f"{len(rows)} risultati su {len(index)} sessioni")
+
+
+if __name__ == "__main__":
+    main()
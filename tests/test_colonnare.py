@@ -0,0 +1,58 @@
+import os
+
+import numpy as np
+
+from colonnare import MERGE_FANOUT, ColumnarSessionStore
+
+
+def session(day, vin="VF1TEST0000000001", health=0.9):
+    return {"vin": vin, "start_time": f"2024-01-{day:02d}T18:00:00", "end_time": f"2024-01-{day:02d}T22:00:00",
+            "start_battery_level": 30, "end_battery_level": 80, "battery_health_estimate": health,
+            "total_mileage": 12345.6}
+
+
+def days(data):
+    return [str(d)[:10] for d in data["start_time"].astype("datetime64[us]")]
+
+
+def test_range_and_vin_filters(tmp_path):
+    store = ColumnarSessionStore(str(tmp_path))
+    store.append_records([session(d, vin="A" if d % 2 else "B") for d in range(10, 0, -1)])
+
+    data = store.read(start="2024-01-03", end="2024-01-07", vins=["A"])
+    assert days(data) == ["2024-01-03", "2024-01-05"]
+    assert list(store.vin_names(data["vin"])) == ["A", "A"]
+    # Salute in percentuale, chilometraggio in float64
+    assert np.allclose(data["battery_health_estimate"], 90.0)
+    assert data["total_mileage"][0] == 12345.6
+    assert len(store.read(vins=["sconosciuto"])["vin"]) == 0
+
+
+def test_small_partitions_are_memory_mapped(tmp_path):
+    store = ColumnarSessionStore(str(tmp_path))
+    store.append_records([session(1)])
+    partition = store.manifest["partitions"][0]
+    assert partition["file"].endswith(".npy")
+    with store._open(partition) as data:
+        assert isinstance(data["start_time"], np.memmap)
+
+
+def test_tiered_compaction_and_reopen(tmp_path):
+    store = ColumnarSessionStore(str(tmp_path))
+    for d in range(1, MERGE_FANOUT + 3):
+        store.append_records([session(d)])
+    # Le prime MERGE_FANOUT partizioni da una riga diventano una sola
+    assert [p["rows"] for p in store.manifest["partitions"]] == [MERGE_FANOUT, 1, 1]
+    assert len([f for f in os.listdir(tmp_path) if f.startswith("part-")]) == 3
+
+    reopened = ColumnarSessionStore(str(tmp_path))
+    assert len(reopened) == MERGE_FANOUT + 2
+    assert days(reopened.read()) == [f"2024-01-{d:02d}" for d in range(1, MERGE_FANOUT + 3)]
+
+
+def test_append_columns_with_one_vin_per_row(tmp_path):
+    store = ColumnarSessionStore(str(tmp_path))
+    columns = store.records_to_columns([session(d) for d in (1, 2, 3)])
+    store.append_columns(columns, vin=np.array(["B", "A", "B"], dtype=object))
+    data = store.read(vins=["B"])
+    assert days(data) == ["2024-01-01", "2024-01-03"]
@@ -0,0 +1,74 @@
+from datetime import datetime
+
+import numpy as np
+
+from curva_ricarica import ChargeCurveModel
+from pianificazione import TimeSeriesPrices, plan_charging
+
+# Curva senza storico: 5 %/h, quindi 12 minuti per punto di SoC (50% -> 57% = 84 minuti)
+CURVE = ChargeCurveModel()
+MONDAY = datetime(2025, 1, 6)
+
+
+def hourly(prices):
+    times = [int(np.datetime64(MONDAY.replace(hour=h), "us").astype(np.int64)) for h in range(len(prices))]
+    return TimeSeriesPrices(times, prices, slot_minutes=60)
+
+
+def at(hour, minute=0):
+    return MONDAY.replace(hour=hour, minute=minute)
+
+
+def plan(prices, soc=50, target=57, start=at(0), departure=at(6)):
+    return plan_charging(hourly(prices), CURVE, soc, target, start, departure, margin=1.0)
+
+
+def test_partial_slot_ends_where_the_next_planned_slot_starts():
+    # Ora più economica 2-3, poi 1-2 usata per 24 minuti: una sola accensione fino alle 3
+    result = plan([5, 2, 1, 5, 5, 5])
+    assert result.intervals == [(at(1, 36), at(3))]
+    assert result.feasible
+
+
+def test_partial_slot_follows_the_previous_planned_slot():
+    result = plan([5, 1, 2, 5, 5, 5])
+    assert result.intervals == [(at(1), at(2, 24))]
+
+
+def test_isolated_partial_slot_starts_at_the_beginning_of_its_slot():
+    result = plan([5, 2, 5, 1, 5, 5])
+    assert result.intervals == [(at(1), at(1, 24)), (at(3), at(4))]
+    assert result.cost < result.immediate_cost
+
+
+def test_deadline_off_the_slot_grid():
+    # Partenza alle 2:30 e avvio alle 0:20: segmenti parziali ai due estremi
+    result = plan([1] * 6, start=at(0, 20), departure=at(2, 30))
+    assert result.intervals == [(at(0, 20), at(1, 44))]
+    assert result.starts_now(at(0, 20))
+
+
+def test_deadline_exactly_enough_time():
+    result = plan([3, 1, 3, 3, 3, 3], departure=at(1, 24))
+    assert result.intervals == [(at(0), at(1, 24))]
+    assert result.feasible
+
+
+def test_deadline_too_close_charges_until_departure():
+    result = plan([1] * 6, target=65, departure=at(2, 30))
+    assert result.intervals == [(at(0), at(2, 30))]
+    assert not result.feasible
+
+
+def test_departure_already_passed():
+    result = plan([1] * 6, start=at(3), departure=at(2))
+    assert result.intervals == []
+    assert not result.feasible
+
+
+def test_no_intervals_when_already_at_target():
+    for soc in (80, 85):
+        result = plan([1] * 6, soc=soc, target=80)
+        assert result.intervals == []
+        assert result.cost == 0.0
+        assert result.feasible
@@ -0,0 +1,110 @@
+import asyncio
+
+from potenza import PowerBudget
+
+
+def run(test):
+    # Le lease usano futures del loop: ogni test gira in un loop suo
+    return asyncio.run(test())
+
+
+def test_requests_over_the_cap_wait_for_a_release():
+    async def test():
+        budget = PowerBudget(3.0)
+        first = budget.request("a", 1.0, 1.5)
+        second = budget.request("b", 1.0, 1.5)
+        third = budget.request("c", 0.5, 1.5)
+        fourth = budget.request("d", 0.9, 1.5)
+        assert first.granted.done() and second.granted.done()
+        assert not third.granted.done() and not fourth.granted.done()
+        assert budget.load_kw == 3.0
+
+        # Entra il più urgente in coda
+        budget.release("a")
+        assert fourth.granted.done() and not third.granted.done()
+        assert budget.load_kw == 3.0
+    run(test)
+
+
+def test_single_plug_over_the_cap_is_admitted_on_an_empty_site():
+    async def test():
+        budget = PowerBudget(1.0)
+        assert budget.request("a", 1.0, 1.5).granted.done()
+        assert not budget.request("b", 5.0, 1.5).granted.done()
+    run(test)
+
+
+def test_release_of_a_waiting_request_cancels_it():
+    async def test():
+        budget = PowerBudget(1.5)
+        budget.request("a", 1.0, 1.5)
+        waiting = budget.request("b", 1.0, 1.5)
+        budget.release("b")
+        assert waiting.granted.cancelled()
+        assert not budget.waiting
+    run(test)
+
+
+def test_much_more_urgent_request_preempts_the_least_urgent():
+    async def test():
+        budget = PowerBudget(3.0, min_run_s=0)
+        low = budget.request("low", 0.5, 1.5)
+        mid = budget.request("mid", 1.0, 1.5)
+        # Non abbastanza più urgente (isteresi del 20%): nessuna sospensione
+        budget.request("similar", 0.55, 1.5)
+        assert not low.revoked
+        urgent = budget.request("urgent", 2.0, 1.5)
+        assert low.revoked and not mid.revoked
+        assert not urgent.granted.done()
+        # La potenza torna disponibile quando il veicolo sospeso spegne la presa
+        budget.release("low")
+        assert urgent.granted.done()
+        assert budget.preemptions == 1
+    run(test)
+
+
+def test_recently_admitted_session_is_not_preempted():
+    async def test():
+        budget = PowerBudget(1.5, min_run_s=900)
+        running = budget.request("a", 0.5, 1.5)
+        budget.request("b", 5.0, 1.5)
+        assert not running.revoked
+    run(test)
+
+
+def test_measured_power_is_counted_in_the_load():
+    async def test():
+        budget = PowerBudget(3.0)
+        budget.request("a", 1.0, 1.5)
+        budget.update("a", measured_kw=1.8)
+        assert budget.load_kw == 1.8
+        budget.release("a")
+        assert budget.load_kw == 0.0
+    run(test)
+
+
+def test_cap_holds_when_measured_power_rises():
+    async def test():
+        budget = PowerBudget(3.0)
+        low = budget.request("low", 0.5, 1.5)
+        high = budget.request("high", 1.0, 1.5)
+        assert budget.load_kw == 3.0
+        # La presa più urgente assorbe più del previsto: si sospende la meno urgente
+        budget.update("high", measured_kw=2.0)
+        assert low.revoked and not high.revoked
+        assert budget.load_kw - budget.revoked_kw <= budget.cap_kw
+        assert budget.sheds == 1
+    run(test)
+
+
+def test_low_measured_power_keeps_the_reservation():
+    async def test():
+        budget = PowerBudget(3.0)
+        budget.request("a", 1.0, 1.5)
+        budget.request("b", 1.0, 1.5)
+        waiting = budget.request("c", 1.0, 1.5)
+        # Una lettura bassa (rampa, pausa del BMS) non libera la potenza prenotata
+        budget.update("a", measured_kw=0.2)
+        assert budget.load_kw == 3.0
+        assert not waiting.granted.done()
+    run(test)
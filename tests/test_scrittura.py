@@ -0,0 +1,94 @@
+import asyncio
+import threading
+
+import pytest
+
+from scrittura import BackgroundWriter
+
+
+@pytest.fixture
+def writer():
+    writer = BackgroundWriter()
+    yield writer
+    writer.close()
+
+
+def test_appends_arriving_while_busy_are_written_as_one_batch(writer):
+    calls = []
+    entered, release = threading.Event(), threading.Event()
+
+    def slow(*args):
+        entered.set()
+        release.wait(5)
+        calls.append(args)
+
+    def extend(records):
+        calls.append(tuple(records))
+
+    async def test():
+        writer.write("blocco", slow)
+        await asyncio.to_thread(entered.wait, 5)  # il thread è dentro slow
+        pending = [asyncio.ensure_future(writer.append(extend, i)) for i in range(5)]
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(*pending)
+
+    asyncio.run(test())
+    assert calls == [(), (0, 1, 2, 3, 4)]
+    assert writer.stats()["errors"] == 0
+
+
+def test_append_raises_the_write_error(writer):
+    def broken(records):
+        raise OSError("disco pieno")
+
+    async def test():
+        with pytest.raises(OSError, match="disco pieno"):
+            await writer.append(broken, {"a": 1})
+
+    asyncio.run(test())
+    assert writer.errors == 1
+
+
+def test_write_keeps_only_the_latest_value_per_key(writer):
+    saved = []
+    release = threading.Event()
+    writer.write("blocco", release.wait, 5)
+    for i in range(10):
+        writer.write(("stato", "VIN"), saved.append, i)
+    release.set()
+    assert writer.flush(5)
+    assert saved == [9]
+
+
+def test_drain_waits_for_queued_writes(writer):
+    saved = []
+
+    async def test():
+        for i in range(3):
+            writer.write(("stato", i), saved.append, i)
+        await writer.drain()
+        assert sorted(saved) == [0, 1, 2]
+        # Niente in coda: ritorna subito
+        await asyncio.wait_for(writer.drain(), 1)
+
+    asyncio.run(test())
+
+
+def test_persist_returns_when_the_latest_value_is_on_disk(writer):
+    saved = []
+    release = threading.Event()
+
+    async def test():
+        writer.write("blocco", release.wait, 5)
+        first = asyncio.ensure_future(writer.persist(("stato", "VIN"), saved.append, 1))
+        await asyncio.sleep(0)
+        # Sostituita prima di essere scritta: entrambi aspettano il valore più recente
+        second = asyncio.ensure_future(writer.persist(("stato", "VIN"), saved.append, 2))
+        await asyncio.sleep(0)
+        assert not first.done()
+        release.set()
+        await asyncio.gather(first, second)
+        assert saved == [2]
+
+    asyncio.run(test())
@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+from sincronizzazione import MongoSessionSync
+
+
+def session(day, vin="VF1TEST0000000001"):
+    return {"vin": vin, "start_time": f"2024-01-{day:02d}T18:00:00",
+            "end_time": f"2024-01-{day:02d}T22:00:00", "start_battery_level": 30, "end_battery_level": 80}
+
+
+def append(path, records):
+    with open(path, "a", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+@pytest.fixture
+def sync(tmp_path):
+    collection = mongomock.MongoClient()["Renault_Dati"]["charging_data"]
+    sync = MongoSessionSync(collection, state_path=str(tmp_path / "mongo_sync.json"),
+                            outbox_path=str(tmp_path / "mongo_outbox.jsonl"), batch_size=2)
+    sync.ensure_indexes()
+    return sync
+
+
+def test_incremental_sync_and_fetch(sync, tmp_path):
+    path = str(tmp_path / "charging_data.jsonl")
+    append(path, [session(d) for d in range(1, 6)])
+
+    assert sync.sync_file(path) == 5
+    assert [d["start_time"][:10] for d in sync.fetch_new()] == [f"2024-01-{d:02d}" for d in range(1, 6)]
+    assert sync.fetch_new() == []
+
+    # Solo le sessioni aggiunte vengono inviate e lette
+    append(path, [session(6), session(7)])
+    assert sync.sync_file(path) == 2
+    assert [d["start_time"][:10] for d in sync.fetch_new()] == ["2024-01-06", "2024-01-07"]
+    assert sync.sync_file(path) == 0
+    assert sync.collection.count_documents({}) == 7
+
+
+def test_rewritten_source_is_resent_without_duplicates(sync, tmp_path):
+    path = str(tmp_path / "charging_data.jsonl")
+    append(path, [session(d) for d in range(2, 5)])
+    assert sync.sync_file(path) == 3
+
+    # Sessione aggiunta in testa: il file riparte da capo, gli upsert non duplicano
+    with open(path, "r", encoding="utf-8") as f:
+        existing = f.read()
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(json.dumps(session(1)) + "\n" + existing)
+    assert sync.sync_file(path) == 4
+    assert sync.collection.count_documents({}) == 4
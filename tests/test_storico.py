@@ -0,0 +1,46 @@
+from datetime import datetime, timedelta
+
+from storico import HistoryIndex
+
+MONDAY = datetime(2025, 1, 6)
+
+
+def session(hour, start, end, vin="A", kwh=5.0, km=None):
+    return {"vin": vin, "start_time": (MONDAY + timedelta(hours=hour)).isoformat(), "start_battery_level": start,
+            "end_battery_level": end, "EnergyConsumed": kwh, "total_mileage": km}
+
+
+def hours(records):
+    return [int((datetime.fromisoformat(r["start_time"]) - MONDAY).total_seconds() // 3600) for r in records]
+
+
+def test_crossing_matches_a_scan_in_time_order():
+    records = [session(h, (h * 37) % 100, (h * 37) % 100 + (h * 13) % 60, vin="AB"[h % 2]) for h in range(200)]
+    bulk = HistoryIndex(records)
+    incremental = HistoryIndex()
+    for record in reversed(records):
+        incremental.add(record)
+    start, end = MONDAY + timedelta(hours=20), MONDAY + timedelta(hours=150)
+    for level in range(0, 101):
+        expected = [r for r in records if start.isoformat() <= r["start_time"] < end.isoformat()
+                    and r["start_battery_level"] < level <= r["end_battery_level"]]
+        assert hours(bulk.crossing(level, start, end)) == hours(expected)
+        assert hours(incremental.crossing(level, start, end)) == hours(expected)
+        assert hours(bulk.crossing(level, start, end, vin="A")) == hours(r for r in expected if r["vin"] == "A")
+
+
+def test_crossing_bounds():
+    index = HistoryIndex([session(0, 20, 80), session(1, 80, 100), session(2, 0, 100)])
+    # Attraversa X se start < X <= end
+    assert hours(index.crossing(80)) == [0, 2]
+    assert hours(index.crossing(20)) == [2]
+    assert hours(index.crossing(100)) == [1, 2]
+    assert index.crossing(0) == []
+
+
+def test_daily_totals_and_km_of_a_session_inserted_in_between():
+    index = HistoryIndex([session(0, 20, 80, km=1000), session(48, 20, 80, km=1100)])
+    index.add(session(24, 20, 80, km=1040))
+    assert [(row["kwh"], row["km"], row["sessions"]) for row in index.daily()] == [
+        (5.0, 0.0, 1), (5.0, 40.0, 1), (5.0, 60.0, 1)]
+    assert hours(index.last(2)) == [24, 48]